@@ -1,15 +1,79 @@
+import asyncio
+import hashlib
+import json
 import os
-from dataclasses import dataclass
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, replace
 from typing import Literal
 
-from dotenv import load_dotenv
-from openai import OpenAI
-
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from config import (
+    BUTLER_TIERED,
+    CLASSIFY_BODY_TOKEN_BUDGET,
+    CLASSIFY_MAX_TOKENS,
+    LLM_CACHE_FILE,
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL_SECONDS,
+    LLM_CONCURRENCY,
+    REPLY_WORTHY_CLASSES,
+)
+import metrics
+import preclassifier
+import ratelimit
+import replay
+from preprocess import cap_tokens, estimate_tokens
+from rules import is_cache_opt_out
+
+# OpenAI clients, created on first use so importing this module stays cheap;
+# assign fakes here to run offline.
+client = None
+async_client = None
+
+MODEL = "gpt-4.1-mini"
+BUTLER_TEMPERATURE = 0.4
+COMPOSER_TEMPERATURE = 0.6
+# Reserved against the tokens-per-minute budget when max_tokens is not set;
+# corrected from the reported usage once the response arrives.
+COMPLETION_TOKEN_ESTIMATE = 400
 
 EmailClass = Literal["URGENT", "IMPORTANT", "INFO ONLY", "SPAM / MARKETING"]
 
+
+def _new_client(kind: str):
+    import openai
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    # Retries are handled by ratelimit so they share one budget and backoff policy
+    return getattr(openai, kind)(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+def _sync_client():
+    global client
+    if client is None:
+        client = _new_client("OpenAI")
+    return client
+
+
+def _async_client():
+    global async_client
+    if async_client is None:
+        if replay.replaying():
+            async_client = replay.chat_client()
+        else:
+            async_client = replay.wrap_chat(_new_client("AsyncOpenAI"))
+    return async_client
+
+
+def _transient_errors() -> tuple:
+    """openai's connection errors, or nothing when a fake client is in use."""
+    import sys
+
+    openai = sys.modules.get("openai")
+    return (openai.APIConnectionError,) if openai is not None else ()
+
+
 # ===== Results for incoming-email butler =====
 
 @dataclass
@@ -29,6 +93,241 @@ class EmailComposerResult:
     body: str
 
 
+@dataclass
+class Completion:
+    content: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency: float
+
+
+@dataclass
+class StreamTiming:
+    """Seconds from request to first visible subject/body text, and to the end."""
+    first_text: float | None
+    total: float
+
+
+# ===== Persistent LLM response cache =====
+
+def cache_key(model: str, instruction: str, temperature: float, prompt: str) -> str:
+    """
+    Content address for a completion. Whitespace in the prompt is collapsed
+    so re-wrapped copies of the same mailing share one entry.
+    """
+    normalized = " ".join(prompt.split())
+    payload = json.dumps([model, instruction, temperature, normalized])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of parsed results, keyed by cache_key().
+
+    Entries expire after ttl seconds; once more than max_entries are stored
+    the least recently used ones are evicted. hits / misses / evictions are
+    counted for the lifetime of the process.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    with conn:
+                        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            with conn:
+                conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, value: dict):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, used_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now),
+                )
+                count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if count > self.max_entries:
+                    cur = conn.execute(
+                        "DELETE FROM responses WHERE key IN ("
+                        " SELECT key FROM responses ORDER BY used_at LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+                    self.evictions += cur.rowcount
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+butler_cache = ResponseCache(LLM_CACHE_FILE, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES)
+
+
+# ===== Async completion path =====
+
+# Bounds concurrent requests to the API; created on the loop that uses it.
+_semaphore: asyncio.Semaphore | None = None
+# cache_key -> task for completions currently in flight
+_in_flight: dict = {}
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+async def _request_completion(
+    instruction: str, prompt: str, temperature: float, max_tokens: int | None
+) -> Completion:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    extra = {"max_tokens": max_tokens} if max_tokens else {}
+    estimate = estimate_tokens(instruction) + estimate_tokens(prompt) + (max_tokens or COMPLETION_TOKEN_ESTIMATE)
+
+    async def attempt():
+        await ratelimit.acquire_openai(estimate)
+        return await _async_client().chat.completions.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": instruction},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=temperature,
+            **extra,
+        )
+
+    async with _semaphore:
+        start = time.perf_counter()
+        resp = await ratelimit.call_with_retry_async(attempt, "chat.completions", transient=_transient_errors())
+        latency = time.perf_counter() - start
+    usage = getattr(resp, "usage", None)
+    completion = Completion(
+        content=resp.choices[0].message.content or "",
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        latency=latency,
+    )
+    ratelimit.settle_openai(estimate, completion.prompt_tokens + completion.completion_tokens)
+    return completion
+
+
+async def complete_with_usage_async(
+    instruction: str, prompt: str, temperature: float, max_tokens: int | None = None
+) -> Completion:
+    """
+    One completion, with at most LLM_CONCURRENCY requests in flight.
+    Identical concurrent prompts share a single request; only the caller
+    that issued it is charged its token usage.
+    """
+    key = cache_key(MODEL, instruction, temperature, f"{max_tokens}:{prompt}")
+    task = _in_flight.get(key)
+    if task is not None:
+        shared = await asyncio.shield(task)
+        return replace(shared, prompt_tokens=0, completion_tokens=0)
+
+    task = asyncio.ensure_future(_request_completion(instruction, prompt, temperature, max_tokens))
+    _in_flight[key] = task
+    task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def complete_async(instruction: str, prompt: str, temperature: float) -> str:
+    """Raw completion text for one prompt; see complete_with_usage_async."""
+    return (await complete_with_usage_async(instruction, prompt, temperature)).content
+
+
+class UsageStats:
+    """Calls, tokens and latency per email class and tier ("local" / "classify" / "draft")."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_class: dict = {}
+
+    def record(self, klass: str, tier: str, completion: Completion):
+        with self._lock:
+            row = self.by_class.setdefault(klass, {}).setdefault(
+                tier, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0}
+            )
+            row["calls"] += 1
+            row["prompt_tokens"] += completion.prompt_tokens
+            row["completion_tokens"] += completion.completion_tokens
+            row["latency"] += completion.latency
+        if tier != "local":
+            metrics.observe("sandra_llm_seconds", completion.latency, tier=tier)
+        metrics.inc("sandra_llm_calls_total", tier=tier, klass=klass)
+        metrics.inc("sandra_llm_tokens_total", completion.prompt_tokens, tier=tier, type="prompt")
+        metrics.inc("sandra_llm_tokens_total", completion.completion_tokens, tier=tier, type="completion")
+
+    def report(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for klass, tiers in sorted(self.by_class.items()):
+                for tier, row in sorted(tiers.items()):
+                    avg = row["latency"] / row["calls"] if row["calls"] else 0.0
+                    lines.append(
+                        f"{klass} / {tier}: {row['calls']} call(s), "
+                        f"{row['prompt_tokens']} prompt + {row['completion_tokens']} completion tokens, "
+                        f"avg {avg:.2f}s"
+                    )
+        return lines
+
+
+usage_stats = UsageStats()
+
+
+def _run_sync(coro):
+    """
+    Run a coroutine on the shared background event loop and wait for it.
+    One long-lived loop keeps the async client, the semaphore and request
+    coalescing shared by every thread that calls the sync wrappers.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+
 # ====== 1. Incoming email butler ======
 
 MASTER_INSTRUCTION = """
@@ -59,6 +358,30 @@ DRAFT REPLY:
 """.strip()
 
 
+CLASSIFY_INSTRUCTION = """
+Classify the email into EXACTLY ONE of:
+URGENT
+IMPORTANT
+INFO ONLY
+SPAM / MARKETING
+
+Reply with the class only.
+""".strip()
+
+# Longest names first so "SPAM" is not mistaken for anything shorter
+_CLASS_NAMES = ("SPAM / MARKETING", "INFO ONLY", "IMPORTANT", "URGENT")
+
+
+def parse_class(content: str) -> str | None:
+    text = content.upper()
+    for klass in _CLASS_NAMES:
+        if klass in text:
+            return klass
+    if "SPAM" in text or "MARKETING" in text:
+        return "SPAM / MARKETING"
+    return None
+
+
 def build_user_prompt(subject: str, sender: str, body: str) -> str:
     return f"""Here is the email:
 
@@ -70,19 +393,7 @@ BODY:
 """
 
 
-def call_email_butler(subject: str, sender: str, body: str) -> ButlerResult:
-    user_prompt = build_user_prompt(subject, sender, body)
-
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": MASTER_INSTRUCTION},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.4,
-    )
-
-    content = resp.choices[0].message.content or ""
+def parse_butler_response(content: str) -> ButlerResult:
     klass = ""
     summary = ""
     draft = ""
@@ -115,6 +426,76 @@ def call_email_butler(subject: str, sender: str, body: str) -> ButlerResult:
     )
 
 
+async def call_email_butler_async(
+    subject: str, sender: str, body: str, use_cache: bool = True, tiered: bool = BUTLER_TIERED
+) -> ButlerResult:
+    """
+    Classify, summarize and draft a reply for one email.
+
+    Results are served from butler_cache when the same prompt was answered
+    before, unless use_cache is False or the sender is opted out in config.
+
+    With tiered=True a short classification call runs first; classes outside
+    REPLY_WORTHY_CLASSES return with an empty summary and draft_reply and
+    never pay for the full generation. The class is cached on its own, under
+    the classify prompt's key, and checked against the current
+    REPLY_WORTHY_CLASSES on every hit. Before any call, the local
+    pre-classifier may answer confidently on its own. Classes the LLM assigns
+    are recorded as training labels for it.
+    """
+    user_prompt = build_user_prompt(subject, sender, body)
+
+    cacheable = use_cache and not is_cache_opt_out(sender)
+    key = cache_key(MODEL, MASTER_INSTRUCTION, BUTLER_TEMPERATURE, user_prompt)
+    if cacheable:
+        cached = butler_cache.get(key)
+        if cached is not None:
+            return ButlerResult(**cached)
+
+    start = time.perf_counter()
+    klass = preclassifier.confident_skip(subject, sender, body)
+    if klass is not None:
+        usage_stats.record(klass, "local", Completion("", 0, 0, time.perf_counter() - start))
+        return ButlerResult(klass=klass, summary="", draft_reply="")
+
+    if tiered:
+        classify_prompt = build_user_prompt(
+            subject, sender, cap_tokens(body or "", CLASSIFY_BODY_TOKEN_BUDGET)
+        )
+        classify_key = cache_key(MODEL, CLASSIFY_INSTRUCTION, 0.0, classify_prompt)
+        cached = butler_cache.get(classify_key) if cacheable else None
+        if cached is not None:
+            klass = cached["klass"]
+        else:
+            classified = await complete_with_usage_async(
+                CLASSIFY_INSTRUCTION, classify_prompt, 0.0, max_tokens=CLASSIFY_MAX_TOKENS
+            )
+            klass = parse_class(classified.content)
+            usage_stats.record(klass or "UNKNOWN", "classify", classified)
+            if cacheable and klass is not None:
+                butler_cache.put(classify_key, {"klass": klass})
+                if klass not in REPLY_WORTHY_CLASSES:
+                    preclassifier.labels.record(subject, sender, body, klass)
+        # Unknown labels fall through to the full call rather than drop mail
+        if klass is not None and klass not in REPLY_WORTHY_CLASSES:
+            return ButlerResult(klass=klass, summary="", draft_reply="")
+
+    completion = await complete_with_usage_async(MASTER_INSTRUCTION, user_prompt, BUTLER_TEMPERATURE)
+
+    result = parse_butler_response(completion.content)
+    usage_stats.record(result.klass, "draft", completion)
+    if cacheable:
+        butler_cache.put(key, asdict(result))
+        preclassifier.labels.record(subject, sender, body, result.klass)
+    return result
+
+
+def call_email_butler(
+    subject: str, sender: str, body: str, use_cache: bool = True, tiered: bool = BUTLER_TIERED
+) -> ButlerResult:
+    return _run_sync(call_email_butler_async(subject, sender, body, use_cache, tiered))
+
+
 # ====== 2. User-initiated email composer (mood-aware) ======
 
 EMAIL_COMPOSER_INSTRUCTION = """
@@ -304,31 +685,7 @@ def format_email_body(body: str) -> str:
 
 
 
-def compose_email_from_context(
-    context: str,
-    relationship: str,
-    mood: str,
-    recipient_email: str | None = None,
-    sender_name: str | None = None,
-) -> EmailComposerResult:
-    user_prompt = build_composer_prompt(
-        context=context,
-        relationship=relationship,
-        mood=mood,
-        recipient_email=recipient_email,
-        sender_name=sender_name,
-    )
-
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": EMAIL_COMPOSER_INSTRUCTION},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.6,
-    )
-
-    content = resp.choices[0].message.content or ""
+def parse_composer_response(content: str, sender_name: str | None = None) -> EmailComposerResult:
     klass = ""
     summary = ""
     subject = ""
@@ -374,3 +731,148 @@ def compose_email_from_context(
         body=body.strip(),
     )
 
+
+async def compose_email_from_context_async(
+    context: str,
+    relationship: str,
+    mood: str,
+    recipient_email: str | None = None,
+    sender_name: str | None = None,
+) -> EmailComposerResult:
+    user_prompt = build_composer_prompt(
+        context=context,
+        relationship=relationship,
+        mood=mood,
+        recipient_email=recipient_email,
+        sender_name=sender_name,
+    )
+
+    content = await complete_async(EMAIL_COMPOSER_INSTRUCTION, user_prompt, COMPOSER_TEMPERATURE)
+    return parse_composer_response(content, sender_name)
+
+
+def compose_email_from_context(
+    context: str,
+    relationship: str,
+    mood: str,
+    recipient_email: str | None = None,
+    sender_name: str | None = None,
+) -> EmailComposerResult:
+    return _run_sync(compose_email_from_context_async(
+        context=context,
+        relationship=relationship,
+        mood=mood,
+        recipient_email=recipient_email,
+        sender_name=sender_name,
+    ))
+
+
+class ComposerStreamParser:
+    """
+    Incremental CLASS / SUMMARY / SUBJECT / BODY parser for streamed tokens.
+
+    Subject and body text is passed to on_text(section, text) as soon as it
+    can no longer turn out to be a section header. The full text is kept so
+    the final result is parsed exactly like a non-streamed completion.
+    """
+
+    HEADERS = {"CLASS:": "class", "SUMMARY:": "summary", "SUBJECT:": "subject", "BODY:": "body"}
+    VISIBLE = ("subject", "body")
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.section = None
+        self.content = ""
+        self._line = ""
+        self._emitted = 0
+
+    def _could_be_header(self, text: str) -> bool:
+        text = text.strip()
+        return any(h.startswith(text) or text.startswith(h) for h in self.HEADERS)
+
+    def _emit(self, text: str):
+        if text and self.section in self.VISIBLE:
+            self.on_text(self.section, text)
+
+    def feed(self, chunk: str):
+        self.content += chunk
+        self._consume(chunk)
+
+    def _consume(self, chunk: str):
+        self._line += chunk
+
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            stripped = line.strip()
+            header = next((h for h in self.HEADERS if stripped.startswith(h)), None)
+            if header and self._emitted == 0:
+                self.section = self.HEADERS[header]
+            else:
+                self._emit(line[self._emitted:] + "\n")
+            self._emitted = 0
+
+        if self._line and (self._emitted or not self._could_be_header(self._line)):
+            self._emit(self._line[self._emitted:])
+            self._emitted = len(self._line)
+
+    def close(self):
+        if self._line:
+            self._consume("\n")
+
+
+def compose_email_streaming(
+    context: str,
+    relationship: str,
+    mood: str,
+    recipient_email: str | None = None,
+    sender_name: str | None = None,
+    on_text=None,
+) -> tuple[EmailComposerResult, StreamTiming]:
+    """
+    Like compose_email_from_context, but streams the completion and calls
+    on_text(section, text) for subject and body text as it arrives.
+    format_email_body is applied to the final result once the stream ends.
+    """
+    user_prompt = build_composer_prompt(
+        context=context,
+        relationship=relationship,
+        mood=mood,
+        recipient_email=recipient_email,
+        sender_name=sender_name,
+    )
+
+    start = time.perf_counter()
+    first_text = None
+
+    def _on_text(section, text):
+        nonlocal first_text
+        if first_text is None:
+            first_text = time.perf_counter() - start
+        if on_text:
+            on_text(section, text)
+
+    parser = ComposerStreamParser(_on_text)
+
+    def open_stream():
+        ratelimit.acquire_openai_sync(
+            estimate_tokens(EMAIL_COMPOSER_INSTRUCTION) + estimate_tokens(user_prompt) + COMPLETION_TOKEN_ESTIMATE
+        )
+        return _sync_client().chat.completions.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": EMAIL_COMPOSER_INSTRUCTION},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=COMPOSER_TEMPERATURE,
+            stream=True,
+        )
+
+    # Only opening the stream is retried; text already shown can't be taken back
+    stream = ratelimit.call_with_retry(open_stream, "chat.completions", transient=_transient_errors())
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parser.feed(chunk.choices[0].delta.content)
+    parser.close()
+
+    result = parse_composer_response(parser.content, sender_name)
+    return result, StreamTiming(first_text=first_text, total=time.perf_counter() - start)
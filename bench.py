@@ -0,0 +1,1246 @@
+"""
+Offline benchmarks against the fakes in fakes.py.
+
+Run with:  python bench.py              # everything
+           python bench.py startup      # only bench_startup (and so on)
+           python bench.py harness --update-baseline   # re-record bench_baseline.json
+"""
+import json
+import math
+import os
+import random
+import re
+import tempfile
+import time
+
+from fakes import BUTLER_REPLY, COMPOSER_REPLY, FakeAsyncChatClient, FakeChatClient, FakeGmailService, MockOpenAIServer, make_corpus, make_message
+import ratelimit
+import reply_guard
+from rules import metadata_skip_reason
+from gmail_client import (
+    FetchStats,
+    LabelMutationQueue,
+    get_message_detail,
+    get_message_details_batch,
+    get_messages_two_phase,
+    iter_unread_message_ids,
+    list_unread_messages,
+    mark_as_read,
+    sync_unread_messages,
+)
+
+# The fakes enforce no quota unless asked to, so client-side budgets would
+# only hide the call patterns being measured; bench_rate_limit sets its own.
+ratelimit.gmail_quota = ratelimit.TokenBucket(1e9)
+ratelimit.openai_requests = ratelimit.TokenBucket(1e9)
+ratelimit.openai_tokens = ratelimit.TokenBucket(1e9)
+
+
+def _corpus(n: int):
+    return [
+        make_message(f"m{i}", f"Subject {i}", f"Person {i} <p{i}@example.com>", f"Body {i}")
+        for i in range(n)
+    ]
+
+
+def bench_fetch(n: int = 250):
+    """Compare per-message get() against batched fetching."""
+    ids = [f"m{i}" for i in range(n)]
+
+    service = FakeGmailService(_corpus(n))
+    start = time.perf_counter()
+    for msg_id in ids:
+        get_message_detail(service, msg_id)
+    single_time = time.perf_counter() - start
+    single_trips = service.round_trips
+
+    service = FakeGmailService(_corpus(n))
+    start = time.perf_counter()
+    fetched = get_message_details_batch(service, ids)
+    batch_time = time.perf_counter() - start
+    batch_trips = service.round_trips
+
+    assert [msg_id for msg_id, _, _ in fetched] == ids
+    assert batch_trips == math.ceil(n / 100)
+
+    print(f"fetch n={n}")
+    print(f"  one-by-one: {single_trips} round trips, {single_time * 1000:.1f} ms")
+    print(f"  batched:    {batch_trips} round trips, {batch_time * 1000:.1f} ms")
+
+
+def bench_mark_read(n: int = 2500):
+    """Compare per-message modify() against a batchModify queue."""
+    ids = [f"m{i}" for i in range(n)]
+
+    service = FakeGmailService(_corpus(n))
+    start = time.perf_counter()
+    for msg_id in ids:
+        mark_as_read(service, msg_id)
+    single_time = time.perf_counter() - start
+    single_trips = service.round_trips
+
+    service = FakeGmailService(_corpus(n))
+    # What the pipeline records in state; only ids whose change was written may appear
+    recorded = []
+
+    def record(written):
+        assert all("UNREAD" not in service.messages[i]["labelIds"] for i in written)
+        recorded.extend(written)
+
+    start = time.perf_counter()
+    with LabelMutationQueue(service, max_age=float("inf")) as labels:
+        for msg_id in ids:
+            labels.mark_read(msg_id, on_written=record)
+    batch_time = time.perf_counter() - start
+    batch_trips = service.round_trips
+
+    assert all("UNREAD" not in m["labelIds"] for m in service.messages.values())
+    assert batch_trips == math.ceil(n / 1000)
+    assert recorded == ids
+
+    # A message deleted after it was queued is dropped; the rest of its chunk is still written
+    service = FakeGmailService(_corpus(n))
+    recorded = []
+    del service.messages["m7"]
+    with LabelMutationQueue(service, max_age=float("inf")) as labels:
+        for msg_id in ids:
+            labels.mark_read(msg_id, on_written=recorded.extend)
+    assert len(labels) == 0 and sorted(recorded) == sorted(i for i in ids if i != "m7")
+    isolate_trips = service.round_trips
+
+    print(f"mark read n={n}")
+    print(f"  one-by-one: {single_trips} round trips, {single_time * 1000:.1f} ms")
+    print(f"  queued:     {batch_trips} round trips, {batch_time * 1000:.1f} ms")
+    print(f"  one deleted id isolated in {isolate_trips} round trips")
+
+
+def bench_sync(inbox_size: int = 5000, polls: int = 100):
+    """Compare re-listing the inbox against History API sync on idle polls."""
+    service = FakeGmailService(_corpus(inbox_size))
+    for _ in range(polls):
+        list_unread_messages(service, max_results=10)
+    list_trips = service.round_trips
+
+    service = FakeGmailService(_corpus(inbox_size))
+    # The first sync returns every unread message, not just its first page
+    first, history_id = sync_unread_messages(service, None, max_results=100)
+    assert len(first) == inbox_size
+    service.round_trips = 0
+    for _ in range(polls):
+        new, history_id = sync_unread_messages(service, history_id)
+        assert not new
+
+    service.deliver(make_message("new", "Hello", "a@example.com", "Are you free?"))
+    new, history_id = sync_unread_messages(service, history_id)
+    assert [m["id"] for m in new] == ["new"]
+
+    # Gmail quota units: messages.list = 5, history.list = 2
+    history_trips = service.round_trips - 1
+    print(f"idle polls={polls} inbox={inbox_size}")
+    print(f"  re-list:  {list_trips} x messages.list  = {list_trips * 5} quota units")
+    print(f"  history:  {history_trips} x history.list = {history_trips * 2} quota units")
+
+
+def bench_backlog(n: int = 5000, page_size: int = 100):
+    """Stream a large unread backlog page by page, resuming once mid-way."""
+    service = FakeGmailService(_corpus(n))
+    seen = 0
+    cursor = None
+    start = time.perf_counter()
+
+    # First run "crashes" after three pages
+    for page, (ids, cursor) in enumerate(iter_unread_message_ids(service, page_size=page_size)):
+        seen += len(ids)
+        if page == 2:
+            break
+
+    for ids, cursor in iter_unread_message_ids(service, page_size=page_size, page_token=cursor):
+        seen += len(ids)
+    elapsed = time.perf_counter() - start
+
+    assert seen == n
+    print(f"backlog n={n} page_size={page_size}")
+    print(f"  {service.round_trips} list calls across one resume, {elapsed * 1000:.1f} ms")
+
+
+def bench_two_phase(n: int = 200):
+    """Full fetch of everything vs metadata-first fetch on newsletter-heavy mail."""
+    html = "<html>" + "<p>Big sale on everything!</p>" * 2000 + "</html>"
+    corpus = []
+    for i in range(n):
+        if i % 4 == 0:
+            corpus.append(make_message(f"m{i}", "Quick question", f"p{i}@example.com", "Can we meet?"))
+        elif i % 4 == 1:
+            corpus.append(make_message(f"m{i}", "Receipt", "no-reply@shop.example", html))
+        else:
+            corpus.append(make_message(
+                f"m{i}", "Weekly deals", "news@shop.example", html,
+                {"List-Unsubscribe": "<mailto:unsub@shop.example>"},
+            ))
+    ids = [m["id"] for m in corpus]
+
+    full_bytes = sum(
+        len(json.dumps(msg, separators=(",", ":")))
+        for _, msg, _ in get_message_details_batch(FakeGmailService(corpus), ids)
+    )
+
+    stats = FetchStats()
+    results = get_messages_two_phase(FakeGmailService(corpus), ids, metadata_skip_reason, stats)
+    assert sum(1 for r in results if r[3] is None) == n // 4
+
+    print(f"two-phase fetch n={n}")
+    print(f"  full only: {full_bytes} bytes")
+    print(f"  two-phase: {stats}")
+
+
+def _use_temp_state(tmp: str):
+    import state
+
+    state.STATE_FILE = os.path.join(tmp, "missing.json")
+    state.STATE_DB = os.path.join(tmp, "state.db")
+    state._conn = None
+
+
+def bench_state(history: int = 20000, writes: int = 200):
+    """Rewrite-the-JSON-file per message vs one SQLite row per message."""
+    import state
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.json")
+        ids = [f"old{i}" for i in range(history)]
+        start = time.perf_counter()
+        for i in range(writes):
+            ids.append(f"new{i}")
+            with open(path, "w") as f:
+                json.dump({"processed_ids": ids}, f, indent=2)
+        json_time = time.perf_counter() - start
+
+        _use_temp_state(tmp)
+        state.record_progress([f"old{i}" for i in range(history)])
+        start = time.perf_counter()
+        for i in range(writes):
+            state.record_progress([f"new{i}"])
+        db_time = time.perf_counter() - start
+        state._conn.close()
+        state._conn = None
+
+    print(f"state writes={writes} history={history}")
+    print(f"  json rewrite: {json_time / writes * 1000:.2f} ms per message")
+    print(f"  sqlite:       {db_time / writes * 1000:.2f} ms per message")
+
+
+def _legacy_should_generate_reply(subject: str, body: str) -> bool:
+    """The original per-pattern guard, kept as the reference for bench_guards."""
+    rg = reply_guard
+    norm_subject = (subject or "").strip().lower()
+    norm = (body or "").strip().lower()
+    if not norm:
+        return False
+    if "out of office" in norm_subject or "automatic reply" in norm_subject:
+        return False
+    if "out of office" in norm or "auto-reply" in norm or "automatic reply" in norm:
+        return False
+    if any(re.search(p, norm) for p in rg.SYSTEM_PATTERNS):
+        return False
+    if len(norm) <= 80 and any(re.match(p, norm) for p in rg.CLOSING_PATTERNS):
+        return False
+    if ("thanks" in norm or "thank you" in norm) and len(norm.split()) <= 6:
+        return False
+    if any(re.search(p, norm) for p in rg.DEFER_PATTERNS):
+        return False
+    if "?" not in norm and any(p in norm for p in rg.CLOSURE_PHRASES):
+        return False
+    return True
+
+
+def _guard_corpus(n: int, seed: int = 7):
+    rng = random.Random(seed)
+    filler = (
+        "we reviewed the proposal and the numbers look reasonable overall "
+        "although the timeline for the second phase seems tight"
+    ).split()
+    snippets = [
+        "Thanks!", "ok", "Got it.", "Thank you so much", "thanks for the update",
+        "I'll get back to you tomorrow.", "Let me check and get back to you",
+        "This is an automated message.", "Click here to unsubscribe",
+        "Feel free to reach out whenever you are ready.",
+        "Can you send the report by Friday?", "Out of office until Monday",
+        "", "   ", "What time works for you?",
+    ]
+    corpus = []
+    for _ in range(n):
+        words = rng.choices(filler, k=rng.randint(0, 400))
+        pos = rng.randint(0, len(words))
+        words[pos:pos] = [rng.choice(snippets)]
+        subject = rng.choice(["Hello", "Re: proposal", "Automatic reply: away", "Update"])
+        corpus.append((subject, " ".join(words) if rng.random() > 0.3 else rng.choice(snippets)))
+    return corpus
+
+
+def bench_guards(n: int = 20000):
+    """Compiled single-pass guards vs the original pattern loops."""
+    corpus = _guard_corpus(n)
+
+    start = time.perf_counter()
+    legacy = [_legacy_should_generate_reply(s, b) for s, b in corpus]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [reply_guard.should_generate_reply(s, b) for s, b in corpus]
+    compiled_time = time.perf_counter() - start
+
+    assert legacy == compiled
+
+    print(f"guards n={n} (decisions identical)")
+    print(f"  original: {legacy_time / n * 1e6:.1f} us per email")
+    print(f"  compiled: {compiled_time / n * 1e6:.1f} us per email ({legacy_time / compiled_time:.1f}x)")
+
+
+def bench_llm_cache(n: int = 500, distinct: int = 50):
+    """Repeated mailings answered from the response cache instead of the API."""
+    import agent_sandra
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fake = FakeAsyncChatClient(latency=0.002)
+        agent_sandra.async_client = fake
+        agent_sandra.butler_cache = agent_sandra.ResponseCache(
+            os.path.join(tmp, "cache.db"), ttl=3600, max_entries=1000
+        )
+        agent_sandra.preclassifier.labels = agent_sandra.preclassifier.LabelStore(
+            os.path.join(tmp, "labels.db")
+        )
+
+        start = time.perf_counter()
+        for i in range(n):
+            k = i % distinct
+            agent_sandra.call_email_butler(
+                f"Offer {k}", "list@example.com", f"Body {k}\n\nthanks", tiered=False
+            )
+        elapsed = time.perf_counter() - start
+        stats = agent_sandra.butler_cache.stats()
+
+        # Tiered mode: mail classified as not reply-worthy is cached from the classify call alone
+        tiered_fake = FakeAsyncChatClient(lambda messages: "SPAM / MARKETING", latency=0.002)
+        agent_sandra.async_client = tiered_fake
+        agent_sandra.butler_cache = agent_sandra.ResponseCache(
+            os.path.join(tmp, "tiered.db"), ttl=3600, max_entries=1000
+        )
+        for i in range(n):
+            k = i % distinct
+            result = agent_sandra.call_email_butler(
+                f"Offer {k}", "list@example.com", f"Body {k}\n\nthanks", tiered=True
+            )
+            assert not result.draft_reply
+        tiered_stats = agent_sandra.butler_cache.stats()
+
+        # Cached classes are checked against the current config: once marketing is reply-worthy, it gets drafts
+        agent_sandra.async_client = FakeAsyncChatClient(
+            lambda messages: BUTLER_REPLY.replace("IMPORTANT", "SPAM / MARKETING")
+        )
+        worthy, agent_sandra.REPLY_WORTHY_CLASSES = (
+            agent_sandra.REPLY_WORTHY_CLASSES, agent_sandra.REPLY_WORTHY_CLASSES | {"SPAM / MARKETING"}
+        )
+        try:
+            result = agent_sandra.call_email_butler("Offer 0", "list@example.com", "Body 0\n\nthanks", tiered=True)
+        finally:
+            agent_sandra.REPLY_WORTHY_CLASSES = worthy
+        assert result.draft_reply and agent_sandra.async_client.calls == 1
+
+    assert fake.calls == distinct
+    assert tiered_fake.calls == distinct
+    print(f"llm cache n={n} distinct={distinct}")
+    print(f"  {fake.calls} API calls, {stats['hits']} hits ({stats['hit_rate']:.0%}), {elapsed * 1000:.0f} ms")
+    print(f"  tiered, classify-only: {tiered_fake.calls} API calls, {tiered_stats['hits']} hits"
+          f" ({tiered_stats['hit_rate']:.0%})")
+
+
+def bench_pipeline(n: int = 40, gmail_latency: float = 0.01, llm_latency: float = 0.2):
+    """Sequential processing vs the staged pipeline, with injected latency."""
+    import agent_sandra
+    from pipeline import ServicePool, process_messages
+
+    corpus = [
+        make_message(f"m{i}", f"Question {i}", f"p{i}@example.com", f"Could you review item {i}?")
+        for i in range(n)
+    ]
+    ids = [m["id"] for m in corpus]
+
+    def run(llm_workers, write_workers):
+        with tempfile.TemporaryDirectory() as tmp:
+            _use_temp_state(tmp)
+            service = FakeGmailService([dict(m) for m in corpus], latency=gmail_latency)
+            agent_sandra.async_client = FakeAsyncChatClient(latency=llm_latency)
+            committed = []
+            start = time.perf_counter()
+            with LabelMutationQueue(service) as labels:
+                process_messages(
+                    ServicePool(lambda: service), labels, ids,
+                    lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False),
+                    report=lambda item: committed.append(item.msg_id),
+                    llm_workers=llm_workers, write_workers=write_workers,
+                )
+            elapsed = time.perf_counter() - start
+            import state
+            state._conn.close()
+            state._conn = None
+        assert committed == ids
+        assert len(service.drafts) == n
+        return elapsed
+
+    sequential = run(1, 1)
+    staged = run(16, 4)
+
+    # A commit that raises fails its own item only; the rest still commit and every stage thread exits
+    import threading
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_temp_state(tmp)
+        service = FakeGmailService([dict(m) for m in corpus])
+        agent_sandra.async_client = FakeAsyncChatClient()
+        reported = []
+
+        def report(item):
+            reported.append((item.msg_id, item.error is not None))
+            if item.msg_id == "m3" and item.error is None:
+                raise RuntimeError("report failed")
+
+        with LabelMutationQueue(service) as labels:
+            failed = process_messages(
+                ServicePool(lambda: service), labels, ids,
+                lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False), report=report,
+            )
+        import state
+        state._conn.close()
+        state._conn = None
+    assert [msg_id for msg_id, error in reported if not error] == ids
+    assert failed == ["m3"] and ("m3", True) in reported
+    assert not [t for t in threading.enumerate() if t.name.startswith("pipeline-")]
+
+    print(f"pipeline n={n} gmail={gmail_latency * 1000:.0f}ms llm={llm_latency * 1000:.0f}ms")
+    print(f"  1 LLM / 1 write worker:  {n / sequential:.1f} emails/s")
+    print(f"  16 LLM / 4 write workers: {n / staged:.1f} emails/s ({sequential / staged:.1f}x)")
+
+
+def bench_tiered(n: int = 200, reply_worthy: float = 0.2):
+    """Total tokens for one-shot vs classify-then-draft on a marketing-heavy inbox."""
+    import agent_sandra
+
+    def reply(messages):
+        prompt = messages[-1]["content"]
+        if messages[0]["content"] == agent_sandra.CLASSIFY_INSTRUCTION:
+            return "IMPORTANT" if "Question" in prompt else "SPAM / MARKETING"
+        if "Question" in prompt:
+            return BUTLER_REPLY
+        return BUTLER_REPLY.replace("IMPORTANT", "SPAM / MARKETING")
+
+    worthy = int(n * reply_worthy)
+    jobs = [
+        (f"Question {i}", f"p{i}@example.com", f"Could you review item {i}?")
+        if i < worthy else
+        (f"Sale {i}", "deals@shop.example", f"Big savings on item {i}. " * 40)
+        for i in range(n)
+    ]
+
+    totals = {}
+    for tiered in (False, True):
+        agent_sandra.async_client = FakeAsyncChatClient(reply)
+        agent_sandra.usage_stats = agent_sandra.UsageStats()
+        drafts = sum(
+            1 for s, f, b in jobs
+            if agent_sandra.call_email_butler(s, f, b, use_cache=False, tiered=tiered).draft_reply
+        )
+        tokens = sum(
+            row["prompt_tokens"] + row["completion_tokens"]
+            for tiers in agent_sandra.usage_stats.by_class.values()
+            for row in tiers.values()
+        )
+        totals[tiered] = (tokens, drafts, agent_sandra.usage_stats.report())
+
+    # One-shot drafts a reply for every email; tiered only for reply-worthy ones
+    assert totals[False][1] == n and totals[True][1] == worthy
+    print(f"tiered butler n={n} reply-worthy={reply_worthy:.0%}")
+    print(f"  one-shot: {totals[False][0]} tokens")
+    print(f"  tiered:   {totals[True][0]} tokens ({1 - totals[True][0] / totals[False][0]:.0%} saved)")
+    for line in totals[True][2]:
+        print(f"    {line}")
+
+
+def bench_preclassifier(n: int = 3000, seed: int = 11):
+    """Held-out accuracy, LLM calls avoided and predict cost of the local pre-classifier."""
+    import random
+
+    import preclassifier
+
+    rng = random.Random(seed)
+    shops = ["deals@shop.example", "news@brand.example", "offers@travel.example"]
+    notifiers = ["notifications@github.com", "alerts@bank.example", "updates@calendar.example"]
+    people = [f"{name}@example.com" for name in ("alex", "sam", "jo", "kim", "lee")]
+    templates = {
+        "SPAM / MARKETING": (shops, "{pct}% off everything this weekend",
+                             "Huge sale on {item}. Shop now and save {pct}%. Unsubscribe any time."),
+        "INFO ONLY": (notifiers, "Your {item} statement is ready",
+                      "This is an automated notification about your {item}. No action is required."),
+        "IMPORTANT": (people, "Question about the {item}",
+                      "Hi, could you take a look at the {item} and tell me what you think by Friday?"),
+        "URGENT": (people, "Need the {item} today",
+                   "Hi, the client is waiting on the {item}. Can you send it over in the next hour?"),
+    }
+    weights = {"SPAM / MARKETING": 0.5, "INFO ONLY": 0.3, "IMPORTANT": 0.15, "URGENT": 0.05}
+    items = ["contract", "invoice", "slides", "report", "account", "order", "budget", "roadmap"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = preclassifier.LabelStore(os.path.join(tmp, "labels.db"))
+        for i in range(n):
+            klass = rng.choices(list(weights), list(weights.values()))[0]
+            senders, subject, body = templates[klass]
+            fill = {"item": rng.choice(items), "pct": rng.choice([10, 20, 30, 50])}
+            store.record(subject.format(**fill), rng.choice(senders), f"{body.format(**fill)} ref {i}", klass)
+        rows = store.examples()
+
+    report = preclassifier.evaluate(rows, holdout=0.2)
+    assert report["missed"] == 0
+    print(f"preclassifier n={n} (train {report['train']}, test {report['test']})")
+    print(f"  accuracy {report['accuracy']:.1%}, {report['coverage']:.0%} of mail answered locally,"
+          f" {report['missed']} reply-worthy skipped, {report['us_per_email']:.0f} us per email")
+
+
+def bench_threads(n_threads: int = 20, replies: int = 4):
+    """LLM calls and drafts per poll when several unread replies share a thread."""
+    import agent_sandra
+    from pipeline import ServicePool, process_messages
+
+    corpus = []
+    for t in range(n_threads):
+        opener = make_message(f"t{t}-0", f"Plan {t}", "me@example.com", f"Here is plan {t}.", thread_id=f"t{t}")
+        opener["labelIds"] = ["INBOX"]
+        corpus.append(opener)
+        corpus += [
+            make_message(f"t{t}-{r}", f"Re: Plan {t}", f"p{r}@example.com", f"Reply {r} on plan {t}: looks good?",
+                         thread_id=f"t{t}")
+            for r in range(1, replies + 1)
+        ]
+    unread = [m for m in corpus if "UNREAD" in m["labelIds"]]
+    ids = [m["id"] for m in unread]
+
+    def run(threads):
+        with tempfile.TemporaryDirectory() as tmp:
+            _use_temp_state(tmp)
+            service = FakeGmailService([dict(m, labelIds=list(m["labelIds"])) for m in corpus])
+            fake = FakeAsyncChatClient()
+            agent_sandra.async_client = fake
+            with LabelMutationQueue(service) as labels:
+                failed = process_messages(
+                    ServicePool(lambda: service), labels, ids,
+                    lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False, tiered=False),
+                    threads=threads,
+                )
+            import state
+            state._conn.close()
+            state._conn = None
+        assert not failed
+        assert not any("UNREAD" in service.messages[i]["labelIds"] for i in ids)
+        return fake.calls, len(service.drafts), service.round_trips
+
+    per_message = run(None)
+    per_thread = run({m["id"]: m["threadId"] for m in unread})
+    assert per_thread[1] == n_threads
+
+    # A closing "Thanks!" after a question: the question still gets the reply
+    thread = [
+        make_message("a1", "Contract", "p1@example.com", "Can you send me the signed contract by Friday?",
+                     thread_id="ack"),
+        make_message("a2", "Re: Contract", "p1@example.com", "Thanks!", thread_id="ack"),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_temp_state(tmp)
+        service = FakeGmailService(thread)
+        agent_sandra.async_client = FakeAsyncChatClient()
+        committed = []
+        with LabelMutationQueue(service) as labels:
+            process_messages(
+                ServicePool(lambda: service), labels, ["a1", "a2"],
+                lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False, tiered=False),
+                report=committed.append, threads={"a1": "ack", "a2": "ack"},
+            )
+        import state
+        state._conn.close()
+        state._conn = None
+    assert [(i.msg_id, i.outcome, i.coalesced) for i in committed] == [("a1", "draft", ["a2"])]
+    assert len(service.drafts) == 1
+    print(f"threads={n_threads} unread replies per thread={replies}")
+    print(f"  per message: {per_message[0]} LLM calls, {per_message[1]} drafts, {per_message[2]} Gmail round trips")
+    print(f"  per thread:  {per_thread[0]} LLM calls, {per_thread[1]} drafts, {per_thread[2]} Gmail round trips")
+    print("  question followed by \"Thanks!\": the question is answered")
+
+
+def bench_rate_limit(n: int = 300, server_quota: int = 500):
+    """Gmail batch fetch against a fake that enforces a per-second quota, with and without the client bucket."""
+    import ratelimit
+    from gmail_client import get_message_details_batch, list_unread_messages
+
+    corpus = _corpus(n)
+    ids = [m["id"] for m in corpus]
+
+    def run(client_rate):
+        service = FakeGmailService(corpus, quota_per_second=server_quota)
+        ratelimit.gmail_quota = ratelimit.TokenBucket(client_rate)
+        ratelimit.retries.clear()
+        start = time.perf_counter()
+        results = get_message_details_batch(service, ids, format="metadata")
+        elapsed = time.perf_counter() - start
+        assert all(error is None for _, _, error in results)
+        return elapsed, service.throttled, sum(ratelimit.retries.values())
+
+    unlimited = ratelimit.gmail_quota
+    try:
+        unthrottled = run(server_quota * 10)
+        # A little headroom absorbs clock skew between our bucket and Gmail's window
+        bucketed = run(server_quota * 0.9)
+    finally:
+        ratelimit.gmail_quota = unlimited
+
+    # Transient 5xx on a single call is retried instead of losing the cycle
+    service = FakeGmailService(corpus)
+    service.fail_next(2, status=503)
+    assert len(list_unread_messages(service, max_results=10)) == 10
+
+    print(f"rate limit n={n} server quota={server_quota} units/s")
+    print(f"  no client budget: {unthrottled[0]:.2f} s, {unthrottled[1]} call(s) got 429, {unthrottled[2]} retried")
+    print(f"  bucket at 90%:    {bucketed[0]:.2f} s, {bucketed[1]} call(s) got 429, {bucketed[2]} retried")
+    print("  two 503s on messages.list: recovered by retry")
+
+
+def bench_service_start(services: int = 4, runs: int = 5):
+    """
+    Time to build the Gmail services watch.py starts with (one plus the
+    pool) in a fresh process: the old per-call token.json read and build()
+    vs shared credentials and the cached discovery document. Needs the real
+    google client libraries; uses a dummy token that never expires.
+    """
+    import subprocess
+    import sys
+
+    token = {
+        "token": "x", "refresh_token": "r", "client_id": "c", "client_secret": "s",
+        "expiry": "2099-01-01T00:00:00Z",
+    }
+    timed = (
+        "import time\nstart = time.perf_counter()\n"
+        "import gmail_client, google.oauth2.credentials, googleapiclient.discovery, google_auth_httplib2\n"
+        "imported = time.perf_counter()\n"
+        "{build}"
+        "print(imported - start, time.perf_counter() - imported)\n"
+    )
+    before = timed.format(build=(
+        "from google.oauth2.credentials import Credentials\n"
+        "from googleapiclient.discovery import build\n"
+        f"for _ in range({services}):\n"
+        "    creds = Credentials.from_authorized_user_file('token.json', gmail_client.SCOPES)\n"
+        "    build('gmail', 'v1', credentials=creds)\n"
+    ))
+    after = timed.format(build=f"for _ in range({services}): gmail_client.get_gmail_service()\n")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+
+    def cold(code, cwd):
+        runs_ = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True,
+                                 capture_output=True, text=True).stdout
+            runs_.append(tuple(float(x) for x in out.split()))
+        return min(r[0] for r in runs_), min(r[1] for r in runs_)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "token.json"), "w") as f:
+            json.dump(token, f)
+        old = cold(before, tmp)
+        new = cold(after, tmp)
+        assert os.path.exists(os.path.join(tmp, "gmail_discovery.json"))
+
+    print(f"gmail service start, {services} service(s), best of {runs} fresh processes")
+    print(f"  imports:                {old[0] * 1000:.0f} ms")
+    print(f"  token.json + build():   {old[1] * 1000:.1f} ms")
+    print(f"  shared creds + cached:  {new[1] * 1000:.1f} ms ({old[1] / new[1]:.1f}x)")
+
+
+# Cold-start budget for loading every module the CLI subcommands use,
+# measured with -X importtime. bench_startup fails above it.
+STARTUP_IMPORT_BUDGET_MS = 200
+
+# Must not load until the first Gmail / OpenAI call
+LAZY_MODULES = ("openai", "dotenv", "googleapiclient", "google_auth_oauthlib", "google_auth_httplib2", "httplib2")
+
+
+def bench_startup(budget_ms: float = STARTUP_IMPORT_BUDGET_MS, runs: int = 3):
+    """Import cost of sandra and its subcommand modules in a fresh process; fails over budget."""
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = "import sandra, main, watch, agent_sandra, gmail_client, pipeline"
+
+    best, loaded = float("inf"), set()
+    for _ in range(runs):
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=here, check=True, capture_output=True, text=True,
+        ).stderr
+        total, modules = 0, set()
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            modules.add(name.strip().split(".")[0])
+            # Top-level imports are not indented; their cumulative times add up
+            if not name.startswith("  "):
+                total += int(cumulative)
+        best, loaded = min(best, total / 1000), modules
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "sandra.py", "--help"], cwd=here, check=True, capture_output=True)
+    help_time = time.perf_counter() - start
+
+    eager = sorted(m for m in LAZY_MODULES if m in loaded)
+    print(f"startup (best of {runs} fresh processes)")
+    print(f"  imports: {best:.0f} ms (budget {budget_ms:.0f} ms), `sandra.py --help`: {help_time * 1000:.0f} ms")
+    assert not eager, f"imported at startup, should be lazy: {', '.join(eager)}"
+    assert best <= budget_ms, f"startup imports took {best:.0f} ms, over the {budget_ms:.0f} ms budget"
+
+
+def bench_async_llm(n: int = 50, latency: float = 0.2):
+    """Wall time for n butler calls at concurrency 1 vs 16 against a mock server."""
+    import asyncio
+
+    from openai import AsyncOpenAI
+
+    import agent_sandra
+
+    async def run_all(jobs):
+        return await asyncio.gather(*(
+            agent_sandra.call_email_butler_async(s, f, b, use_cache=False, tiered=False) for s, f, b in jobs
+        ))
+
+    distinct = [(f"Question {i}", f"p{i}@example.com", f"Can we talk about {i}?") for i in range(n)]
+
+    with MockOpenAIServer(latency=latency) as server:
+        agent_sandra.async_client = AsyncOpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+        timings = {}
+        for concurrency in (1, 16):
+            agent_sandra.LLM_CONCURRENCY = concurrency
+            agent_sandra._semaphore = None
+            start = time.perf_counter()
+            agent_sandra._run_sync(run_all(distinct))
+            timings[concurrency] = time.perf_counter() - start
+
+        # Identical prompts in flight together collapse into one request
+        before = server.requests
+        agent_sandra._run_sync(run_all([distinct[0]] * 10))
+        coalesced = server.requests - before
+
+    print(f"async llm n={n} latency={latency * 1000:.0f}ms")
+    print(f"  concurrency 1:  {timings[1]:.2f} s")
+    print(f"  concurrency 16: {timings[16]:.2f} s ({timings[1] / timings[16]:.1f}x)")
+    print(f"  10 identical prompts in flight -> {coalesced} request(s)")
+
+
+def bench_streaming(latency: float = 0.3, chunk_latency: float = 0.01):
+    """Time to first visible text: streamed composer vs waiting for the whole reply."""
+    import agent_sandra
+
+    args = ("thank them for the interview", "recruiter", "professional")
+
+    # Without streaming nothing is visible until the call returns the whole reply
+    agent_sandra.async_client = FakeAsyncChatClient(COMPOSER_REPLY, latency=latency, chunk_latency=chunk_latency)
+    start = time.perf_counter()
+    blocked = agent_sandra.compose_email_from_context(*args, sender_name="Pat")
+    blocking = time.perf_counter() - start
+
+    agent_sandra.client = FakeChatClient(COMPOSER_REPLY, latency=latency, chunk_latency=chunk_latency)
+    start = time.perf_counter()
+    result, timing = agent_sandra.compose_email_streaming(*args, sender_name="Pat")
+    streamed_total = time.perf_counter() - start
+
+    assert result.subject == blocked.subject == "Thank you for the interview"
+
+    print(f"composer streaming latency={latency * 1000:.0f}ms")
+    print(f"  blocking:  first text after {blocking:.2f} s")
+    print(f"  streaming: first text after {timing.first_text:.2f} s, complete after {streamed_total:.2f} s")
+
+
+def bench_prompt_trim(n: int = 200):
+    """Estimated prompt tokens before and after body preprocessing on long threads."""
+    from preprocess import estimate_tokens, prepare_body
+
+    quoted = "\n".join(f"> earlier message line {i} about the project plan" for i in range(60))
+    disclaimer = (
+        "CONFIDENTIALITY NOTICE: This email and any attachments are intended solely "
+        "for the use of the addressee. If you have received this email in error, delete it."
+    )
+    bodies = [
+        f"Hi,\n\nCan we confirm item {i} by Friday?\n\nThanks,\nSam\n-- \nSam Lee | Acme\n\n"
+        f"{disclaimer}\n\nOn Tue, Jun {i % 28 + 1}, 2024 at 9:00 AM Alex <alex@example.com> wrote:\n{quoted}"
+        for i in range(n)
+    ]
+
+    start = time.perf_counter()
+    prepared = [prepare_body(b) for b in bodies]
+    elapsed = time.perf_counter() - start
+
+    before = sum(estimate_tokens(b) for b in bodies)
+    after = sum(p.tokens_after for p in prepared)
+    print(f"prompt trim n={n}")
+    print(f"  {before / n:.0f} -> {after / n:.0f} tokens per email ({1 - after / before:.0%} saved),"
+          f" {elapsed / n * 1e6:.0f} us per email")
+
+
+def bench_metrics(n: int = 100, samples: int = 200000):
+    """Per-stage timings from a pipeline run, and what one observation costs."""
+    import agent_sandra
+    import metrics
+    from pipeline import ServicePool, process_messages
+
+    corpus = [
+        make_message(f"m{i}", f"Question {i}", f"p{i}@example.com", f"Could you review item {i}?")
+        for i in range(n)
+    ]
+    metrics.reset()
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_temp_state(tmp)
+        agent_sandra.preclassifier.labels = agent_sandra.preclassifier.LabelStore(
+            os.path.join(tmp, "labels.db")
+        )
+        service = FakeGmailService([dict(m) for m in corpus], latency=0.002)
+        agent_sandra.async_client = FakeAsyncChatClient(latency=0.01)
+        with LabelMutationQueue(service) as labels:
+            process_messages(
+                ServicePool(lambda: service), labels, [m["id"] for m in corpus],
+                lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False, tiered=False),
+            )
+        path = os.path.join(tmp, "metrics.prom")
+        metrics.write_textfile(path)
+        with open(path) as f:
+            text = f.read()
+        import state
+        state._conn.close()
+        state._conn = None
+
+    for stage in ("fetch", "guard", "llm", "write", "commit"):
+        assert f'sandra_stage_seconds_count{{stage="{stage}"}} {n}' in text, stage
+    assert f'sandra_messages_total{{outcome="draft"}} {n}' in text
+    assert 'sandra_llm_tokens_total{tier="draft",type="prompt"}' in text
+
+    start = time.perf_counter()
+    for _ in range(samples):
+        metrics.observe("bench_seconds", 0.001, stage="x")
+    per_observe = (time.perf_counter() - start) / samples
+    start = time.perf_counter()
+    metrics.render()
+    render_ms = (time.perf_counter() - start) * 1000
+    metrics.reset()
+
+    print(f"metrics n={n}")
+    for line in text.splitlines():
+        if line.startswith("sandra_stage_seconds{") and 'quantile="0.95"' in line:
+            print(f"  {line}")
+    print(f"  {per_observe * 1e6:.2f} us per observation, render {render_ms:.1f} ms, {len(text)} bytes exported")
+
+
+# Reference results for bench_harness, checked in next to this file
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+# How far throughput may drop, or peak memory grow, before bench_harness fails
+REGRESSION_TOLERANCE = 0.25
+
+
+def _process_inbox(ids, service, llm, threads=None, use_outbox=False):
+    """
+    Run ids through process_messages against `service` and the async chat
+    client `llm`, with state and labels in a temporary directory. With
+    use_outbox, replies go through an Outbox as in main.main, and the time
+    includes delivering them. Returns (seconds, committed items).
+    """
+    import agent_sandra
+    import state
+    from outbox import Outbox
+    from pipeline import ServicePool, process_messages
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_temp_state(tmp)
+        agent_sandra.preclassifier.labels = agent_sandra.preclassifier.LabelStore(
+            os.path.join(tmp, "labels.db")
+        )
+        agent_sandra.async_client = llm
+        committed = []
+        pool = ServicePool(lambda: service)
+        start = time.perf_counter()
+        outbox = Outbox(os.path.join(tmp, "outbox.db")) if use_outbox else None
+        if outbox:
+            outbox.start(pool)
+        with LabelMutationQueue(service) as labels:
+            failed = process_messages(
+                pool, labels, ids,
+                lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False),
+                report=committed.append, threads=threads, outbox=outbox,
+            )
+        if outbox:
+            assert outbox.flush(timeout=60) and set(outbox.stats()) <= {"done"}, outbox.stats()
+            outbox.close()
+        elapsed = time.perf_counter() - start
+        state._conn.close()
+        state._conn = None
+    assert len(committed) == len(ids)
+    assert not failed, f"{len(failed)} message(s) failed: {[i.error for i in committed if i.error][:3]}"
+    return elapsed, committed
+
+
+def _run_inbox(corpus, gmail_latency, llm_latency, gmail_error_rate, llm_error_rate):
+    """
+    Run corpus through process_messages on fresh fakes the way main.main
+    does, with the thread map and the outbox; returns (seconds, service, llm).
+    """
+    service = FakeGmailService(
+        [json.loads(json.dumps(m)) for m in corpus], latency=gmail_latency, error_rate=gmail_error_rate, seed=1
+    )
+    llm = FakeAsyncChatClient(latency=llm_latency, error_rate=llm_error_rate, seed=2)
+    elapsed, _ = _process_inbox(
+        [m["id"] for m in corpus], service, llm,
+        threads={m["id"]: m["threadId"] for m in corpus}, use_outbox=True,
+    )
+    return elapsed, service, llm
+
+
+def bench_harness(
+    n: int = 200,
+    gmail_latency: float = 0.005,
+    llm_latency: float = 0.02,
+    gmail_error_rate: float = 0.02,
+    llm_error_rate: float = 0.02,
+    update_baseline: bool = False,
+):
+    """
+    End-to-end run of the pipeline main.py and watch.py share, thread map
+    and outbox included, over a mixed MIME corpus with injected latency and
+    retryable errors. Throughput counts until every reply is delivered.
+    Reports emails/s, per-stage latency and peak traced memory, and fails when
+    throughput or memory regress past REGRESSION_TOLERANCE from
+    bench_baseline.json.
+    """
+    import tracemalloc
+
+    import metrics
+
+    corpus = make_corpus(n)
+    # Injected errors carry Retry-After: 0; keep the backoff short too
+    base_delay, ratelimit.RETRY_BASE_DELAY = ratelimit.RETRY_BASE_DELAY, 0.01
+    try:
+        metrics.reset()
+        elapsed, service, llm = _run_inbox(corpus, gmail_latency, llm_latency, gmail_error_rate, llm_error_rate)
+        stages = metrics.timer_stats("sandra_stage_seconds")
+        steps = metrics.timer_stats("sandra_step_seconds")
+
+        # tracemalloc slows allocation-heavy code, so memory gets its own run
+        tracemalloc.start()
+        _run_inbox(corpus, gmail_latency, llm_latency, gmail_error_rate, llm_error_rate)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        ratelimit.RETRY_BASE_DELAY = base_delay
+        metrics.reset()
+
+    result = {"emails_per_second": round(n / elapsed, 1), "peak_mib": round(peak / 2 ** 20, 2)}
+    print(f"harness n={n} gmail={gmail_latency * 1000:.0f}ms/{gmail_error_rate:.0%} errors"
+          f" llm={llm_latency * 1000:.0f}ms/{llm_error_rate:.0%} errors")
+    print(f"  {result['emails_per_second']} emails/s, peak {result['peak_mib']} MiB traced,"
+          f" {service.injected_errors} Gmail + {llm.errors} LLM errors injected,"
+          f" {len(service.drafts)} drafts")
+    for label, row in [*stages.items(), *steps.items()]:
+        print(f"  {label:<20} n={row['count']:<4} p50={row['p50'] * 1000:7.2f}ms  p95={row['p95'] * 1000:7.2f}ms")
+
+    if update_baseline or not os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"harness": result}, f, indent=2)
+            f.write("\n")
+        print(f"  baseline written to {os.path.basename(BASELINE_FILE)}")
+        return
+
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)["harness"]
+    print(f"  baseline: {baseline['emails_per_second']} emails/s, {baseline['peak_mib']} MiB")
+    assert result["emails_per_second"] >= baseline["emails_per_second"] * (1 - REGRESSION_TOLERANCE), (
+        f"throughput regressed: {result['emails_per_second']} < {baseline['emails_per_second']} emails/s"
+    )
+    assert result["peak_mib"] <= baseline["peak_mib"] * (1 + REGRESSION_TOLERANCE), (
+        f"peak memory regressed: {result['peak_mib']} > {baseline['peak_mib']} MiB"
+    )
+
+
+def bench_replay(n: int = 150, gmail_latency: float = 0.01, llm_latency: float = 0.05):
+    """Record a run against the fakes, then replay the capture at 1x, 10x and with no delays."""
+    import replay
+
+    corpus = make_corpus(n)
+    ids = [m["id"] for m in corpus]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "capture.jsonl.gz")
+        recorder = replay.start_recording(path)
+        try:
+            service = replay.wrap_gmail(FakeGmailService(corpus, latency=gmail_latency))
+            llm = replay.wrap_chat(FakeAsyncChatClient(latency=llm_latency))
+            recorded, committed = _process_inbox(ids, service, llm)
+        finally:
+            replay.stop_recording()
+        size = os.path.getsize(path)
+        outcomes = [(item.msg_id, item.outcome) for item in committed]
+
+        runs = []
+        for speed in (1.0, 10.0, 0.0):
+            capture = replay.start_replay(path, speed)
+            try:
+                elapsed, committed = _process_inbox(ids, replay.gmail_service(), replay.chat_client())
+            finally:
+                replay.stop_replay()
+            assert [(item.msg_id, item.outcome) for item in committed] == outcomes
+            assert capture.misses == 0, f"{capture.misses} call(s) missing from the capture"
+            runs.append((speed, elapsed))
+
+    print(f"replay n={n} gmail={gmail_latency * 1000:.0f}ms llm={llm_latency * 1000:.0f}ms")
+    print(f"  recorded: {n / recorded:.1f} emails/s, {recorder.records} calls in {size / 1024:.0f} KiB compressed")
+    for speed, elapsed in runs:
+        label = f"{speed:g}x" if speed else "no delay"
+        print(f"  replay {label:>8}: {n / elapsed:.1f} emails/s (same outcomes)")
+
+
+def _extract_one_level(msg):
+    """extract_email_data's body lookup before mime.py: one level of parts, whole part decoded."""
+    import base64
+
+    payload = msg.get("payload", {})
+    if payload.get("mimeType") == "text/plain":
+        data = payload.get("body", {}).get("data")
+        return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore") if data else ""
+    for part in payload.get("parts", []):
+        if part.get("mimeType") == "text/plain" and part.get("body", {}).get("data"):
+            return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="ignore")
+    return ""
+
+
+def bench_mime(runs: int = 20):
+    """Body extraction from large and deeply nested messages: time, peak memory, body found."""
+    import tracemalloc
+
+    from fakes import make_mime_message
+    from gmail_client import extract_email_data
+
+    paragraph = "Please see the figures below and let me know what you think. " * 8
+    big_body = "\n\n".join([paragraph] * 4000)  # ~2 MB
+    deep = make_mime_message("deep", "Deep", "a@example.com", "Reply inline please.", "nested", 1000)
+    # mixed > mixed > alternative > text/plain, as forwarded mail often nests
+    deep["payload"]["parts"][0] = {"mimeType": "multipart/mixed", "parts": [deep["payload"]["parts"][0]]}
+    fixtures = {
+        "plain 2MB": make_mime_message("p", "Plain", "a@example.com", big_body, "plain"),
+        "html-only 2MB": make_mime_message("h", "Html", "a@example.com", big_body, "html"),
+        "nested + 10MB pdf": make_mime_message("n", "Nested", "a@example.com", big_body, "nested", 10_000_000),
+        "3 levels deep": deep,
+    }
+
+    def measure(extract, msg):
+        start = time.perf_counter()
+        for _ in range(runs):
+            body = extract(msg)
+        elapsed = (time.perf_counter() - start) / runs
+        tracemalloc.start()
+        extract(msg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return body, elapsed, peak
+
+    print(f"mime extraction (mean of {runs})")
+    for name, msg in fixtures.items():
+        old_body, old_time, old_peak = measure(_extract_one_level, msg)
+        new_body, new_time, new_peak = measure(lambda m: extract_email_data(m)["body"], msg)
+        assert new_body, f"{name}: no body found"
+        print(f"  {name:<18} one-level: {old_time * 1000:7.2f} ms {old_peak / 2 ** 20:6.2f} MiB {len(old_body):>8} chars")
+        print(f"  {'':<18} walker:    {new_time * 1000:7.2f} ms {new_peak / 2 ** 20:6.2f} MiB {len(new_body):>8} chars")
+
+
+def bench_records(n: int = 200, attachment_bytes: int = 50_000):
+    """Memory held by n in-flight messages: full payload dicts vs EmailRecords."""
+    import tracemalloc
+
+    from gmail_client import extract_email_record
+
+    # Round-trip through JSON so each message is a fresh object, as an API response is
+    wire = json.dumps(make_corpus(n, attachment_bytes=attachment_bytes))
+
+    tracemalloc.start()
+    messages = json.loads(wire)
+    held_raw = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    records = [extract_email_record(m) for m in messages]
+    elapsed = time.perf_counter() - start
+    del messages
+    held_records = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(records) == n and all(r.body for r in records)
+    print(f"records n={n} attachments={attachment_bytes // 1000} KB")
+    print(f"  payload dicts: {held_raw / 2 ** 20:.2f} MiB held")
+    print(f"  EmailRecords:  {held_records / 2 ** 20:.2f} MiB held"
+          f" ({held_raw / held_records:.0f}x less), built in {elapsed / n * 1e6:.0f} us each")
+
+
+class _SlowWriteGmailService(FakeGmailService):
+    """FakeGmailService whose sends and draft creations take write_latency seconds each."""
+
+    def __init__(self, messages, write_latency: float, **kwargs):
+        super().__init__(messages, **kwargs)
+        self.write_latency = write_latency
+
+    def _send(self, body):
+        time.sleep(self.write_latency)
+        return super()._send(body)
+
+    def _create_draft(self, body):
+        time.sleep(self.write_latency)
+        return super()._create_draft(body)
+
+
+def bench_outbox(n: int = 40, write_latency: float = 0.2, llm_latency: float = 0.02):
+    """
+    Delivery through the outbox: generation no longer waits on slow Gmail
+    writes, a restarted run delivers what a crashed one stored, and a lost
+    response never leads to a second send.
+    """
+    import agent_sandra
+    import state
+    from gmail_client import extract_email_record
+    from outbox import Outbox, idempotency_key
+    from pipeline import ServicePool, process_messages
+
+    corpus = [
+        make_message(f"m{i}", f"Question {i}", f"p{i}@example.com", f"Could you review item {i}?")
+        for i in range(n)
+    ]
+    ids = [m["id"] for m in corpus]
+
+    def run(tmp, use_outbox):
+        _use_temp_state(tmp)
+        service = _SlowWriteGmailService([dict(m) for m in corpus], write_latency)
+        agent_sandra.async_client = FakeAsyncChatClient(latency=llm_latency)
+        pool = ServicePool(lambda: service)
+        outbox = Outbox(os.path.join(tmp, "outbox.db")) if use_outbox else None
+        if outbox:
+            outbox.start(pool)
+        start = time.perf_counter()
+        with LabelMutationQueue(service) as labels:
+            failed = process_messages(
+                pool, labels, ids,
+                lambda s, f, b: agent_sandra.call_email_butler(s, f, b, use_cache=False),
+                outbox=outbox,
+            )
+        committed = time.perf_counter() - start
+        if outbox:
+            assert outbox.flush(timeout=60)
+            outbox.close()
+        delivered = time.perf_counter() - start
+        state._conn.close()
+        state._conn = None
+        assert not failed and len(service.drafts) == n
+        return committed, delivered
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inline, _ = run(tmp, use_outbox=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        committed, delivered = run(tmp, use_outbox=True)
+
+    # Crash after storing replies, before any delivery; a new process resumes them
+    record = extract_email_record(corpus[0])
+    result = agent_sandra.ButlerResult(klass="question", summary="s", draft_reply=BUTLER_REPLY)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "outbox.db")
+        crashed = Outbox(path)
+        crashed.enqueue(record, result, "send")
+        crashed.close()
+        service = FakeGmailService([dict(corpus[0])])
+        restarted = Outbox(path)
+        resumed = restarted.start(ServicePool(lambda: service))
+        assert restarted.flush(timeout=10)
+        assert restarted.enqueue(record, result, "send").status == "done"
+        restarted.close()
+    assert resumed == 1 and len(service.sent) == 1
+
+    # The send goes through but its response is lost; the retry finds it instead of resending
+    with tempfile.TemporaryDirectory() as tmp:
+        service = FakeGmailService([dict(corpus[0])])
+        service.lose_next_responses(1)
+        box = Outbox(os.path.join(tmp, "outbox.db"))
+        box.start(ServicePool(lambda: service))
+        box.enqueue(record, result, "send")
+        assert box.flush(timeout=10)
+        entry = box.get(record.id)
+        box.close()
+    assert len(service.sent) == 1 and entry.status == "done" and entry.attempts == 1
+    assert entry.gmail_id == "sent-1" and entry.key == idempotency_key(record.id)
+
+    # Gmail is down past the retry budget: the reply is failed, not dropped, and a restart delivers it
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "outbox.db")
+        service = FakeGmailService([dict(corpus[0])])
+        service.fail_next(10, status=503)
+        down = Outbox(path, max_attempts=2, retry_interval=60)
+        down.start(ServicePool(lambda: service))
+        down.enqueue(record, result, "draft")
+        assert down.flush(timeout=10)
+        assert down.stats() == {"failed": 1} and not service.drafts
+        down.close()
+        service._failures.clear()
+        restarted = Outbox(path)
+        retried = restarted.start(ServicePool(lambda: service))
+        while restarted.get(record.id).status != "done":
+            time.sleep(0.01)
+        restarted.close()
+    assert retried == 1 and len(service.drafts) == 1
+
+    print(f"outbox n={n} gmail write={write_latency * 1000:.0f}ms llm={llm_latency * 1000:.0f}ms")
+    print(f"  inline write stage: all committed in {inline:.2f}s")
+    print(f"  outbox:             all committed in {committed:.2f}s ({inline / committed:.1f}x sooner),"
+          f" delivered by {delivered:.2f}s")
+    print(f"  crash + restart: {resumed} stored reply resumed, sent once")
+    print(f"  lost send response: found by Message-ID on retry, sent once")
+    print(f"  Gmail down past the retry budget: reply kept as failed, drafted once after restart")
+
+
+if __name__ == "__main__":
+    import sys
+
+    benches = [
+        bench_fetch,
+        bench_mark_read,
+        bench_sync,
+        bench_backlog,
+        bench_two_phase,
+        bench_state,
+        bench_guards,
+        bench_llm_cache,
+        bench_pipeline,
+        bench_prompt_trim,
+        bench_streaming,
+        bench_tiered,
+        bench_preclassifier,
+        bench_threads,
+        bench_rate_limit,
+        bench_service_start,
+        bench_startup,
+        bench_async_llm,
+        bench_metrics,
+        bench_harness,
+        bench_replay,
+        bench_mime,
+        bench_records,
+        bench_outbox,
+    ]
+    selected = {arg for arg in sys.argv[1:] if not arg.startswith("--")}
+    for bench in benches:
+        if not selected or bench.__name__[len("bench_"):] in selected:
+            if bench is bench_harness:
+                bench(update_baseline="--update-baseline" in sys.argv)
+            else:
+                bench()
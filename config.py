@@ -7,3 +7,96 @@ AUTO_SEND_EMAILS = {
 AUTO_SEND_DOMAINS = {
     # "",
 }
+
+# Log Gmail response sizes with and without field masks (repeats read calls).
+MEASURE_RESPONSE_SIZES = False
+
+# Senders whose replies must always be generated fresh, never served from the
+# LLM response cache (e.g. drafts that must be personal every time).
+NO_CACHE_EMAILS = {
+    # "",
+}
+NO_CACHE_DOMAINS = {
+    # "",
+}
+
+# LLM response cache for the incoming-email butler.
+LLM_CACHE_FILE = "llm_cache.db"
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 5000
+
+# Concurrency for the message pipeline (pipeline.py).
+PIPELINE_LLM_WORKERS = 4
+PIPELINE_WRITE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 16
+
+# Maximum OpenAI requests in flight at once (agent_sandra async path).
+LLM_CONCURRENCY = 16
+
+# Bytes of a message's text part decoded by extract_email_data (mime.py);
+# guards and the prompt trimmer only ever look at the start of a body.
+MAX_BODY_BYTES = 100_000
+
+# Upper bound, in estimated tokens, for an email body sent to the butler.
+PROMPT_BODY_TOKEN_BUDGET = 1500
+
+# Two-tier butler: a short classification call runs first, and the full
+# summary + draft call only runs for these classes.
+BUTLER_TIERED = True
+REPLY_WORTHY_CLASSES = {"URGENT", "IMPORTANT"}
+CLASSIFY_MAX_TOKENS = 8
+# The classifier only needs the opening of a body to label it
+CLASSIFY_BODY_TOKEN_BUDGET = 200
+
+# Local pre-classifier (preclassifier.py): skips the LLM for mail it is this
+# confident is not reply-worthy. Train with `python preclassifier.py train`.
+PRECLASSIFIER_LABELS_FILE = "labels.db"
+PRECLASSIFIER_MODEL_FILE = "preclassifier.json"
+PRECLASSIFIER_THRESHOLD = 0.99
+PRECLASSIFIER_MIN_EXAMPLES = 200
+
+# Unread messages sharing a thread get one reply, to the newest of them.
+# Earlier messages are passed to the butler as context, each trimmed to
+# this many estimated tokens.
+THREAD_CONTEXT_MESSAGES = 5
+THREAD_CONTEXT_TOKEN_BUDGET = 150
+
+# Client-side API budgets (ratelimit.py). Gmail allows 250 quota units per
+# user per second; staying a little under it avoids 429s at window edges.
+# OpenAI limits depend on your account tier.
+GMAIL_QUOTA_UNITS_PER_SECOND = 225
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 200_000
+
+# Retries for throttled and transient API errors: exponential backoff with
+# full jitter, never shorter than the server's Retry-After.
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+# Watcher retries (watch.py): a message that fails is retried on later
+# polls after interval * 2**attempts seconds, at most WATCH_RETRY_MAX_DELAY,
+# and given up on (left unread, recorded as processed) after
+# WATCH_RETRY_LIMIT attempts.
+WATCH_RETRY_LIMIT = 5
+WATCH_RETRY_MAX_DELAY = 3600
+
+# Gmail client start-up: the discovery document is cached here after the
+# first run; access tokens are refreshed this long before they expire.
+DISCOVERY_CACHE_FILE = "gmail_discovery.json"
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+HTTP_TIMEOUT_SECONDS = 60
+
+# Write-ahead outbox (outbox.py): generated replies are stored here before
+# they are sent or drafted, then delivered in the background. A reply that
+# still fails after OUTBOX_MAX_ATTEMPTS is marked "failed" and retried every
+# OUTBOX_RETRY_INTERVAL seconds, and again on every start, until it goes out.
+OUTBOX_FILE = "outbox.db"
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_INTERVAL = 300
+
+# Metrics (metrics.py): rewritten in the Prometheus text format after every
+# poll cycle or run, for node_exporter's textfile collector. Set METRICS_PORT
+# to also serve them at http://localhost:<port>/metrics. None turns either off.
+METRICS_FILE = "metrics.prom"
+METRICS_PORT = None
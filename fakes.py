@@ -0,0 +1,673 @@
+"""
+In-process fakes for the Gmail API surface used by gmail_client and the
+OpenAI chat-completions surface used by agent_sandra.
+
+Only the calls Sandra actually makes are implemented. Every request that
+would leave the process counts as one round trip, so benchmarks can compare
+call patterns without a live mailbox or API key. Both fakes take a latency
+and an error rate; make_corpus() builds a mixed inbox with varied MIME
+structures.
+"""
+import asyncio
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+COMPOSER_REPLY = """CLASS:
+IMPORTANT
+
+SUMMARY:
+A thank-you note after an interview.
+
+SUBJECT:
+Thank you for the interview
+
+BODY:
+Dear Recruiter,
+
+Thank you for taking the time to speak with me today. I enjoyed learning about the team.
+
+I remain very interested in the role and am available next week.
+
+Thank you again for your consideration.
+
+Best regards,
+Pat"""
+
+BUTLER_REPLY = """CLASS:
+IMPORTANT
+
+SUMMARY:
+The sender asks a question that needs an answer.
+
+DRAFT REPLY:
+Hi,
+
+Thanks for reaching out. I will follow up shortly.
+
+Best regards"""
+
+
+# internalDate (ms) for messages made without one, increasing in creation order
+_clock = itertools.count(1_700_000_000_000, 1000)
+
+
+def make_message(
+    msg_id: str, subject: str, sender: str, body: str, extra_headers: Dict[str, str] | None = None,
+    thread_id: str | None = None,
+) -> Dict[str, Any]:
+    """Build a minimal format="full" Gmail message with a text/plain body."""
+    data = base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")
+    headers = [
+        {"name": "From", "value": sender},
+        {"name": "Subject", "value": subject},
+        {"name": "Message-ID", "value": f"<{msg_id}@fake.local>"},
+    ]
+    headers += [{"name": k, "value": v} for k, v in (extra_headers or {}).items()]
+    return {
+        "id": msg_id,
+        "threadId": thread_id or f"t-{msg_id}",
+        "internalDate": str(next(_clock)),
+        "labelIds": ["INBOX", "UNREAD"],
+        "sizeEstimate": len(body.encode("utf-8")) + sum(len(h["value"]) for h in headers),
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": headers,
+            "body": {"data": data},
+        },
+    }
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def _text_part(mime_type: str, text: str) -> Dict[str, Any]:
+    data = text.encode("utf-8")
+    return {"mimeType": mime_type, "filename": "", "headers": [], "body": {"size": len(data), "data": _b64(data)}}
+
+
+def _html(body: str) -> str:
+    paragraphs = "".join(f"<p>{line}</p>" for line in body.split("\n") if line)
+    return (
+        "<html><head><style>p { margin: 0 }</style></head>"
+        f"<body><div class=\"content\">{paragraphs}</div></body></html>"
+    )
+
+
+# How each MIME structure nests the text, HTML and attachment parts
+MIME_STRUCTURES = ("plain", "html", "alternative", "mixed", "nested")
+
+
+def make_mime_message(
+    msg_id: str, subject: str, sender: str, body: str, structure: str = "plain",
+    attachment_bytes: int = 0, extra_headers: Dict[str, str] | None = None, thread_id: str | None = None,
+) -> Dict[str, Any]:
+    """
+    make_message() with another MIME layout, one of MIME_STRUCTURES:
+
+    plain        text/plain only
+    html         text/html only
+    alternative  multipart/alternative of text/plain and text/html
+    mixed        multipart/mixed of text/plain and an attachment
+    nested       multipart/mixed of (multipart/alternative of text and HTML)
+                 and an attachment, as most mail clients send
+
+    Attachments carry attachment_bytes of data inline.
+    """
+    msg = make_message(msg_id, subject, sender, body, extra_headers, thread_id)
+    if structure == "plain":
+        return msg
+
+    plain, html = _text_part("text/plain", body), _text_part("text/html", _html(body))
+    attachment = {
+        "mimeType": "application/pdf",
+        "filename": f"{msg_id}.pdf",
+        "headers": [{"name": "Content-Disposition", "value": f'attachment; filename="{msg_id}.pdf"'}],
+        "body": {"size": attachment_bytes, "data": _b64(b"%PDF" + b"\0" * max(0, attachment_bytes - 4))},
+    }
+    alternative = {"mimeType": "multipart/alternative", "filename": "", "headers": [], "body": {"size": 0},
+                   "parts": [plain, html]}
+    layouts = {
+        "html": html,
+        "alternative": alternative,
+        "mixed": {"mimeType": "multipart/mixed", "body": {"size": 0}, "parts": [plain, attachment]},
+        "nested": {"mimeType": "multipart/mixed", "body": {"size": 0}, "parts": [alternative, attachment]},
+    }
+    payload = dict(layouts[structure])
+    payload["headers"] = msg["payload"]["headers"]
+    msg["payload"] = payload
+    msg["sizeEstimate"] += len(html["body"]["data"]) + (attachment_bytes if structure in ("mixed", "nested") else 0)
+    return msg
+
+
+_PEOPLE = ["Alex Kim", "Sam Lee", "Jordan Diaz", "Priya Nair", "Chris Okafor", "Maria Rossi"]
+_QUESTIONS = [
+    "Could you review the attached proposal before Friday?",
+    "Are you free for a call on Tuesday to go over the contract?",
+    "We need your sign-off on the budget numbers by end of day.",
+    "Can you share the latest version of the deck?",
+]
+
+
+def make_corpus(n: int, seed: int = 7, attachment_bytes: int = 50_000) -> List[Dict[str, Any]]:
+    """
+    A mixed inbox of n messages: mostly questions from people, plus
+    newsletters, no-reply notifications and out-of-office replies that the
+    guards stop. Structures cycle through MIME_STRUCTURES and bodies vary in
+    length, with quoted history on some replies.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        name = rng.choice(_PEOPLE)
+        structure = MIME_STRUCTURES[i % len(MIME_STRUCTURES)]
+        kind = rng.choices(["question", "newsletter", "notification", "ooo"], [0.6, 0.2, 0.1, 0.1])[0]
+        headers = {}
+        if kind == "question":
+            sender = f"{name} <{name.split()[0].lower()}{i}@example.com>"
+            subject = f"Re: Project {i % 37}"
+            body = f"Hi,\n\n{rng.choice(_QUESTIONS)}\n\nThanks,\n{name}"
+            if rng.random() < 0.5:
+                quoted = "\n".join(f"> {rng.choice(_QUESTIONS)}" for _ in range(rng.randint(5, 60)))
+                body += f"\n\nOn Mon, Jan 1, 2024 at 9:00 AM Me <me@example.com> wrote:\n{quoted}"
+        elif kind == "newsletter":
+            sender = "Weekly Digest <digest@news.example.com>"
+            subject = f"This week's top stories #{i}"
+            body = "\n".join(f"Story {j}: something happened." for j in range(rng.randint(10, 80)))
+            headers["List-Unsubscribe"] = "<mailto:unsubscribe@news.example.com>"
+        elif kind == "notification":
+            sender = "Builds <no-reply@ci.example.com>"
+            subject = f"Build #{i} passed"
+            body = f"Build #{i} passed in {rng.randint(1, 30)} minutes."
+        else:
+            sender = f"{name} <{name.split()[0].lower()}{i}@example.com>"
+            subject = "Out of Office"
+            body = "I am currently out of the office with limited access to email."
+        corpus.append(make_mime_message(
+            f"m{i}", subject, sender, body, structure,
+            attachment_bytes=attachment_bytes, extra_headers=headers,
+        ))
+    return corpus
+
+
+class _FakeResponse(dict):
+    """Headers plus .status, like httplib2.Response on HttpError.resp."""
+
+    def __init__(self, status: int, headers: Dict[str, str]):
+        super().__init__(headers)
+        self.status = status
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status: int, message: str = "", retry_after: float | None = None):
+        super().__init__(message or f"HTTP {status}")
+        self.status = status
+        headers = {"retry-after": f"{retry_after:.3f}"} if retry_after is not None else {}
+        self.resp = _FakeResponse(status, headers)
+
+
+# Gmail quota units charged by each fake handler; anything else costs 1
+_QUOTA_UNITS = {
+    "_list": 5, "_get": 5, "_modify": 5, "_batch_modify": 50, "_send": 100,
+    "_create_draft": 10, "_history_list": 2, "_get_thread": 10,
+}
+
+
+class FakeRequest:
+    def __init__(self, service: "FakeGmailService", fn, *args):
+        self._service = service
+        self._fn = fn
+        self._args = args
+
+    def _run(self):
+        self._service.charge(_QUOTA_UNITS.get(self._fn.__name__, 1))
+        return self._fn(*self._args)
+
+    def execute(self):
+        self._service.round_trip()
+        response = self._run()
+        self._service.maybe_lose_response()
+        return response
+
+
+class FakeBatch:
+    def __init__(self, service: "FakeGmailService", callback):
+        self._service = service
+        self._callback = callback
+        self._requests: List = []
+
+    def add(self, request: FakeRequest, request_id: str | None = None, callback=None):
+        if len(self._requests) >= 100:
+            raise ValueError("Exceeded maximum of 100 calls in a batch")
+        rid = request_id or str(len(self._requests))
+        self._requests.append((rid, request, callback or self._callback))
+
+    def execute(self):
+        self._service.round_trip()
+        for rid, request, callback in self._requests:
+            try:
+                response, error = request._run(), None
+            except Exception as e:
+                response, error = None, e
+            callback(rid, response, error)
+
+
+class _Messages:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def list(self, userId: str, labelIds=None, q: str = "", maxResults: int = 100, pageToken=None, **kwargs):
+        return FakeRequest(self._service, self._service._list, labelIds or [], maxResults, pageToken, q)
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders=None, **kwargs):
+        return FakeRequest(self._service, self._service._get, id, format, metadataHeaders)
+
+    def modify(self, userId: str, id: str, body: Dict[str, Any], **kwargs):
+        return FakeRequest(self._service, self._service._modify, id, body)
+
+    def batchModify(self, userId: str, body: Dict[str, Any], **kwargs):
+        return FakeRequest(self._service, self._service._batch_modify, body)
+
+    def send(self, userId: str, body: Dict[str, Any], **kwargs):
+        return FakeRequest(self._service, self._service._send, body)
+
+
+class _History:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def list(self, userId: str, startHistoryId: str, pageToken=None, **kwargs):
+        return FakeRequest(self._service, self._service._history_list, int(startHistoryId))
+
+
+class _Threads:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def get(self, userId: str, id: str, format: str = "full", **kwargs):
+        return FakeRequest(self._service, self._service._get_thread, id)
+
+
+class _Drafts:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def create(self, userId: str, body: Dict[str, Any], **kwargs):
+        return FakeRequest(self._service, self._service._create_draft, body)
+
+
+class _Users:
+    def __init__(self, service: "FakeGmailService"):
+        self._service = service
+
+    def messages(self):
+        return _Messages(self._service)
+
+    def drafts(self):
+        return _Drafts(self._service)
+
+    def threads(self):
+        return _Threads(self._service)
+
+    def history(self):
+        return _History(self._service)
+
+    def getProfile(self, userId: str, **kwargs):
+        return FakeRequest(self._service, lambda: {"historyId": str(self._service.history_id)})
+
+
+class FakeGmailService:
+    """
+    Stand-in for googleapiclient's Gmail resource.
+
+    `messages` maps message id -> format="full" dict. `round_trips` counts
+    every execute() on a single request or a batch, each of which sleeps for
+    `latency` seconds.
+
+    With quota_per_second set, a call that would take the last second's
+    quota units over it fails with 429 and a Retry-After, as Gmail does;
+    fail_next() makes the next calls fail with any status, and error_rate
+    fails that share of all calls at random with error_status.
+    lose_next_responses() drops responses after the call has taken effect.
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]] | None = None, latency: float = 0.0,
+                 quota_per_second: int | None = None, error_rate: float = 0.0,
+                 error_status: int = 429, seed: int = 0):
+        self.messages: Dict[str, Dict[str, Any]] = {m["id"]: m for m in messages or []}
+        self.latency = latency
+        self.quota_per_second = quota_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._rng = random.Random(seed)
+        self.round_trips = 0
+        self.throttled = 0
+        self.injected_errors = 0
+        self._charges: List = []
+        self._failures: List[int] = []
+        self._lost_responses = 0
+        self._quota_lock = threading.Lock()
+        self.drafts: List[Dict[str, Any]] = []
+        self.sent: List[Dict[str, Any]] = []
+        # (historyId, message id) for every delivered message
+        self.history_id = 1
+        self.min_history_id = 1
+        self._history: List = []
+
+    def deliver(self, msg: Dict[str, Any]):
+        """Simulate a new message arriving in the inbox."""
+        self.messages[msg["id"]] = msg
+        self.history_id += 1
+        self._history.append((self.history_id, msg["id"]))
+
+    def users(self):
+        return _Users(self)
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def fail_next(self, count: int, status: int = 503):
+        """Make the next `count` calls (single or inside a batch) fail with `status`."""
+        self._failures += [status] * count
+
+    def lose_next_responses(self, count: int):
+        """Let the next `count` single calls take effect, then fail as if the connection dropped."""
+        self._lost_responses += count
+
+    def maybe_lose_response(self):
+        with self._quota_lock:
+            if self._lost_responses:
+                self._lost_responses -= 1
+                raise ConnectionError("connection reset before the response arrived")
+
+    def charge(self, units: int):
+        with self._quota_lock:
+            if self._failures:
+                raise FakeHttpError(self._failures.pop(0))
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.injected_errors += 1
+                raise FakeHttpError(self.error_status, "injected error", retry_after=0.0)
+            if self.quota_per_second is None:
+                return
+            now = time.monotonic()
+            self._charges = [(t, u) for t, u in self._charges if now - t < 1.0]
+            used = sum(u for _, u in self._charges)
+            if used + units > self.quota_per_second:
+                self.throttled += 1
+                wait = 1.0 - (now - self._charges[0][0]) if self._charges else 1.0
+                raise FakeHttpError(429, "User-rate limit exceeded", retry_after=wait)
+            self._charges.append((now, units))
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _list(self, label_ids: List[str], max_results: int, page_token=None, q: str = ""):
+        if q.startswith("rfc822msgid:"):
+            return self._find_by_message_id(q[len("rfc822msgid:"):])
+        # Page tokens are opaque in Gmail; here they are the last id returned,
+        # so pages stay stable while earlier messages change labels.
+        ordered = list(self.messages.values())
+        start = 0
+        if page_token:
+            start = next(i for i, m in enumerate(ordered) if m["id"] == page_token) + 1
+        ids = []
+        for m in ordered[start:]:
+            if all(label in m["labelIds"] for label in label_ids):
+                ids.append({"id": m["id"], "threadId": m["threadId"]})
+                if len(ids) == max_results:
+                    break
+        result = {"messages": ids, "resultSizeEstimate": len(ids)}
+        if len(ids) == max_results and ids[-1]["id"] != ordered[-1]["id"]:
+            result["nextPageToken"] = ids[-1]["id"]
+        return result
+
+    def _history_list(self, start: int):
+        if start < self.min_history_id:
+            raise FakeHttpError(404, "Requested entity was not found.")
+        records = [
+            {
+                "id": str(hid),
+                "messagesAdded": [{
+                    "message": {
+                        "id": msg_id,
+                        "threadId": self.messages[msg_id]["threadId"],
+                        "labelIds": list(self.messages[msg_id]["labelIds"]),
+                    }
+                }],
+            }
+            for hid, msg_id in self._history
+            if hid > start
+        ]
+        return {"history": records, "historyId": str(self.history_id)}
+
+    def _get(self, msg_id: str, format: str = "full", metadata_headers=None):
+        if msg_id not in self.messages:
+            raise FakeHttpError(404, f"Message {msg_id} not found")
+        msg = self.messages[msg_id]
+        if format != "metadata":
+            return msg
+        wanted = {h.lower() for h in metadata_headers or []}
+        headers = [
+            h for h in msg["payload"]["headers"]
+            if not wanted or h["name"].lower() in wanted
+        ]
+        return {
+            "id": msg["id"],
+            "threadId": msg["threadId"],
+            "labelIds": list(msg["labelIds"]),
+            "sizeEstimate": msg["sizeEstimate"],
+            "payload": {"mimeType": msg["payload"]["mimeType"], "headers": headers},
+        }
+
+    def _get_thread(self, thread_id: str):
+        messages = [m for m in self.messages.values() if m["threadId"] == thread_id]
+        if not messages:
+            raise FakeHttpError(404, f"Thread {thread_id} not found")
+        return {"id": thread_id, "messages": messages}
+
+    def _modify(self, msg_id: str, body: Dict[str, Any]):
+        msg = self._get(msg_id)
+        labels = [l for l in msg["labelIds"] if l not in body.get("removeLabelIds", [])]
+        labels += [l for l in body.get("addLabelIds", []) if l not in labels]
+        msg["labelIds"] = labels
+        return {"id": msg_id, "labelIds": labels}
+
+    def _batch_modify(self, body: Dict[str, Any]):
+        if len(body["ids"]) > 1000:
+            raise FakeHttpError(400, "Too many ids in batchModify")
+        # All or nothing: one unknown id fails the whole call
+        for msg_id in body["ids"]:
+            if msg_id not in self.messages:
+                raise FakeHttpError(400, f"Invalid id value: {msg_id}")
+        for msg_id in body["ids"]:
+            self._modify(msg_id, body)
+        return None
+
+    def _find_by_message_id(self, message_id: str):
+        written = [(f"sent-{i + 1}", b) for i, b in enumerate(self.sent)]
+        written += [(f"draft-{i + 1}", d["message"]) for i, d in enumerate(self.drafts)]
+        ids = [
+            {"id": gmail_id, "threadId": message.get("threadId")}
+            for gmail_id, message in written
+            if f"Message-ID: {message_id}" in base64.urlsafe_b64decode(message["raw"]).decode("utf-8", "ignore")
+        ]
+        return {"messages": ids[:1], "resultSizeEstimate": len(ids[:1])}
+
+    def _send(self, body: Dict[str, Any]):
+        self.sent.append(body)
+        return {"id": f"sent-{len(self.sent)}", "threadId": body.get("threadId")}
+
+    def _create_draft(self, body: Dict[str, Any]):
+        self.drafts.append(body)
+        return {"id": f"draft-{len(self.drafts)}", "message": body.get("message", {})}
+
+
+def _generation_time(content: str, chunk_size: int, chunk_latency: float) -> float:
+    """How long streaming content would take after the first-token latency."""
+    return chunk_latency * -(-len(content) // chunk_size)
+
+
+class _Completions:
+    def __init__(self, client: "FakeChatClient"):
+        self._client = client
+
+    def create(self, model: str, messages: List[Dict[str, str]], stream: bool = False, **kwargs):
+        self._client.calls += 1
+        self._client.prompts.append(messages)
+        if self._client.latency:
+            time.sleep(self._client.latency)
+        content = self._client.reply
+        if stream:
+            return self._stream(content)
+        # The whole reply is generated before any of it is returned
+        time.sleep(_generation_time(content, self._client.chunk_size, self._client.chunk_latency))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+                completion_tokens=len(content) // 4,
+            ),
+        )
+
+    def _stream(self, content: str):
+        size = self._client.chunk_size
+        for start in range(0, len(content), size):
+            if self._client.chunk_latency:
+                time.sleep(self._client.chunk_latency)
+            delta = SimpleNamespace(content=content[start:start + size])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class FakeChatClient:
+    """
+    Stand-in for openai.OpenAI with a fixed reply. `latency` is paid before
+    the first token and each chunk of `chunk_size` characters costs another
+    `chunk_latency`: as it streams with stream=True, all up front without.
+    """
+
+    def __init__(self, reply: str = BUTLER_REPLY, latency: float = 0.0,
+                 chunk_size: int = 4, chunk_latency: float = 0.0):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_latency = chunk_latency
+        self.calls = 0
+        self.prompts: List = []
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+
+class _AsyncCompletions:
+    def __init__(self, client: "FakeAsyncChatClient"):
+        self._client = client
+
+    async def create(self, model: str, messages: List[Dict[str, str]], **kwargs):
+        self._client.calls += 1
+        self._client.prompts.append(messages)
+        if self._client.latency:
+            await asyncio.sleep(self._client.latency)
+        if self._client.error_rate and self._client._rng.random() < self._client.error_rate:
+            self._client.errors += 1
+            raise FakeHttpError(429, "Rate limit reached", retry_after=0.0)
+        reply = self._client.reply
+        content = reply(messages) if callable(reply) else reply
+        if self._client.chunk_latency:
+            await asyncio.sleep(_generation_time(content, self._client.chunk_size, self._client.chunk_latency))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+                completion_tokens=len(content) // 4,
+            ),
+        )
+
+
+class FakeAsyncChatClient:
+    """
+    Stand-in for openai.AsyncOpenAI with optional latency. `reply` is the
+    fixed reply text, or a callable(messages) returning it. error_rate is
+    the share of calls that fail with a 429 after their latency. Generation
+    time is modelled as in FakeChatClient: chunk_latency per chunk_size
+    characters of the reply.
+    """
+
+    def __init__(self, reply: str = BUTLER_REPLY, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 chunk_size: int = 4, chunk_latency: float = 0.0):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.prompts: List = []
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(self))
+
+
+class MockOpenAIServer:
+    """
+    Local HTTP server answering POST /v1/chat/completions after `latency`
+    seconds, for benchmarks that go through the real openai client.
+
+        with MockOpenAIServer(latency=0.2) as server:
+            AsyncOpenAI(base_url=server.base_url, api_key="test")
+    """
+
+    def __init__(self, reply: str = BUTLER_REPLY, latency: float = 0.0):
+        self.reply = reply
+        self.latency = latency
+        self.requests = 0
+        self._server = None
+
+    def __enter__(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                mock.requests += 1
+                time.sleep(mock.latency)
+                body = json.dumps({
+                    "id": f"chatcmpl-{mock.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", ""),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": mock.reply},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
@@ -1,24 +1,78 @@
 import os.path
-from typing import List, Dict, Any
+import atexit
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Dict, Any, Iterator, Optional, Tuple
 import base64
 from email.mime.text import MIMEText
 from email.utils import parseaddr
-from datetime import datetime
+from datetime import datetime, timezone
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
 import base64
 from email.utils import formataddr
 
+from config import (
+    DISCOVERY_CACHE_FILE,
+    HTTP_TIMEOUT_SECONDS,
+    MAX_BODY_BYTES,
+    MEASURE_RESPONSE_SIZES,
+    RETRY_MAX_ATTEMPTS,
+    TOKEN_REFRESH_MARGIN_SECONDS,
+)
+import metrics
+import replay
+from mime import body_text
+from ratelimit import acquire_gmail, backoff_delay, call_with_retry, is_retryable, note_retry
+
 # Read + modify + create drafts/send
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
     "https://www.googleapis.com/auth/gmail.compose",
 ]
 
+DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+
+# Gmail rejects batch HTTP requests with more than 100 inner calls.
+BATCH_GET_LIMIT = 100
+
+# users.messages.batchModify accepts at most 1000 ids per call.
+BATCH_MODIFY_LIMIT = 1000
+
+# Headers fetched in the metadata phase; enough for sender and header guards.
+METADATA_HEADERS = ["From", "Subject", "Message-ID", "List-Unsubscribe", "Auto-Submitted"]
+
+# Partial-response field masks, one per API call. Each lists only what the
+# callers of that call read; widen the mask here before reading a new field.
+FIELDS = {
+    "messages.list": "messages(id,threadId),nextPageToken",
+    "messages.get.full": "id,threadId,sizeEstimate,payload(mimeType,headers,body/data,parts)",
+    "messages.get.metadata": "id,threadId,sizeEstimate,payload(mimeType,headers)",
+    "messages.modify": "id",
+    "messages.send": "id,threadId",
+    "drafts.create": "id",
+    "history.list": "history/messagesAdded/message(id,threadId,labelIds),historyId,nextPageToken",
+    "users.getProfile": "historyId",
+    "threads.get": "id,messages(id,threadId,internalDate,sizeEstimate,payload(mimeType,headers,body/data,parts))",
+}
+
+# Calls that must not be retried after a 5xx: the first attempt may have
+# gone through, and a retry would send or draft twice. Rate limits are
+# still retried.
+_NON_IDEMPOTENT_CALLS = {"messages.send", "drafts.create"}
+
+# Calls that may be repeated without a mask when measuring response sizes.
+# Writes are never repeated, so only their masked size is recorded.
+_READ_ONLY_CALLS = {
+    "messages.list", "messages.get.full", "messages.get.metadata",
+    "history.list", "users.getProfile", "threads.get",
+}
+
+# kind -> [calls, masked bytes, unmasked bytes] while MEASURE_RESPONSE_SIZES is on
+RESPONSE_SIZES: Dict[str, List[int]] = {}
+
 
 def send_new_email(service, to_email: str, subject: str, body: str, from_name: str | None = None):
     """
@@ -38,34 +92,199 @@ def send_new_email(service, to_email: str, subject: str, body: str, from_name: s
     raw = base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
     message = {"raw": raw}
 
-    sent = service.users().messages().send(
+    sent = _execute(
+        service.users().messages().send, "messages.send",
         userId="me",
         body=message,
-    ).execute()
+    )
 
     return sent
 
 
-def get_gmail_service():
-    """Authenticate and return a Gmail service client."""
-    creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+def _record_response_size(kind: str, masked: Any, unmasked: Any = None):
+    sizes = RESPONSE_SIZES.setdefault(kind, [0, 0, 0])
+    sizes[0] += 1
+    sizes[1] += _response_size(masked)
+    sizes[2] += _response_size(unmasked if unmasked is not None else masked)
+
+
+def _call(kind: str, request_fn):
+    """Run request_fn() within the Gmail quota, retrying throttled and transient errors."""
+
+    def attempt():
+        acquire_gmail(kind)
+        return request_fn()
+
+    with metrics.timed("sandra_gmail_call_seconds", call=kind):
+        return call_with_retry(attempt, kind, idempotent=kind not in _NON_IDEMPOTENT_CALLS)
+
+
+def _execute(method, kind: str, **kwargs):
+    """
+    Run a Gmail API method with the field mask for `kind`.
+
+    With MEASURE_RESPONSE_SIZES on, read-only calls are repeated without the
+    mask so report_response_sizes() can compare both sizes.
+    """
+    response = _call(kind, lambda: method(fields=FIELDS[kind], **kwargs).execute())
+    if MEASURE_RESPONSE_SIZES:
+        unmasked = _call(kind, lambda: method(**kwargs).execute()) if kind in _READ_ONLY_CALLS else None
+        _record_response_size(kind, response, unmasked)
+    return response
+
+
+def report_response_sizes():
+    """Print masked vs unmasked response bytes per call since the last report."""
+    for kind, (calls, masked, unmasked) in sorted(RESPONSE_SIZES.items()):
+        saved = 100 * (1 - masked / unmasked) if unmasked else 0
+        print(f"[FIELDS] {kind}: {calls} call(s), {masked} bytes masked vs {unmasked} unmasked ({saved:.0f}% saved)")
+    RESPONSE_SIZES.clear()
+
+
+# The google client libraries are imported inside the functions below: they
+# take most of a cold start, and only code that talks to Gmail needs them.
+_creds = None
+_creds_lock = threading.RLock()
+_discovery_doc: Optional[Dict[str, Any]] = None
+
+
+def _save_token(creds):
+    with open("token.json", "w") as token:
+        token.write(creds.to_json())
+
+
+def get_credentials():
+    """
+    Process-wide OAuth credentials, read from token.json once. Runs the
+    browser flow when there is no usable token.
+    """
+    global _creds
+    with _creds_lock:
+        if _creds is None:
+            from google.oauth2.credentials import Credentials
+
+            creds = None
+            if os.path.exists("token.json"):
+                creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    from google.auth.transport.requests import Request
+
+                    creds.refresh(Request())
+                else:
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        "credentials.json", SCOPES
+                    )
+                    creds = flow.run_local_server(port=0)
+                _save_token(creds)
+            _creds = creds
+        return _creds
+
+
+def refresh_credentials():
+    """Refresh the shared credentials now and persist the new token."""
+    from google.auth.transport.requests import Request
+
+    with _creds_lock:
+        creds = get_credentials()
+        creds.refresh(Request())
+        _save_token(creds)
+
+
+def start_token_refresher(margin: float = TOKEN_REFRESH_MARGIN_SECONDS) -> Optional[threading.Thread]:
+    """
+    Refresh the access token `margin` seconds before it expires, on a daemon
+    thread, so no API call in a poll cycle has to stop and refresh it.
+    Replays need no token, so none is started for them.
+    """
+    if replay.replaying():
+        return None
+
+    def _run():
+        while True:
+            expiry = get_credentials().expiry
+            # google-auth keeps expiry as naive UTC
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            wait = (expiry - now).total_seconds() - margin if expiry else 3600
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                refresh_credentials()
+                print("[AUTH] Refreshed access token ahead of expiry.")
+            except Exception as e:
+                print("[AUTH] Token refresh failed:", e)
+                time.sleep(60)
+
+    thread = threading.Thread(target=_run, name="token-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def _discovery_document() -> Dict[str, Any]:
+    """
+    The Gmail v1 discovery document, read and parsed at most once per
+    process. It comes from DISCOVERY_CACHE_FILE, else the copy bundled with
+    googleapiclient, else one network fetch; the first two need no round trip.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        import httplib2
+        from googleapiclient import discovery_cache
+
+        if os.path.exists(DISCOVERY_CACHE_FILE):
+            with open(DISCOVERY_CACHE_FILE, "r") as f:
+                doc = f.read()
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
-            )
-            creds = flow.run_local_server(port=0)
+            doc = discovery_cache.get_static_doc("gmail", "v1")
+            if doc is None:
+                _, content = httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS).request(DISCOVERY_URL)
+                doc = content.decode("utf-8")
+            with open(DISCOVERY_CACHE_FILE, "w") as f:
+                f.write(doc)
+        _discovery_doc = json.loads(doc)
+    return _discovery_doc
+
+
+def build_gmail_service(credentials):
+    """
+    A Gmail service with its own keep-alive HTTP connection. httplib2
+    connections are not thread-safe, so build one per thread (ServicePool
+    does) and keep it for the life of the process.
+    """
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
+
+    http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+    return build_from_document(_discovery_document(), http=http)
+
+
+def get_gmail_service():
+    """
+    Authenticate and return a Gmail service client; while replay.py is
+    replaying, a stand-in serving the capture, and while it is recording,
+    the client wrapped to record every call.
+    """
+    if replay.replaying():
+        return replay.gmail_service()
+    return replay.wrap_gmail(build_gmail_service(get_credentials()))
 
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
 
-    service = build("gmail", "v1", credentials=creds)
-    return service
+def build_search_query(query: str = "", after: str | None = None, before: str | None = None) -> str:
+    """
+    Combine a Gmail search query with an optional date window.
+    Dates use Gmail's 'YYYY/MM/DD' form.
+    """
+    parts = [query] if query else []
+    if after:
+        parts.append(f"after:{after}")
+    if before:
+        parts.append(f"before:{before}")
+    return " ".join(parts)
 
 
 def list_unread_messages(service, max_results: int = 5) -> List[Dict[str, Any]]:
@@ -75,26 +294,375 @@ def list_unread_messages(service, max_results: int = 5) -> List[Dict[str, Any]]:
     """
     today = datetime.now().strftime("%Y/%m/%d")
 
-    result = service.users().messages().list(
+    result = _execute(
+        service.users().messages().list, "messages.list",
         userId="me",
         labelIds=["INBOX", "UNREAD"],
-        q=f"after:{today}",
+        q=build_search_query(after=today),
         maxResults=max_results,
-    ).execute()
+    )
 
     return result.get("messages", [])
 
 
+def iter_unread_messages(
+    service,
+    query: str = "",
+    after: str | None = None,
+    before: str | None = None,
+    page_size: int = 100,
+    page_token: str | None = None,
+) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+    """
+    Stream unread INBOX messages ({"id", "threadId"}) page by page,
+    following nextPageToken. Yields (messages, next_page_token).
+    """
+    q = build_search_query(query, after, before)
+
+    while True:
+        result = _execute(
+            service.users().messages().list, "messages.list",
+            userId="me",
+            labelIds=["INBOX", "UNREAD"],
+            q=q,
+            maxResults=page_size,
+            pageToken=page_token,
+        )
+
+        page_token = result.get("nextPageToken")
+        messages = result.get("messages", [])
+        if messages:
+            yield messages, page_token
+        if not page_token:
+            return
+
+
+def iter_unread_message_ids(
+    service,
+    query: str = "",
+    after: str | None = None,
+    before: str | None = None,
+    page_size: int = 100,
+    page_token: str | None = None,
+) -> Iterator[Tuple[List[str], Optional[str]]]:
+    """
+    Stream unread INBOX message ids page by page, following nextPageToken.
+
+    Yields (ids, next_page_token). Store next_page_token once a page has
+    been processed and pass it back as page_token to resume after a crash.
+    Only one page of ids is held in memory at a time.
+    """
+    for messages, next_page_token in iter_unread_messages(service, query, after, before, page_size, page_token):
+        yield [m["id"] for m in messages], next_page_token
+
+
+class HistoryExpiredError(Exception):
+    """The stored historyId is too old for users.history.list (HTTP 404)."""
+
+
+def _http_status(error: Exception) -> Optional[int]:
+    """Best-effort HTTP status of a googleapiclient HttpError."""
+    resp = getattr(error, "resp", None)
+    status = getattr(resp, "status", None) or getattr(error, "status", None)
+    return int(status) if status else None
+
+
+def is_gone(error: Exception) -> bool:
+    """The message or thread was deleted: retrying will never succeed."""
+    return _http_status(error) in (404, 410)
+
+
+def get_history_id(service) -> str:
+    """Current mailbox historyId, used as the starting point for sync."""
+    profile = _execute(service.users().getProfile, "users.getProfile", userId="me")
+    return str(profile["historyId"])
+
+
+def list_added_message_ids(service, start_history_id: str) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Return unread INBOX messages added since start_history_id and the new
+    historyId to store. An idle mailbox costs a single small request.
+
+    Raises HistoryExpiredError when Gmail no longer has that history.
+    """
+    messages: List[Dict[str, Any]] = []
+    seen = set()
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        try:
+            result = _execute(
+                service.users().history().list, "history.list",
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                labelId="INBOX",
+                pageToken=page_token,
+            )
+        except Exception as e:
+            if _http_status(e) == 404:
+                raise HistoryExpiredError(start_history_id) from e
+            raise
+
+        for record in result.get("history", []):
+            for added in record.get("messagesAdded", []):
+                msg = added.get("message", {})
+                if msg.get("id") in seen or "UNREAD" not in msg.get("labelIds", []):
+                    continue
+                seen.add(msg["id"])
+                messages.append({"id": msg["id"], "threadId": msg.get("threadId")})
+
+        history_id = str(result.get("historyId", history_id))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return messages, history_id
+
+
+def sync_unread_messages(
+    service, history_id: Optional[str], max_results: int = 5
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Incremental replacement for list_unread_messages.
+
+    With a stored history_id only new messageAdded events are fetched. With
+    no history_id, or an expired one, this falls back to listing every
+    unread message from today, max_results per page, and starts a fresh
+    history from there; history only reports later arrivals, so the whole
+    listing is returned rather than its first page. Returns (messages,
+    history_id); persist the id once the messages have been processed.
+    """
+    if history_id:
+        try:
+            return list_added_message_ids(service, history_id)
+        except HistoryExpiredError:
+            print("[SYNC] Stored historyId expired. Falling back to a full list.")
+
+    # Read the profile first so nothing that arrives during the list is lost
+    new_history_id = get_history_id(service)
+    today = datetime.now().strftime("%Y/%m/%d")
+    messages = [
+        m
+        for page, _ in iter_unread_messages(service, after=today, page_size=max_results)
+        for m in page
+    ]
+    return messages, new_history_id
+
+
 def get_message_detail(service, msg_id: str) -> Dict[str, Any]:
     """Get full message with headers and body."""
-    msg = service.users().messages().get(
+    msg = _execute(
+        service.users().messages().get, "messages.get.full",
         userId="me",
         id=msg_id,
         format="full",
-    ).execute()
+    )
     return msg
 
 
+def _batch_get(service, ids: List[str], make_request, kind: str):
+    """
+    Run make_request(id, **kwargs) for every id as Gmail batch HTTP requests,
+    BATCH_GET_LIMIT per round trip. Returns (id, response, error) tuples in
+    ids order; exactly one of response / error is set for each item.
+
+    Every inner call is charged to the Gmail quota. Inner calls that fail
+    with a retryable error are sent again in a smaller batch after a backoff.
+    """
+    results: Dict[str, Tuple[Optional[Dict[str, Any]], Optional[Exception]]] = {}
+
+    def _callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    pending = list(range(len(ids)))
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        for start in range(0, len(pending), BATCH_GET_LIMIT):
+            chunk = pending[start:start + BATCH_GET_LIMIT]
+            batch = service.new_batch_http_request(callback=_callback)
+            for idx in chunk:
+                batch.add(make_request(ids[idx], fields=FIELDS[kind]), request_id=str(idx))
+
+            def run_batch(batch=batch, size=len(chunk)):
+                acquire_gmail(kind, size)
+                batch.execute()
+
+            with metrics.timed("sandra_gmail_call_seconds", call=f"{kind} batch"):
+                call_with_retry(run_batch, f"{kind} batch")
+
+        failed = []
+        for idx in pending:
+            error = results.get(str(idx), (None, None))[1]
+            if error is not None and is_retryable(error):
+                failed.append(idx)
+        if not failed or attempt + 1 == RETRY_MAX_ATTEMPTS:
+            break
+        delay = max(backoff_delay(attempt, results[str(idx)][1]) for idx in failed)
+        note_retry(kind, f"{len(failed)} call(s) in batch failed; retrying in {delay:.1f}s.", len(failed))
+        time.sleep(delay)
+        pending = failed
+
+    if MEASURE_RESPONSE_SIZES:
+        for idx, item_id in enumerate(ids):
+            masked = results.get(str(idx), (None, None))[0]
+            if masked is not None:
+                _record_response_size(kind, masked, _call(kind, make_request(item_id).execute))
+
+    ordered = []
+    for idx, item_id in enumerate(ids):
+        response, error = results.get(
+            str(idx), (None, RuntimeError("no response in batch"))
+        )
+        ordered.append((item_id, response, error))
+    return ordered
+
+
+def get_message_details_batch(
+    service, msg_ids: List[str], format: str = "full"
+) -> List[Tuple[str, Optional[Dict[str, Any]], Optional[Exception]]]:
+    """
+    Fetch many messages using Gmail batch HTTP requests.
+
+    Sends one round trip per BATCH_GET_LIMIT ids instead of one per message.
+    Returns (msg_id, message, error) tuples in the same order as msg_ids;
+    exactly one of message / error is set for each item. format="metadata"
+    returns only METADATA_HEADERS and no body.
+    """
+    extra = {"metadataHeaders": METADATA_HEADERS} if format == "metadata" else {}
+
+    def make_request(msg_id, **kwargs):
+        return service.users().messages().get(userId="me", id=msg_id, format=format, **extra, **kwargs)
+
+    return _batch_get(service, msg_ids, make_request, f"messages.get.{format}")
+
+
+def get_threads_batch(
+    service, thread_ids: List[str]
+) -> List[Tuple[str, Optional[Dict[str, Any]], Optional[Exception]]]:
+    """
+    Fetch whole threads (every message, format="full") with batch requests.
+    Returns (thread_id, thread, error) tuples in thread_ids order.
+    """
+
+    def make_request(thread_id, **kwargs):
+        return service.users().threads().get(userId="me", id=thread_id, format="full", **kwargs)
+
+    return _batch_get(service, thread_ids, make_request, "threads.get")
+
+
+class FetchStats:
+    """
+    Bytes downloaded by the two-phase fetch, and bytes it did not download
+    because a metadata guard dropped the message first. Avoided bytes use
+    Gmail's sizeEstimate of the raw message.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes_fetched = 0
+        self.bytes_avoided = 0
+        self.skipped = 0
+
+    def __str__(self) -> str:
+        return (
+            f"fetched {self.bytes_fetched} bytes, avoided {self.bytes_avoided} bytes "
+            f"({self.skipped} message(s) dropped on metadata)"
+        )
+
+
+def _response_size(obj: Dict[str, Any]) -> int:
+    return len(json.dumps(obj, separators=(",", ":")))
+
+
+def get_messages_two_phase(service, msg_ids: List[str], skip_reason, stats: FetchStats | None = None):
+    """
+    Fetch metadata first and download full bodies only for survivors.
+
+    skip_reason(metadata_dict) returns a reason string to drop the message,
+    or None to keep it; metadata_dict comes from extract_metadata().
+    Returns (msg_id, message, error, reason) tuples in msg_ids order. For
+    dropped messages `message` is the metadata-only resource.
+    """
+    stats = stats or FetchStats()
+    results = []
+    keep_ids = []
+
+    for msg_id, meta, error in get_message_details_batch(service, msg_ids, format="metadata"):
+        if error is not None:
+            results.append((msg_id, None, error, None))
+            continue
+        stats.bytes_fetched += _response_size(meta)
+        reason = skip_reason(extract_metadata(meta))
+        if reason:
+            stats.skipped += 1
+            stats.bytes_avoided += int(meta.get("sizeEstimate", 0))
+            results.append((msg_id, meta, None, reason))
+        else:
+            keep_ids.append(msg_id)
+            results.append((msg_id, None, None, None))
+
+    full = {}
+    for msg_id, msg, error in get_message_details_batch(service, keep_ids, format="full"):
+        if msg is not None:
+            stats.bytes_fetched += _response_size(msg)
+        full[msg_id] = (msg, error)
+
+    ordered = []
+    for msg_id, msg, error, reason in results:
+        if reason is None and error is None:
+            msg, error = full[msg_id]
+        ordered.append((msg_id, msg, error, reason))
+    return ordered
+
+
+def get_thread_heads(
+    service, groups: List[Tuple[str, List[str]]], skip_reason, stats: FetchStats | None = None,
+    block_reason=None,
+):
+    """
+    Coalesce unread messages that share a thread.
+
+    groups is a list of (thread_id, unread msg_ids). Each thread is fetched
+    once and one unread message becomes the head that gets a reply: the
+    newest one that skip_reason() (on its headers) and block_reason() (on
+    the full message, if given) both let through, else the newest one.
+    A trailing "Thanks!" so no longer hides the question before it.
+    Returns (head_id, head, earlier, error, reason) tuples in groups order:
+    earlier holds the thread's messages before the head, oldest first, and
+    reason is skip_reason() applied to the head's headers.
+    """
+    stats = stats or FetchStats()
+    fetched = get_threads_batch(service, [thread_id for thread_id, _ in groups])
+
+    results = []
+    for (thread_id, msg_ids), (_, thread, error) in zip(groups, fetched):
+        if error is not None:
+            results.append((msg_ids[0], None, [], error, None))
+            continue
+        stats.bytes_fetched += _response_size(thread)
+        messages = sorted(thread.get("messages", []), key=lambda m: int(m.get("internalDate", 0)))
+        unread = set(msg_ids)
+        positions = [i for i, m in enumerate(messages) if m["id"] in unread]
+        if not positions:
+            error = RuntimeError(f"none of {msg_ids} found in thread {thread_id}")
+            results.append((msg_ids[0], None, [], error, None))
+            continue
+        head_pos, reason = positions[-1], None
+        for pos in reversed(positions):
+            pos_reason = skip_reason(extract_metadata(messages[pos]))
+            if pos == positions[-1]:
+                reason = pos_reason
+            if not pos_reason and not (block_reason and block_reason(messages[pos])):
+                head_pos, reason = pos, None
+                break
+        if reason:
+            stats.skipped += 1
+        head = messages[head_pos]
+        results.append((head["id"], head, messages[:head_pos], None, reason))
+    return results
+
+
 def _find_header(headers, name: str) -> str:
     for h in headers:
         if h["name"].lower() == name.lower():
@@ -102,33 +670,30 @@ def _find_header(headers, name: str) -> str:
     return ""
 
 
-def extract_email_data(msg: Dict[str, Any]) -> Dict[str, str]:
-    """
-    Extract subject, from, plain-text body (simple version).
-    """
+def extract_metadata(msg: Dict[str, Any]) -> Dict[str, str]:
+    """Header values used by the metadata guards."""
     headers = msg.get("payload", {}).get("headers", [])
+    return {
+        "from": _find_header(headers, "From"),
+        "subject": _find_header(headers, "Subject"),
+        "message_id": _find_header(headers, "Message-ID"),
+        "list_unsubscribe": _find_header(headers, "List-Unsubscribe"),
+        "auto_submitted": _find_header(headers, "Auto-Submitted"),
+    }
 
-    subject = _find_header(headers, "Subject")
-    from_ = _find_header(headers, "From")
 
-    body = ""
+def extract_email_data(msg: Dict[str, Any], max_bytes: int = MAX_BODY_BYTES) -> Dict[str, str]:
+    """
+    Extract subject, from and the plain-text body: the first text/plain part
+    at any depth, else the first text/html part as text, with at most
+    max_bytes decoded and attachments never read (see mime.py).
+    """
     payload = msg.get("payload", {})
+    headers = payload.get("headers", [])
 
-    if payload.get("mimeType") == "text/plain":
-        body_data = payload.get("body", {}).get("data")
-        if body_data:
-            body = base64.urlsafe_b64decode(body_data).decode(
-                "utf-8", errors="ignore"
-            )
-    else:
-        for part in payload.get("parts", []):
-            if part.get("mimeType") == "text/plain":
-                body_data = part.get("body", {}).get("data")
-                if body_data:
-                    body = base64.urlsafe_b64decode(body_data).decode(
-                        "utf-8", errors="ignore"
-                    )
-                    break
+    subject = _find_header(headers, "Subject")
+    from_ = _find_header(headers, "From")
+    body = body_text(payload, max_bytes)
 
     return {
         "subject": subject,
@@ -137,26 +702,174 @@ def extract_email_data(msg: Dict[str, Any]) -> Dict[str, str]:
     }
 
 
+@dataclass(frozen=True, slots=True)
+class EmailRecord:
+    """
+    The part of a message the pipeline keeps once its payload is parsed:
+    enough to prompt the butler and to address a reply. Holding this
+    instead of the format="full" dict lets the payload be freed at once.
+    """
+    id: str
+    thread_id: str
+    sender: str
+    subject: str
+    message_id: str
+    body: str
+
+
+def extract_email_record(msg: Dict[str, Any], max_bytes: int = MAX_BODY_BYTES) -> EmailRecord:
+    """Build the EmailRecord for a format="full" message; the body is as in extract_email_data."""
+    payload = msg.get("payload", {})
+    headers = payload.get("headers", [])
+    return EmailRecord(
+        id=msg.get("id", ""),
+        thread_id=msg.get("threadId", ""),
+        sender=_find_header(headers, "From"),
+        subject=_find_header(headers, "Subject"),
+        message_id=_find_header(headers, "Message-ID"),
+        body=body_text(payload, max_bytes),
+    )
+
+
 def mark_as_read(service, msg_id: str):
     """Remove UNREAD label from a message."""
-    service.users().messages().modify(
+    _execute(
+        service.users().messages().modify, "messages.modify",
         userId="me",
         id=msg_id,
         body={"removeLabelIds": ["UNREAD"], "addLabelIds": []},
-    ).execute()
+    )
 
 
-def create_reply_draft(service, original_msg: Dict[str, Any], reply_text: str):
-    """Create a Gmail draft reply in the same thread."""
-    payload = original_msg.get("payload", {})
-    headers = payload.get("headers", [])
-
-    from_addr = _find_header(headers, "From")
-    subject = _find_header(headers, "Subject")
-    message_id = _find_header(headers, "Message-ID")
+class LabelMutationQueue:
+    """
+    Buffer label changes and apply them with users.messages.batchModify.
+
+    Changes are grouped by their (add, remove) label sets, since one
+    batchModify call applies the same change to every id. The queue flushes
+    when it holds max_size ids, when the oldest pending change is older than
+    max_age seconds, when flush() is called, and at interpreter exit;
+    add(..., auto_flush=False) leaves the flush to the caller. A change's
+    on_written(ids) callback runs only once the batchModify carrying it has
+    succeeded.
+    """
 
-    _, to_email = parseaddr(from_addr)
+    def __init__(self, service, max_size: int = BATCH_MODIFY_LIMIT, max_age: float = 30.0):
+        self.service = service
+        self.max_size = min(max_size, BATCH_MODIFY_LIMIT)
+        self.max_age = max_age
+        # (add, remove) -> insertion-ordered set of message ids
+        self._pending: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], Dict[str, None]] = {}
+        self._size = 0
+        self._oldest: Optional[float] = None
+        # msg_id -> callbacks waiting for its change to be written
+        self._on_written: Dict[str, List[Callable[[List[str]], None]]] = {}
+        atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def add(self, msg_id: str, add_labels=(), remove_labels=(),
+            on_written: Callable[[List[str]], None] | None = None, auto_flush: bool = True):
+        """Queue a label change for one message."""
+        key = (tuple(sorted(add_labels)), tuple(sorted(remove_labels)))
+        ids = self._pending.setdefault(key, {})
+        if on_written is not None:
+            self._on_written.setdefault(msg_id, []).append(on_written)
+        if msg_id in ids:
+            return
+        ids[msg_id] = None
+        self._size += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+        if auto_flush and (self._size >= self.max_size or time.monotonic() - self._oldest >= self.max_age):
+            self.flush()
+
+    def mark_read(self, msg_id: str, on_written: Callable[[List[str]], None] | None = None,
+                  auto_flush: bool = True):
+        """Queue removal of the UNREAD label."""
+        self.add(msg_id, remove_labels=("UNREAD",), on_written=on_written, auto_flush=auto_flush)
+
+    def flush(self) -> int:
+        """
+        Apply every pending change. Returns the number of ids written.
+
+        A chunk Gmail rejects outright (a 4xx other than 429, e.g. an id
+        deleted since it was queued) is split in half and retried until the
+        bad ids are isolated; those are logged and dropped so the rest of
+        the chunk still goes through.
+        """
+        written = 0
+        for key in list(self._pending):
+            ids = list(self._pending[key])
+            while ids:
+                chunk = ids[:BATCH_MODIFY_LIMIT]
+                written += self._write_chunk(key, chunk)
+                del ids[:len(chunk)]
+            del self._pending[key]
+
+        self._oldest = None
+        return written
+
+    def _write_chunk(self, key, chunk: List[str]) -> int:
+        add_labels, remove_labels = key
+        try:
+            _call("messages.batchModify", self.service.users().messages().batchModify(
+                userId="me",
+                body={
+                    "ids": chunk,
+                    "addLabelIds": list(add_labels),
+                    "removeLabelIds": list(remove_labels),
+                },
+            ).execute)
+        except Exception as e:
+            status = _http_status(e)
+            if status is None or not 400 <= status < 500 or status == 429:
+                raise
+            if len(chunk) > 1:
+                half = len(chunk) // 2
+                return self._write_chunk(key, chunk[:half]) + self._write_chunk(key, chunk[half:])
+            print(f"[LABELS] Dropping label change for {chunk[0]}: {e}")
+            self._done(key, chunk)
+            for msg_id in chunk:
+                self._on_written.pop(msg_id, None)
+            return 0
+        self._done(key, chunk)
+        self._notify_written(chunk)
+        return len(chunk)
+
+    def _done(self, key, chunk: List[str]):
+        for msg_id in chunk:
+            del self._pending[key][msg_id]
+        self._size -= len(chunk)
+
+    def _notify_written(self, chunk: List[str]):
+        # One call per callback with all of its ids in the chunk
+        waiting: Dict[Callable, List[str]] = {}
+        for msg_id in chunk:
+            for callback in self._on_written.pop(msg_id, ()):
+                waiting.setdefault(callback, []).append(msg_id)
+        for callback, ids in waiting.items():
+            callback(ids)
+
+
+def _reply_raw(original: EmailRecord, reply_text: str, message_id: str | None = None) -> str:
+    """
+    The reply to `original` as a base64url RFC 2822 message, threaded under
+    it. message_id sets the reply's own Message-ID, so find_reply() can
+    tell later whether it was delivered.
+    """
+    _, to_email = parseaddr(original.sender)
 
+    subject = original.subject
     if subject.lower().startswith("re:"):
         reply_subject = subject
     else:
@@ -166,59 +879,68 @@ def create_reply_draft(service, original_msg: Dict[str, Any], reply_text: str):
     msg["To"] = to_email
     msg["Subject"] = reply_subject
 
+    if original.message_id:
+        msg["In-Reply-To"] = original.message_id
+        msg["References"] = original.message_id
     if message_id:
-        msg["In-Reply-To"] = message_id
-        msg["References"] = message_id
+        msg["Message-ID"] = message_id
+
+    return base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
 
-    raw = base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
 
+def _as_record(original) -> EmailRecord:
+    # Reply builders take an EmailRecord; a raw message dict still works
+    if isinstance(original, EmailRecord):
+        return original
+    return extract_email_record(original, max_bytes=0)
+
+
+def create_reply_draft(service, original: EmailRecord, reply_text: str, message_id: str | None = None):
+    """Create a Gmail draft reply in the same thread."""
+    original = _as_record(original)
     draft_body = {
         "message": {
-            "raw": raw,
-            "threadId": original_msg.get("threadId"),
+            "raw": _reply_raw(original, reply_text, message_id),
+            "threadId": original.thread_id,
         }
     }
 
-    draft = service.users().drafts().create(
-        userId="me", body=draft_body
-    ).execute()
+    draft = _execute(
+        service.users().drafts().create, "drafts.create",
+        userId="me", body=draft_body,
+    )
 
     return draft
 
 
-def send_reply(service, original_msg: Dict[str, Any], reply_text: str):
+def send_reply(service, original: EmailRecord, reply_text: str, message_id: str | None = None):
     """Send an actual reply email in the same thread."""
-    payload = original_msg.get("payload", {})
-    headers = payload.get("headers", [])
-
-    from_addr = _find_header(headers, "From")
-    subject = _find_header(headers, "Subject")
-    message_id = _find_header(headers, "Message-ID")
-
-    _, to_email = parseaddr(from_addr)
-
-    if subject.lower().startswith("re:"):
-        reply_subject = subject
-    else:
-        reply_subject = f"Re: {subject}"
-
-    msg = MIMEText(reply_text)
-    msg["To"] = to_email
-    msg["Subject"] = reply_subject
-
-    if message_id:
-        msg["In-Reply-To"] = message_id
-        msg["References"] = message_id
-
-    raw = base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
-
+    original = _as_record(original)
     body = {
-        "raw": raw,
-        "threadId": original_msg.get("threadId"),
+        "raw": _reply_raw(original, reply_text, message_id),
+        "threadId": original.thread_id,
     }
 
-    sent = service.users().messages().send(
-        userId="me", body=body
-    ).execute()
+    sent = _execute(
+        service.users().messages().send, "messages.send",
+        userId="me", body=body,
+    )
 
     return sent
+
+
+def find_reply(service, message_id: str) -> Optional[str]:
+    """
+    Id of the sent message or draft whose Message-ID header is message_id,
+    or None if Gmail has none. Used to check whether a send whose response
+    was lost actually went through.
+    """
+    result = _execute(
+        service.users().messages().list, "messages.list",
+        userId="me",
+        q=f"rfc822msgid:{message_id}",
+        includeSpamTrash=True,
+        maxResults=1,
+    )
+    messages = result.get("messages", [])
+    return messages[0]["id"] if messages else None
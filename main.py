@@ -1,89 +1,202 @@
+import metrics
+from config import OUTBOX_FILE
+from state import load_state, record_progress
 from gmail_client import (
     get_gmail_service,
+    start_token_refresher,
     list_unread_messages,
-    get_message_detail,
-    extract_email_data,
-    mark_as_read,
-    create_reply_draft,
-    send_reply,
+    iter_unread_message_ids,
+    extract_metadata,
+    FetchStats,
+    report_response_sizes,
+    LabelMutationQueue,
 )
-from ai_butler import call_email_butler
-from rules import is_noreply_address, should_auto_send
-from reply_guard import should_generate_reply
+from agent_sandra import call_email_butler
+from outbox import Outbox, report_delivered
+from pipeline import ServicePool, process_messages
+
+
+def report_message(idx, item):
+    """Print what happened to one message once it has been committed."""
+    print("=" * 80)
+    if item.error is not None:
+        print(f"[{idx}] [ERROR] Could not process message {item.msg_id}: {item.error}")
+        print("=" * 80)
+        print()
+        return
+
+    if item.outcome == "gone":
+        print(f"[{idx}] [INFO] Message {item.msg_id} no longer exists ({item.reason}). Skipping.")
+        print("=" * 80)
+        print()
+        return
+
+    # Guard 1: sender / header checks, decided from metadata only
+    if item.outcome == "skipped":
+        meta = extract_metadata(item.msg)
+        print(f"[{idx}] SUBJECT: {meta['subject']}")
+        print(f"FROM: {meta['from']}")
+        print(f"[GUARD] {item.reason}. Skipping reply.")
+        print("[INFO] Queued original message to be marked as read.")
+        print("=" * 80)
+        print()
+        return
+
+    record = item.record
+    print(f"[{idx}] SUBJECT: {record.subject}")
+    print(f"FROM: {record.sender}")
+    if item.coalesced:
+        print(f"[THREAD] Coalesced {len(item.coalesced)} earlier unread message(s) into one reply.")
+    print("-" * 80)
+    print("BODY (truncated preview):")
+    print(record.body[:500])
+    print()
+
+    # Guard 2: closure / acknowledgement / system-like content
+    if item.outcome == "blocked":
+        print(f"[GUARD] Email does not require a reply based on content analysis ({item.reason}).")
+        print("[INFO] Queued original message to be marked as read.")
+        print("=" * 80)
+        print()
+        return
+
+    result = item.result
+    print(f"[PROMPT] Trimmed ~{item.tokens_saved} tokens before the LLM call.")
+    print(f"CLASS: {result.klass}")
+    if item.outcome == "classified":
+        print("[TIER] Not reply-worthy; no draft needed.")
+        print("[INFO] Queued original message to be marked as read.")
+        print("=" * 80)
+        print()
+        return
+
+    print("SUMMARY:")
+    print(result.summary)
+    print("DRAFT REPLY:")
+    print(result.draft_reply)
+    print()
+
+    if item.resumed and item.gmail_id is None:
+        print("[OUTBOX] Reply was stored by an earlier run and is still being delivered.")
+    elif item.resumed:
+        print(f"[OUTBOX] Reply was already delivered by an earlier run. ID: {item.gmail_id}")
+    elif item.gmail_id is None:
+        print(f"[OUTBOX] Reply stored for {'sending' if item.outcome == 'sent' else 'drafting'}.")
+    elif item.outcome == "sent":
+        print(f"[INFO] Auto-sent reply. Gmail message ID: {item.gmail_id}")
+    else:
+        print(f"[INFO] Draft created. ID: {item.gmail_id}")
+
+    print("[INFO] Queued original message to be marked as read.")
+    print("=" * 80)
+    print()
+
+
+def _start_outbox(pool) -> Outbox:
+    """Open the outbox and deliver whatever an earlier run left in it."""
+    outbox = Outbox(OUTBOX_FILE, on_delivered=report_delivered)
+    resumed = outbox.start(pool)
+    if resumed:
+        print(f"[OUTBOX] Resuming {resumed} undelivered repl{'y' if resumed == 1 else 'ies'} from an earlier run.")
+    return outbox
 
 
 def main():
     service = get_gmail_service()
-    messages = list_unread_messages(service, max_results=10)
+    with metrics.timed("sandra_step_seconds", step="list_unread_messages"):
+        messages = list_unread_messages(service, max_results=10)
 
     if not messages:
         print("No unread messages found for today.")
         return
 
-    for idx, m in enumerate(messages, start=1):
-        msg_id = m["id"]
-        full_msg = get_message_detail(service, msg_id)
-        email_data = extract_email_data(full_msg)
+    labels = LabelMutationQueue(service)
+    stats = FetchStats()
+    pool = ServicePool(get_gmail_service)
+    outbox = _start_outbox(pool)
+    process_messages(
+        pool, labels, [m["id"] for m in messages], call_email_butler,
+        report=lambda item: report_message(item.seq + 1, item), stats=stats,
+        threads={m["id"]: m.get("threadId") for m in messages}, outbox=outbox,
+    )
 
-        sender = email_data["from"]
-        subject = email_data["subject"]
-        body = email_data["body"]
+    written = labels.flush()
+    print(f"[INFO] Marked {written} message(s) as read.")
+    outbox.flush()
+    print(f"[OUTBOX] {outbox.stats()}")
+    print(f"[FETCH] {stats}")
+    report_response_sizes()
+    for line in metrics.summary_lines():
+        print(f"[STAGE] {line}")
+    metrics.write_textfile()
 
-        print("=" * 80)
-        print(f"[{idx}] SUBJECT: {subject}")
-        print(f"FROM: {sender}")
-        print("-" * 80)
-        print("BODY (truncated preview):")
-        print((body or "")[:500])
-        print()
 
-        # Guard 1: no-reply sender
-        if is_noreply_address(sender):
-            print("[GUARD] No-reply or system sender detected. Skipping reply.")
-            mark_as_read(service, msg_id)
-            print("[INFO] Marked original message as read.")
-            print("=" * 80)
-            print()
-            continue
-
-        # Guard 2: closure / acknowledgement / system-like content
-        if not should_generate_reply(subject, body):
-            print("[GUARD] Email does not require a reply based on content analysis.")
-            mark_as_read(service, msg_id)
-            print("[INFO] Marked original message as read.")
-            print("=" * 80)
-            print()
-            continue
-
-        # Safe to generate a reply
-        print("Running AI Email Butler...")
-
-        result = call_email_butler(
-            subject=subject,
-            sender=sender,
-            body=body,
-        )
+def drain_backlog(query: str = "", after: str | None = None, before: str | None = None, page_size: int = 100):
+    """
+    Process every unread INBOX message matching the query, page by page.
 
-        print(f"CLASS: {result.klass}")
-        print("SUMMARY:")
-        print(result.summary)
-        print("DRAFT REPLY:")
-        print(result.draft_reply)
-        print()
+    Each message is recorded in state as it commits and the page cursor is
+    saved after each page, so a crashed run picks up where it stopped.
+    Memory stays at one page of messages.
+    """
+    service = get_gmail_service()
+    start_token_refresher()
+    state = load_state()
+    processed = set(state.get("processed_ids", []))
 
-        if should_auto_send(sender):
-            sent = send_reply(service, full_msg, result.draft_reply)
-            print(f"[INFO] Auto-sent reply. Gmail message ID: {sent.get('id')}")
-        else:
-            draft = create_reply_draft(service, full_msg, result.draft_reply)
-            draft_id = draft.get("id")
-            print(f"[INFO] Draft created. ID: {draft_id}")
+    cursor = state.get("backlog_cursor") or {}
+    cursor_key = {"query": query, "after": after, "before": before}
+    page_token = None
+    if {k: cursor.get(k) for k in cursor_key} == cursor_key:
+        page_token = cursor.get("page_token")
+        if page_token:
+            print("[INFO] Resuming backlog from saved cursor.")
 
-        mark_as_read(service, msg_id)
-        print("[INFO] Marked original message as read.")
-        print("=" * 80)
-        print()
+    seen = [0]
+    stats = FetchStats()
+    pool = ServicePool(get_gmail_service)
+    outbox = _start_outbox(pool)
+
+    def report(item):
+        seen[0] += 1
+        report_message(seen[0], item)
+
+    with LabelMutationQueue(service) as labels:
+        pages = iter_unread_message_ids(
+            service,
+            query=query,
+            after=after,
+            before=before,
+            page_size=page_size,
+            page_token=page_token,
+        )
+        for ids, next_page_token in pages:
+            new_ids = [msg_id for msg_id in ids if msg_id not in processed]
+            process_messages(
+                pool, labels, new_ids, call_email_butler,
+                report=report, processed=processed, stats=stats, outbox=outbox,
+            )
+
+            # Each message is already recorded; now move the cursor past the page
+            labels.flush()
+            record_progress(backlog_cursor={**cursor_key, "page_token": next_page_token})
+            metrics.write_textfile()
+
+    record_progress(backlog_cursor=None)
+    outbox.flush()
+    print(f"[INFO] Backlog drained. {seen[0]} message(s) seen.")
+    print(f"[OUTBOX] {outbox.stats()}")
+    print(f"[FETCH] {stats}")
+    report_response_sizes()
+    for line in metrics.summary_lines():
+        print(f"[STAGE] {line}")
+    metrics.write_textfile()
 
 
 if __name__ == "__main__":
-    main()
+    # Same flags as `python sandra.py scan`
+    import sys
+
+    from sandra import main as cli
+
+    cli(["scan", *sys.argv[1:]])
@@ -0,0 +1,179 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Timers are summaries with p50/p95/p99 over a window of recent samples plus
+a running count and sum; counters only go up. Export with write_textfile()
+for node_exporter's textfile collector, or serve them with
+start_http_server() at http://localhost:<port>/metrics.
+
+    with metrics.timed("sandra_stage_seconds", stage="llm"):
+        ...
+    metrics.inc("sandra_guard_hits_total", guard="out_of_office")
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from config import METRICS_FILE
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Samples kept per timer series for quantiles; count and sum cover all time
+WINDOW = 2048
+
+HELP = {
+    "sandra_stage_seconds": "Time per message in each pipeline stage.",
+    "sandra_step_seconds": "Time spent in one step of processing a message.",
+    "sandra_gmail_call_seconds": "Gmail API call latency, including retries and quota waits.",
+    "sandra_llm_seconds": "OpenAI completion latency per butler tier.",
+    "sandra_messages_total": "Messages committed, by outcome.",
+    "sandra_guard_hits_total": "Messages stopped by each guard.",
+    "sandra_llm_calls_total": "Butler answers by tier and email class.",
+    "sandra_llm_tokens_total": "OpenAI tokens used, by tier and token type.",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_timers: Dict[str, Dict[Labels, list]] = {}
+_counters: Dict[str, Dict[Labels, float]] = {}
+
+
+def _key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name: str, seconds: float, **labels):
+    """Record one timing sample."""
+    with _lock:
+        series = _timers.setdefault(name, {}).get(_key(labels))
+        if series is None:
+            # [recent samples, count, sum]
+            series = _timers[name][_key(labels)] = [deque(maxlen=WINDOW), 0, 0.0]
+        series[0].append(seconds)
+        series[1] += 1
+        series[2] += seconds
+
+
+@contextmanager
+def timed(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        series = _counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def quantile(samples, q: float) -> float:
+    """Nearest-rank quantile of samples (any iterable of numbers)."""
+    ordered = sorted(samples)
+    if not ordered:
+        return math.nan
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, **extra) -> str:
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        timers = {name: {k: (list(v[0]), v[1], v[2]) for k, v in series.items()} for name, series in _timers.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+
+    for name, series in sorted(timers.items()):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} summary")
+        for labels, (samples, count, total) in sorted(series.items()):
+            ordered = sorted(samples)
+            for q in QUANTILES:
+                lines.append(f"{name}{_format_labels(labels, quantile=str(q))} {quantile(ordered, q):.6f}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for name, series in sorted(counters.items()):
+        lines.append(f"# HELP {name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(series.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+    return "\n".join(lines) + "\n"
+
+
+def timer_stats(name: str) -> Dict[str, Dict[str, float]]:
+    """{label values: {"count", "p50", "p95", "p99"}} for one timer, in seconds."""
+    with _lock:
+        series = {k: (list(v[0]), v[1]) for k, v in _timers.get(name, {}).items()}
+    stats = {}
+    for labels, (samples, count) in sorted(series.items()):
+        samples.sort()
+        row = {"count": count}
+        row.update((f"p{round(q * 100)}", quantile(samples, q)) for q in QUANTILES)
+        stats[",".join(v for _, v in labels) or name] = row
+    return stats
+
+
+def summary_lines(name: str = "sandra_stage_seconds"):
+    """One human-readable line per series of a timer: count, p50/p95/p99 in ms."""
+    for label, row in timer_stats(name).items():
+        yield (f"{label}: n={row['count']} p50={row['p50'] * 1000:.1f}ms"
+               f" p95={row['p95'] * 1000:.1f}ms p99={row['p99'] * 1000:.1f}ms")
+
+
+def write_textfile(path: str | None = METRICS_FILE):
+    """Atomically write render() to path (for node_exporter's textfile collector)."""
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1"):
+    """Serve render() at /metrics on a daemon thread. Returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
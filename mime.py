@@ -0,0 +1,103 @@
+"""
+Find and decode the text of a Gmail message payload.
+
+The part tree is walked iteratively, in document order, and nothing is
+decoded until the walk has picked one part: the first text/plain, else the
+first text/html, which is converted to plain text. Attachments are skipped
+without being read, and only the first max_bytes of the chosen part are
+base64-decoded, so a message with a huge body or attachment costs no more
+than a small one.
+"""
+import base64
+import html
+import re
+from typing import Any, Dict, Optional
+
+from config import MAX_BODY_BYTES
+
+_CHARSET_RE = re.compile(r"charset\s*=\s*\"?([\w.:-]+)", re.IGNORECASE)
+
+# Whole elements whose text is never shown to a reader
+_HIDDEN_RE = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+# Tags that end a line of text
+_BREAK_RE = re.compile(r"<\s*(?:br|/p|/div|/li|/tr|/h[1-6]|/blockquote|hr)\b[^>]*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]*>")
+# A tag cut off by the byte cap
+_PARTIAL_TAG_RE = re.compile(r"<[^>]*$")
+_SPACES_RE = re.compile(r"[ \t\r\f\v\xa0]+")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n\s*(?:\n\s*)+")
+
+
+def _header(part: Dict[str, Any], name: str) -> str:
+    for h in part.get("headers") or ():
+        if h["name"].lower() == name:
+            return h["value"]
+    return ""
+
+
+def is_attachment(part: Dict[str, Any]) -> bool:
+    """Named parts, explicit attachments, and bodies Gmail only serves by attachmentId."""
+    if part.get("filename"):
+        return True
+    if _header(part, "content-disposition").lower().startswith("attachment"):
+        return True
+    return "attachmentId" in (part.get("body") or {})
+
+
+def find_text_part(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The part to read the body from: the first inline text/plain part in
+    document order, else the first text/html one, else None.
+    """
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if is_attachment(part):
+            continue
+        mime_type = (part.get("mimeType") or "").lower()
+        if mime_type.startswith("multipart/"):
+            # Reversed so the first child is popped first
+            stack.extend(reversed(part.get("parts") or ()))
+        elif mime_type == "text/plain" and (part.get("body") or {}).get("data"):
+            return part
+        elif mime_type == "text/html" and html_part is None and (part.get("body") or {}).get("data"):
+            html_part = part
+    return html_part
+
+
+def decode_part(part: Dict[str, Any], max_bytes: int = MAX_BODY_BYTES) -> str:
+    """The part's text, decoding only as much base64 as max_bytes needs."""
+    # 4 base64 characters carry 3 bytes
+    data = part["body"]["data"][:(max_bytes + 2) // 3 * 4]
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))[:max_bytes]
+    match = _CHARSET_RE.search(_header(part, "content-type"))
+    charset = match.group(1) if match else "utf-8"
+    try:
+        return raw.decode(charset, errors="ignore")
+    except LookupError:
+        return raw.decode("utf-8", errors="ignore")
+
+
+def html_to_text(markup: str) -> str:
+    """Readable text from HTML: hidden elements dropped, block ends as line breaks, entities decoded."""
+    text = _HIDDEN_RE.sub("", markup)
+    text = _COMMENT_RE.sub("", text)
+    text = _BREAK_RE.sub("\n", text)
+    text = _PARTIAL_TAG_RE.sub("", _TAG_RE.sub("", text))
+    text = html.unescape(text)
+    text = _SPACES_RE.sub(" ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def body_text(payload: Dict[str, Any], max_bytes: int = MAX_BODY_BYTES) -> str:
+    """Plain-text body of a message payload, at most max_bytes of it decoded; "" if it has none."""
+    part = find_text_part(payload)
+    if part is None:
+        return ""
+    text = decode_part(part, max_bytes)
+    if (part.get("mimeType") or "").lower() == "text/html":
+        return html_to_text(text)
+    return text
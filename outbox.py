@@ -0,0 +1,280 @@
+"""
+Write-ahead outbox for generated replies.
+
+The LLM stage writes each reply here, keyed by the message it answers,
+before anything is sent. Background workers then create the draft or send
+the reply, so a slow Gmail write never holds up the next LLM call, and the
+message can be marked read as soon as its reply is safely stored.
+
+Delivery is exactly-once across crashes. Every reply carries a Message-ID
+derived from its idempotency key, and an entry is marked "dispatching"
+before its Gmail call. An entry found "dispatching" on restart, or after
+a lost response, is only sent again when Gmail has no message with that
+Message-ID. A message that is processed again finds its reply already here
+and makes no new LLM call.
+
+    pending -> dispatching -> done
+                           -> failed -> done
+                              (after OUTBOX_MAX_ATTEMPTS; still retried)
+
+The original message is marked read once its reply is stored, so no reply
+is ever given up on: a failed entry is retried every OUTBOX_RETRY_INTERVAL
+seconds and resumed on every start until Gmail accepts it.
+"""
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from config import OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_INTERVAL, PIPELINE_WRITE_WORKERS
+from gmail_client import EmailRecord, create_reply_draft, find_reply, send_reply
+import metrics
+from ratelimit import backoff_delay
+
+# Finished entries older than this are deleted on start
+RETENTION_DAYS = 30
+
+_COLUMNS = (
+    "key, msg_id, mode, thread_id, sender, subject, in_reply_to,"
+    " klass, summary, draft_reply, status, attempts, gmail_id, error"
+)
+
+
+@dataclass(frozen=True)
+class OutboxEntry:
+    """
+    One stored reply. klass / summary / draft_reply mirror ButlerResult, so
+    an entry can stand in for the butler's result when a message is
+    processed again.
+    """
+    key: str
+    msg_id: str
+    mode: str  # "send" or "draft"
+    thread_id: str
+    sender: str
+    subject: str
+    in_reply_to: str
+    klass: str
+    summary: str
+    draft_reply: str
+    status: str
+    attempts: int
+    gmail_id: Optional[str]
+    error: Optional[str]
+
+    @property
+    def message_id(self) -> str:
+        """The Message-ID header the reply is sent with."""
+        return f"<{self.key}@sandra.outbox>"
+
+    def original(self) -> EmailRecord:
+        """What the reply builders need of the message being answered."""
+        return EmailRecord(
+            id=self.msg_id, thread_id=self.thread_id, sender=self.sender,
+            subject=self.subject, message_id=self.in_reply_to, body="",
+        )
+
+
+def idempotency_key(msg_id: str) -> str:
+    return hashlib.sha256(f"reply:{msg_id}".encode("utf-8")).hexdigest()[:32]
+
+
+def report_delivered(entry: OutboxEntry):
+    """Default on_delivered for the CLI commands."""
+    if entry.mode == "send":
+        print(f"[OUTBOX] Auto-sent reply to {entry.msg_id}. Gmail message ID: {entry.gmail_id}")
+    else:
+        print(f"[OUTBOX] Draft created for {entry.msg_id}. ID: {entry.gmail_id}")
+
+
+class Outbox:
+    """
+    SQLite-backed reply queue. enqueue() stores a reply; start() resumes
+    anything left undelivered and runs `workers` delivery threads; flush()
+    waits until every reply is delivered or failed.
+    """
+
+    def __init__(self, path: str, workers: int = PIPELINE_WRITE_WORKERS,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 retry_interval: float = OUTBOX_RETRY_INTERVAL,
+                 on_delivered: Callable[[OutboxEntry], None] | None = None):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self.on_delivered = on_delivered
+        self._conn = None
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        # Keys queued or being delivered in this process and not yet failed
+        self._outstanding: set = set()
+        self._idle = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._pool = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " key TEXT PRIMARY KEY, msg_id TEXT NOT NULL UNIQUE, mode TEXT NOT NULL,"
+                " thread_id TEXT, sender TEXT, subject TEXT, in_reply_to TEXT,"
+                " klass TEXT, summary TEXT, draft_reply TEXT NOT NULL,"
+                " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+                " gmail_id TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_status_idx ON outbox (status)")
+            self._conn.commit()
+        return self._conn
+
+    def _select(self, where: str, args=()) -> List[OutboxEntry]:
+        with self._lock:
+            rows = self._connection().execute(f"SELECT {_COLUMNS} FROM outbox WHERE {where}", args).fetchall()
+        return [OutboxEntry(*row) for row in rows]
+
+    def _update(self, key: str, **values):
+        values["updated_at"] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(f"UPDATE outbox SET {assignments} WHERE key = ?", (*values.values(), key))
+
+    def get(self, msg_id: str) -> Optional[OutboxEntry]:
+        """The stored reply to msg_id, if any."""
+        entries = self._select("msg_id = ?", (msg_id,))
+        return entries[0] if entries else None
+
+    def enqueue(self, record: EmailRecord, result, mode: str) -> OutboxEntry:
+        """
+        Durably store the reply `result` (a ButlerResult) to `record` and
+        queue it for delivery. Storing a second reply to the same message
+        is a no-op that returns the first.
+        """
+        key = idempotency_key(record.id)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO outbox (key, msg_id, mode, thread_id, sender, subject, in_reply_to,"
+                    " klass, summary, draft_reply, status, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?)",
+                    (key, record.id, mode, record.thread_id, record.sender, record.subject, record.message_id,
+                     result.klass, result.summary, result.draft_reply, now, now),
+                ).rowcount
+        if inserted:
+            self._schedule(key)
+        return self.get(record.id)
+
+    def _schedule(self, key: str, counted: bool = True):
+        if counted:
+            with self._idle:
+                self._outstanding.add(key)
+        self._queue.put(key)
+
+    def _settle(self, key: str):
+        """flush() stops waiting for key: it was delivered or has failed."""
+        with self._idle:
+            self._outstanding.discard(key)
+            self._idle.notify_all()
+
+    def start(self, pool) -> int:
+        """
+        Start the delivery workers, leasing Gmail services from `pool` (a
+        pipeline.ServicePool). Entries an earlier run left undelivered,
+        failed ones included, are queued first. Returns how many were resumed.
+        """
+        self._pool = pool
+        self.prune()
+        resumed = self._select("status != 'done' ORDER BY created_at")
+        for entry in resumed:
+            # Failed entries already had their attempts; flush() does not wait on them
+            self._schedule(entry.key, counted=entry.status != "failed")
+        for n in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f"outbox-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return len(resumed)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Wait until every queued entry is delivered or failed; False on
+        timeout. Failed entries keep being retried in the background.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._outstanding, timeout)
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            entries = self._select("key = ?", (key,))
+            if not entries or entries[0].status == "done":
+                self._settle(key)
+                continue
+            entry = entries[0]
+            try:
+                with self._pool.lease() as service:
+                    delivered = self._deliver(service, entry)
+            except Exception as e:
+                attempts = entry.attempts + 1
+                if attempts >= self.max_attempts:
+                    delay = self.retry_interval
+                    self._update(key, status="failed", attempts=attempts, error=str(e)[:500])
+                    print(f"[OUTBOX] Reply to {entry.msg_id} failed {attempts} time(s) ({e});"
+                          f" retrying every {delay:.0f}s.")
+                    self._settle(key)
+                else:
+                    # Stays "dispatching" if the call went out, so the retry checks Gmail first
+                    self._update(key, attempts=attempts, error=str(e)[:500])
+                    delay = backoff_delay(attempts)
+                    print(f"[OUTBOX] Reply to {entry.msg_id} failed ({e}); retrying in {delay:.1f}s.")
+                timer = threading.Timer(delay, self._queue.put, args=(key,))
+                timer.daemon = True
+                timer.start()
+                continue
+            self._settle(key)
+            if self.on_delivered:
+                try:
+                    self.on_delivered(delivered)
+                except Exception as e:
+                    print(f"[OUTBOX] on_delivered failed for {entry.msg_id}: {e}")
+
+    def _deliver(self, service, entry: OutboxEntry) -> OutboxEntry:
+        gmail_id = None
+        if entry.status in ("dispatching", "failed"):
+            # An earlier attempt may have gone through before we lost track of it
+            gmail_id = find_reply(service, entry.message_id)
+        if gmail_id is None:
+            self._update(entry.key, status="dispatching")
+            build = send_reply if entry.mode == "send" else create_reply_draft
+            with metrics.timed("sandra_step_seconds", step=build.__name__):
+                gmail_id = build(service, entry.original(), entry.draft_reply, message_id=entry.message_id).get("id")
+        self._update(entry.key, status="done", gmail_id=gmail_id, error=None)
+        return self._select("key = ?", (entry.key,))[0]
+
+    def stats(self) -> Dict[str, int]:
+        """Entry counts by status."""
+        with self._lock:
+            rows = self._connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    def prune(self, retention_days: float = RETENTION_DAYS) -> int:
+        """Delete delivered entries older than the retention window."""
+        cutoff = time.time() - retention_days * 86400
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                return conn.execute(
+                    "DELETE FROM outbox WHERE status = 'done' AND updated_at < ?", (cutoff,)
+                ).rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
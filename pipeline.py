@@ -0,0 +1,432 @@
+"""
+Staged, concurrent message processing shared by watch.py and main.py.
+
+    fetch -> guard -> LLM -> write-back -> commit
+
+Stages are connected by bounded queues and each has its own worker pool,
+so one slow model response no longer holds up every email behind it.
+Commit runs on the caller's thread, exactly once per message and strictly
+in the order messages were fetched. Given an outbox.Outbox, the LLM stage
+stores each reply there instead and the outbox delivers it, so messages
+commit without waiting on Gmail writes.
+"""
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from config import (
+    PIPELINE_LLM_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_WRITE_WORKERS,
+    THREAD_CONTEXT_MESSAGES,
+    THREAD_CONTEXT_TOKEN_BUDGET,
+)
+from gmail_client import (
+    BATCH_GET_LIMIT,
+    EmailRecord,
+    FetchStats,
+    create_reply_draft,
+    extract_email_record,
+    get_messages_two_phase,
+    get_thread_heads,
+    is_gone,
+    send_reply,
+)
+import metrics
+from preprocess import prepare_body
+from reply_guard import reply_block_reason
+from rules import metadata_skip_reason, should_auto_send
+from state import record_progress
+
+_STOP = object()
+
+
+@dataclass
+class WorkItem:
+    """One message moving through the pipeline."""
+    seq: int
+    msg_id: str
+    # The fetched message; dropped by the guard stage once `record` is built
+    msg: Optional[Dict[str, Any]] = None
+    record: Optional[EmailRecord] = None
+    # "skipped" (metadata guard), "blocked" (content guard), "gone" (deleted
+    # before it could be fetched), "classified"
+    # (tiered butler found nothing to reply to), "sent" or "draft"; with an
+    # outbox, "sent" / "draft" mean the reply is stored for that delivery
+    outcome: str = ""
+    reason: Optional[str] = None
+    result: Any = None
+    gmail_id: Optional[str] = None
+    # Idempotency key of the reply in the outbox, when one is used
+    outbox_key: Optional[str] = None
+    # The reply came from the outbox, stored by an earlier run; no LLM call
+    resumed: bool = False
+    # Estimated prompt tokens removed by preprocess.prepare_body
+    tokens_saved: int = 0
+    # Earlier unread messages in the same thread, answered by this item's reply
+    coalesced: List[str] = field(default_factory=list)
+    # Compact text of the thread before msg, passed to the butler as context
+    thread_context: str = ""
+    error: Optional[Exception] = None
+    finished: bool = False
+
+    @property
+    def msg_ids(self) -> List[str]:
+        """Every message this item settles: the replied-to one and the coalesced ones."""
+        return [self.msg_id, *self.coalesced]
+
+
+class ServicePool:
+    """
+    Gmail service objects are not thread-safe, so each worker leases its own.
+    Services are kept and reused across pipeline runs.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._idle: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+
+    @contextmanager
+    def lease(self):
+        try:
+            service = self._idle.get_nowait()
+        except queue.Empty:
+            service = self._factory()
+        try:
+            yield service
+        finally:
+            self._idle.put(service)
+
+
+class Pipeline:
+    """
+    Run items through `stages`, a list of (name, fn, workers), over queues of
+    at most queue_size items. fn(item) mutates the item; an exception is
+    stored on item.error and later stages skip it, as they skip items marked
+    finished. commit(item) is called on the caller's thread in source order;
+    if it raises, the error is stored on the item and commit is called once
+    more to record the failure, and the run carries on draining the stages.
+    Time spent in each stage is recorded as sandra_stage_seconds{stage=name}.
+    """
+
+    def __init__(self, stages, commit: Callable[[WorkItem], None], queue_size: int = 16):
+        self.stages = stages
+        self.commit = commit
+        self.queue_size = queue_size
+
+    def run(self, source: Iterable[WorkItem]) -> int:
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        # Bounds the reorder buffer too: nothing new starts while this many
+        # items are waiting for an earlier one to commit.
+        in_flight = threading.BoundedSemaphore(self.queue_size * (len(self.stages) + 1))
+        source_error: List[BaseException] = []
+        threads = []
+
+        def feed():
+            try:
+                for item in source:
+                    in_flight.acquire()
+                    queues[0].put(item)
+            except BaseException as e:
+                source_error.append(e)
+            finally:
+                for _ in range(self.stages[0][2]):
+                    queues[0].put(_STOP)
+
+        threads.append(threading.Thread(target=feed, name="pipeline-fetch", daemon=True))
+
+        for idx, (name, fn, workers) in enumerate(self.stages):
+            remaining = [workers]
+            lock = threading.Lock()
+            next_workers = self.stages[idx + 1][2] if idx + 1 < len(self.stages) else 1
+
+            def work(fn=fn, name=name, inbox=queues[idx], outbox=queues[idx + 1],
+                     remaining=remaining, lock=lock, next_workers=next_workers):
+                while True:
+                    item = inbox.get()
+                    if item is _STOP:
+                        break
+                    if not item.finished and item.error is None:
+                        start = time.perf_counter()
+                        try:
+                            fn(item)
+                        except Exception as e:
+                            item.error = e
+                        metrics.observe("sandra_stage_seconds", time.perf_counter() - start, stage=name)
+                    outbox.put(item)
+                # The last worker out tells the next stage to stop
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        for _ in range(next_workers):
+                            outbox.put(_STOP)
+
+            for n in range(workers):
+                threads.append(threading.Thread(target=work, name=f"pipeline-{name}-{n}", daemon=True))
+
+        for t in threads:
+            t.start()
+
+        pending: Dict[int, WorkItem] = {}
+        next_seq = 0
+        committed = 0
+        done = queues[-1]
+        while True:
+            item = done.get()
+            if item is _STOP:
+                break
+            pending[item.seq] = item
+            while next_seq in pending:
+                with metrics.timed("sandra_stage_seconds", stage="commit"):
+                    self._commit(pending.pop(next_seq))
+                in_flight.release()
+                next_seq += 1
+                committed += 1
+
+        for t in threads:
+            t.join()
+        if source_error:
+            raise source_error[0]
+        return committed
+
+
+    def _commit(self, item: WorkItem):
+        try:
+            self.commit(item)
+        except Exception as e:
+            if item.error is not None:
+                print(f"[PIPELINE] Could not commit failed message {item.msg_id}: {e}")
+                return
+            item.error = e
+            try:
+                self.commit(item)
+            except Exception as e2:
+                print(f"[PIPELINE] Could not commit failed message {item.msg_id}: {e2}")
+
+
+def group_by_thread(msg_ids: List[str], threads: Dict[str, str] | None):
+    """(thread_id, msg_ids) groups in first-seen order; no mapping means no grouping."""
+    groups: Dict[str, List[str]] = {}
+    for msg_id in msg_ids:
+        thread_id = (threads or {}).get(msg_id) or f"msg:{msg_id}"
+        groups.setdefault(thread_id, []).append(msg_id)
+    return list(groups.items())
+
+
+def format_thread_context(earlier: List[Dict[str, Any]]) -> str:
+    """The last THREAD_CONTEXT_MESSAGES messages before the head, each trimmed."""
+    blocks = []
+    for msg in earlier[-THREAD_CONTEXT_MESSAGES:]:
+        record = extract_email_record(msg)
+        text = prepare_body(record.body, THREAD_CONTEXT_TOKEN_BUDGET).text
+        blocks.append(f"From: {record.sender}\n{text}")
+    if not blocks:
+        return ""
+    return "--- Earlier in this thread (oldest first) ---\n" + "\n\n".join(blocks)
+
+
+def _observe_fetch(began: float, count: int):
+    share = (time.perf_counter() - began) / count
+    for _ in range(count):
+        metrics.observe("sandra_stage_seconds", share, stage="fetch")
+
+
+def _content_block_reason(msg: Dict[str, Any]) -> Optional[str]:
+    """The content guard's verdict on a full message; guard_stage applies it to heads."""
+    record = extract_email_record(msg)
+    return reply_block_reason(record.subject, record.body)
+
+
+def fetch_items(
+    pool: ServicePool,
+    msg_ids: List[str],
+    stats: FetchStats | None = None,
+    threads: Dict[str, str] | None = None,
+):
+    """
+    Source stage, yielding WorkItems.
+
+    Messages alone in their thread use the two-phase fetch in batch-sized
+    chunks. When `threads` (msg_id -> threadId) puts several unread messages
+    in one thread, that thread is fetched once and becomes a single item for
+    its newest message that passes the guards (see get_thread_heads), with
+    the rest listed in item.coalesced.
+
+    Fetches are batched, so the fetch stage is timed once per message as
+    its share of the batch it came in.
+    """
+    groups = group_by_thread(msg_ids, threads)
+    singles = [ids[0] for _, ids in groups if len(ids) == 1]
+    shared = [(thread_id, ids) for thread_id, ids in groups if len(ids) > 1]
+
+    seq = 0
+    with pool.lease() as service:
+        for start in range(0, len(singles), BATCH_GET_LIMIT):
+            chunk = singles[start:start + BATCH_GET_LIMIT]
+            began = time.perf_counter()
+            fetched = get_messages_two_phase(service, chunk, metadata_skip_reason, stats)
+            _observe_fetch(began, len(chunk))
+            for msg_id, msg, error, reason in fetched:
+                item = WorkItem(seq=seq, msg_id=msg_id, msg=msg, error=error)
+                if reason:
+                    item.outcome, item.reason, item.finished = "skipped", reason, True
+                seq += 1
+                yield item
+
+        for start in range(0, len(shared), BATCH_GET_LIMIT):
+            chunk = shared[start:start + BATCH_GET_LIMIT]
+            began = time.perf_counter()
+            heads = get_thread_heads(service, chunk, metadata_skip_reason, stats, _content_block_reason)
+            _observe_fetch(began, len(chunk))
+            for (_, ids), (head_id, head, earlier, error, reason) in zip(chunk, heads):
+                item = WorkItem(
+                    seq=seq, msg_id=head_id, msg=head, error=error,
+                    coalesced=[msg_id for msg_id in ids if msg_id != head_id],
+                )
+                if reason:
+                    item.outcome, item.reason, item.finished = "skipped", reason, True
+                elif error is None:
+                    item.thread_context = format_thread_context(earlier)
+                seq += 1
+                yield item
+
+
+def guard_stage(item: WorkItem):
+    with metrics.timed("sandra_step_seconds", step="extract_email_data"):
+        item.record = extract_email_record(item.msg)
+    # Everything later needs only the record; free the payload now rather
+    # than holding it while the item waits on the LLM
+    item.msg = None
+    with metrics.timed("sandra_step_seconds", step="reply_block_reason"):
+        reason = reply_block_reason(item.record.subject, item.record.body)
+    if reason:
+        item.outcome, item.reason, item.finished = "blocked", reason, True
+
+
+def write_back_stage(pool: ServicePool, item: WorkItem):
+    with pool.lease() as service:
+        if should_auto_send(item.record.sender):
+            with metrics.timed("sandra_step_seconds", step="send_reply"):
+                sent = send_reply(service, item.record, item.result.draft_reply)
+            item.outcome, item.gmail_id = "sent", sent.get("id")
+        else:
+            with metrics.timed("sandra_step_seconds", step="create_reply_draft"):
+                draft = create_reply_draft(service, item.record, item.result.draft_reply)
+            item.outcome, item.gmail_id = "draft", draft.get("id")
+
+
+def outbox_stage(outbox, item: WorkItem):
+    """Store the reply durably for the outbox to deliver; the item can commit at once."""
+    mode = "send" if should_auto_send(item.record.sender) else "draft"
+    with metrics.timed("sandra_step_seconds", step="outbox_enqueue"):
+        entry = outbox.enqueue(item.record, item.result, mode)
+    item.outcome = "sent" if mode == "send" else "draft"
+    item.outbox_key = entry.key
+
+
+def build_inbox_pipeline(
+    pool: ServicePool,
+    commit: Callable[[WorkItem], None],
+    reply_fn: Callable[..., Any],
+    llm_workers: int = PIPELINE_LLM_WORKERS,
+    write_workers: int = PIPELINE_WRITE_WORKERS,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+    outbox=None,
+) -> Pipeline:
+    """
+    The guard -> LLM -> write-back pipeline used by main.py and watch.py.
+    With an outbox there is no write-back stage; see outbox_stage.
+    """
+
+    def llm_stage(item: WorkItem):
+        record = item.record
+        if outbox is not None:
+            stored = outbox.get(record.id)
+            if stored is not None:
+                # Answered by an earlier run that stopped before committing
+                item.result, item.resumed = stored, True
+                item.outcome = "sent" if stored.mode == "send" else "draft"
+                item.outbox_key, item.gmail_id = stored.key, stored.gmail_id
+                return
+        # Guards saw the full body; the model only needs the new content
+        prepared = prepare_body(record.body)
+        item.tokens_saved = prepared.tokens_saved
+        body = prepared.text
+        if item.thread_context:
+            body = f"{body}\n\n{item.thread_context}"
+        with metrics.timed("sandra_step_seconds", step="call_email_butler"):
+            item.result = reply_fn(record.subject, record.sender, body)
+        # Tiered butler: classified as not worth a reply, so nothing to write
+        if not item.result.draft_reply:
+            item.outcome, item.finished = "classified", True
+        elif outbox is not None:
+            outbox_stage(outbox, item)
+
+    stages = [("guard", guard_stage, 1), ("llm", llm_stage, llm_workers)]
+    if outbox is None:
+        stages.append(("write", lambda item: write_back_stage(pool, item), write_workers))
+    return Pipeline(stages, commit=commit, queue_size=queue_size)
+
+
+def process_messages(
+    pool: ServicePool,
+    labels,
+    msg_ids: List[str],
+    reply_fn: Callable[..., Any],
+    report: Callable[[WorkItem], None] | None = None,
+    processed: set | None = None,
+    stats: FetchStats | None = None,
+    threads: Dict[str, str] | None = None,
+    **pipeline_options,
+) -> List[str]:
+    """
+    Fetch, guard, reply to and commit msg_ids through the pipeline.
+
+    Each successful message is queued for mark-as-read exactly once, in
+    fetch order, and recorded in state when labels writes that change;
+    report(item) is called right after queueing. Failed
+    messages are left unread and unrecorded so the next run retries them.
+    Pass threads (msg_id -> threadId) to answer each thread once; see
+    fetch_items. Returns the ids that failed.
+
+    Messages deleted before they could be fetched (404 / 410) end with
+    outcome "gone": they are recorded as processed, never retried.
+
+    Outcomes are counted in sandra_messages_total and the reasons guards
+    gave in sandra_guard_hits_total.
+    """
+    failed: List[str] = []
+
+    def commit(item: WorkItem):
+        # Nothing here may flush labels: a batchModify error would fail this
+        # item for the whole batch. The caller flushes after the run.
+        if item.error is not None and is_gone(item.error):
+            item.outcome, item.reason, item.error = "gone", str(item.error), None
+            record_progress(item.msg_ids)
+            if processed is not None:
+                processed.update(item.msg_ids)
+            metrics.inc("sandra_messages_total", outcome=item.outcome)
+            if report:
+                report(item)
+            return
+        if item.error is None:
+            # Recorded once actually marked read: an id recorded while still
+            # unread would be skipped, and left unread, by every later run
+            for msg_id in item.msg_ids:
+                labels.mark_read(msg_id, on_written=record_progress, auto_flush=False)
+            if processed is not None:
+                processed.update(item.msg_ids)
+        else:
+            failed.extend(item.msg_ids)
+        metrics.inc("sandra_messages_total", outcome=item.outcome if item.error is None else "error")
+        if item.reason:
+            metrics.inc("sandra_guard_hits_total", guard=item.reason, stage=item.outcome)
+        if report:
+            report(item)
+
+    pipeline = build_inbox_pipeline(pool, commit, reply_fn, **pipeline_options)
+    pipeline.run(fetch_items(pool, msg_ids, stats, threads))
+    return failed
@@ -0,0 +1,279 @@
+"""
+Offline pre-classifier for the incoming-email butler.
+
+A multinomial naive Bayes over hashed word features, trained on the classes
+the LLM butler has already assigned. When it is confident an email is not
+reply-worthy (marketing, notifications), the butler takes its answer and
+makes no API call. Everything here is local: no network, no extra packages.
+
+    python preclassifier.py train    # fit on recorded labels, write the model
+    python preclassifier.py eval     # held-out accuracy and skip precision
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, Tuple
+
+from config import (
+    PRECLASSIFIER_LABELS_FILE,
+    PRECLASSIFIER_MIN_EXAMPLES,
+    PRECLASSIFIER_MODEL_FILE,
+    PRECLASSIFIER_THRESHOLD,
+    REPLY_WORTHY_CLASSES,
+)
+
+# Feature space size; collisions are rare enough at this size for short mail
+N_FEATURES = 1 << 18
+# Only the opening of a body is hashed, which keeps prediction in microseconds
+BODY_CHARS = 2000
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9'$%]+")
+
+
+def _bucket(token: str) -> int:
+    # crc32, not hash(): str hashes change between processes
+    return zlib.crc32(token.encode("utf-8")) & (N_FEATURES - 1)
+
+
+def features(subject: str, sender: str, body: str) -> List[int]:
+    """Hashed bag of words, with subject words and sender kept apart from body words."""
+    address = (sender or "").lower()
+    if "<" in address and ">" in address:
+        address = address[address.find("<") + 1:address.find(">")]
+    domain = address.rpartition("@")[2]
+
+    tokens = [f"a:{address}", f"d:{domain}"]
+    tokens += ["s:" + t for t in _TOKEN_RE.findall((subject or "").lower())]
+    tokens += ["b:" + t for t in _TOKEN_RE.findall((body or "")[:BODY_CHARS].lower())]
+    return [_bucket(t) for t in tokens]
+
+
+class NaiveBayes:
+    """Multinomial naive Bayes with Laplace smoothing over hashed features."""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.doc_counts: Dict[str, int] = {}
+        self.feature_counts: Dict[str, Dict[int, int]] = {}
+        self.totals: Dict[str, int] = {}
+        self._log_prior: Dict[str, float] = {}
+        self._log_denominator: Dict[str, float] = {}
+        self._log_counts: Dict[str, Dict[int, float]] = {}
+
+    @property
+    def n_examples(self) -> int:
+        return sum(self.doc_counts.values())
+
+    def fit(self, examples: Iterable[Tuple[List[int], str]]) -> "NaiveBayes":
+        for feats, klass in examples:
+            self.doc_counts[klass] = self.doc_counts.get(klass, 0) + 1
+            counts = self.feature_counts.setdefault(klass, {})
+            for f in feats:
+                counts[f] = counts.get(f, 0) + 1
+            self.totals[klass] = self.totals.get(klass, 0) + len(feats)
+        self._prepare()
+        return self
+
+    def _prepare(self):
+        n = self.n_examples
+        self._log_prior = {k: math.log(c / n) for k, c in self.doc_counts.items()}
+        self._log_denominator = {
+            k: math.log(self.totals[k] + self.alpha * N_FEATURES) for k in self.doc_counts
+        }
+        # Smoothed log counts, so predict() is a dict lookup per feature
+        self._log_counts = {
+            k: {f: math.log(c + self.alpha) for f, c in counts.items()}
+            for k, counts in self.feature_counts.items()
+        }
+
+    def predict(self, feats: List[int]) -> Tuple[str, float]:
+        """Most likely class and its posterior probability."""
+        unseen = math.log(self.alpha)
+        scores = {}
+        for klass, prior in self._log_prior.items():
+            log_counts = self._log_counts[klass]
+            score = prior - len(feats) * self._log_denominator[klass]
+            for f in feats:
+                score += log_counts.get(f, unseen)
+            scores[klass] = score
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        norm = sum(math.exp(s - top) for s in scores.values())
+        return best, 1.0 / norm
+
+    def save(self, path: str):
+        data = {
+            "alpha": self.alpha,
+            "n_features": N_FEATURES,
+            "doc_counts": self.doc_counts,
+            "totals": self.totals,
+            "feature_counts": {
+                k: {str(f): c for f, c in counts.items()} for k, counts in self.feature_counts.items()
+            },
+        }
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "NaiveBayes":
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data["n_features"] != N_FEATURES:
+            raise ValueError(f"{path} was trained with {data['n_features']} features, not {N_FEATURES}")
+        model = cls(alpha=data["alpha"])
+        model.doc_counts = data["doc_counts"]
+        model.totals = data["totals"]
+        model.feature_counts = {
+            k: {int(f): c for f, c in counts.items()} for k, counts in data["feature_counts"].items()
+        }
+        model._prepare()
+        return model
+
+
+class LabelStore:
+    """
+    SQLite table of (subject, sender, body, class) as labelled by the LLM
+    butler. Identical emails are stored once; the newest label wins.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS labels ("
+                " key TEXT PRIMARY KEY, subject TEXT, sender TEXT, body TEXT,"
+                " klass TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def record(self, subject: str, sender: str, body: str, klass: str):
+        body = (body or "")[:BODY_CHARS]
+        key = hashlib.sha256(json.dumps([subject, sender, body]).encode("utf-8")).hexdigest()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO labels (key, subject, sender, body, klass, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, subject, sender, body, klass, time.time()),
+                )
+
+    def examples(self) -> List[Tuple[str, str, str, str, str]]:
+        """(key, subject, sender, body, klass) rows, oldest first."""
+        with self._lock:
+            return self._connection().execute(
+                "SELECT key, subject, sender, body, klass FROM labels ORDER BY created_at"
+            ).fetchall()
+
+
+labels = LabelStore(PRECLASSIFIER_LABELS_FILE)
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """The trained model, or None if none is saved or it saw too few examples."""
+    global _model, _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            _model_loaded = True
+            if os.path.exists(PRECLASSIFIER_MODEL_FILE):
+                model = NaiveBayes.load(PRECLASSIFIER_MODEL_FILE)
+                if model.n_examples >= PRECLASSIFIER_MIN_EXAMPLES:
+                    _model = model
+        return _model
+
+
+def confident_skip(subject: str, sender: str, body: str, threshold: float = PRECLASSIFIER_THRESHOLD):
+    """
+    The predicted class if the model is at least `threshold` sure the email
+    is not reply-worthy, else None (ask the LLM).
+    """
+    model = get_model()
+    if model is None:
+        return None
+    klass, confidence = model.predict(features(subject, sender, body))
+    if klass in REPLY_WORTHY_CLASSES or confidence < threshold:
+        return None
+    return klass
+
+
+def _is_holdout(key: str, fraction: float) -> bool:
+    # Split on the content hash so train/eval membership is stable across runs
+    return int(key[:8], 16) / 0xFFFFFFFF < fraction
+
+
+def train(rows, holdout: float = 0.0) -> NaiveBayes:
+    return NaiveBayes().fit(
+        (features(subject, sender, body), klass)
+        for key, subject, sender, body, klass in rows
+        if not _is_holdout(key, holdout)
+    )
+
+
+def evaluate(rows, holdout: float = 0.2, threshold: float = PRECLASSIFIER_THRESHOLD) -> dict:
+    """
+    Train on all but `holdout` of rows and score the rest.
+
+    coverage is the share of held-out mail the model would answer alone;
+    missed counts reply-worthy emails it would wrongly skip.
+    """
+    model = train(rows, holdout)
+    test = [r for r in rows if _is_holdout(r[0], holdout)]
+    correct = skipped = missed = 0
+    start = time.perf_counter()
+    for key, subject, sender, body, klass in test:
+        predicted, confidence = model.predict(features(subject, sender, body))
+        correct += predicted == klass
+        if predicted not in REPLY_WORTHY_CLASSES and confidence >= threshold:
+            skipped += 1
+            missed += klass in REPLY_WORTHY_CLASSES
+    elapsed = time.perf_counter() - start
+    n = len(test)
+    return {
+        "train": model.n_examples,
+        "test": n,
+        "accuracy": correct / n if n else 0.0,
+        "coverage": skipped / n if n else 0.0,
+        "skip_precision": (skipped - missed) / skipped if skipped else 1.0,
+        "missed": missed,
+        "us_per_email": elapsed / n * 1e6 if n else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local pre-classifier.")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of labels held out by eval")
+    parser.add_argument("--threshold", type=float, default=PRECLASSIFIER_THRESHOLD)
+    args = parser.parse_args()
+
+    rows = labels.examples()
+    if args.command == "train":
+        model = train(rows)
+        model.save(PRECLASSIFIER_MODEL_FILE)
+        print(f"Trained on {model.n_examples} labelled email(s): {model.doc_counts}")
+        if model.n_examples < PRECLASSIFIER_MIN_EXAMPLES:
+            print(f"[WARN] Fewer than {PRECLASSIFIER_MIN_EXAMPLES} examples; the model will not be used yet.")
+        print(f"Saved to {PRECLASSIFIER_MODEL_FILE}.")
+    else:
+        report = evaluate(rows, args.holdout, args.threshold)
+        for name, value in report.items():
+            print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
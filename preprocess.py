@@ -0,0 +1,118 @@
+"""
+Shrink an email body before it goes into an LLM prompt.
+
+Quoted reply history, signatures and legal disclaimers are removed, then
+the remainder is capped at a token budget. The newest content (the top of
+the message) is what gets kept.
+"""
+import re
+from dataclasses import dataclass
+
+from config import PROMPT_BODY_TOKEN_BUDGET
+
+# Lines that start the quoted part of a reply; everything from here is old.
+_QUOTE_HEADER_RES = [
+    # Gmail / Apple Mail: "On Mon, 3 Jun 2024 at 10:00, Jane <j@x.com> wrote:"
+    # (clients often wrap it over two lines)
+    re.compile(r"^\s*On\b[^\n]{0,200}?(?:\n[^\n]{0,200}?)?\bwrote:\s*$", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Original Message\s*-{2,}\s*$", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$", re.MULTILINE | re.IGNORECASE),
+    # Outlook: "From: ...\nSent: ..."
+    re.compile(r"^\s*From:[^\n]*\n\s*(?:Sent|Date):", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^_{10,}\s*$", re.MULTILINE),
+]
+
+# Lines that start a signature block.
+_SIGNATURE_RES = [
+    re.compile(r"^-- ?$", re.MULTILINE),
+    re.compile(r"^\s*Sent from my \w+", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^\s*Get Outlook for \w+", re.MULTILINE | re.IGNORECASE),
+]
+
+# Paragraphs containing any of these are treated as legal boilerplate.
+DISCLAIMER_MARKERS = (
+    "this email and any attachments",
+    "this e-mail and any attachments",
+    "this message and any attachments",
+    "intended solely for the use",
+    "intended only for the use",
+    "if you have received this email in error",
+    "if you have received this e-mail in error",
+    "if you are not the intended recipient",
+    "confidentiality notice",
+    "privileged and confidential",
+)
+
+# OpenAI's rule of thumb for English text
+CHARS_PER_TOKEN = 4
+
+
+@dataclass
+class PreparedBody:
+    text: str
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local estimate of model tokens, about four characters each. No tokenizer
+    download or API call; close enough for budgeting English mail.
+    """
+    return -(-len(text or "") // CHARS_PER_TOKEN)
+
+
+def _cut_at_first(text: str, patterns) -> str:
+    cut = len(text)
+    for pattern in patterns:
+        match = pattern.search(text)
+        if match:
+            cut = min(cut, match.start())
+    return text[:cut]
+
+
+def strip_quoted_history(body: str) -> str:
+    """Drop everything from the first reply/forward header, and '>' lines."""
+    body = _cut_at_first(body, _QUOTE_HEADER_RES)
+    return "\n".join(l for l in body.split("\n") if not l.lstrip().startswith(">"))
+
+
+def strip_signature(body: str) -> str:
+    return _cut_at_first(body, _SIGNATURE_RES)
+
+
+def strip_disclaimers(body: str) -> str:
+    paragraphs = re.split(r"\n\s*\n", body)
+    kept = [p for p in paragraphs if not any(m in p.lower() for m in DISCLAIMER_MARKERS)]
+    return "\n\n".join(kept)
+
+
+def cap_tokens(text: str, budget: int) -> str:
+    """Keep the start of text within `budget` tokens, on a line break if possible."""
+    limit = max(budget, 0) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    line_end = head.rfind("\n")
+    if line_end > limit // 2:
+        head = head[:line_end]
+    return head.rstrip() + "\n[...]"
+
+
+def prepare_body(body: str, budget: int = PROMPT_BODY_TOKEN_BUDGET) -> PreparedBody:
+    """Strip quoted history, signature and disclaimers, then cap at budget."""
+    before = estimate_tokens(body)
+    text = (body or "").replace("\r\n", "\n")
+    text = strip_quoted_history(text)
+    text = strip_signature(text)
+    text = strip_disclaimers(text)
+    text = re.sub(r"\n{3,}", "\n\n", text).strip()
+    # Never hand the model an empty body because a pattern over-matched
+    if not text:
+        text = (body or "").strip()
+    text = cap_tokens(text, budget)
+    return PreparedBody(text=text, tokens_before=before, tokens_after=estimate_tokens(text))
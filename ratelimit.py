@@ -0,0 +1,232 @@
+"""
+Client-side quota tracking and retries for Gmail and OpenAI calls.
+
+Each API budget is a token bucket. Callers reserve what a call will cost
+and sleep until the bucket can cover it, so a busy cycle queues instead of
+tripping the server's limit. Calls that are throttled anyway (429, Gmail's
+rate-limit 403) or hit a transient 5xx are retried with exponential backoff
+and full jitter, waiting at least as long as Retry-After asks.
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from config import (
+    GMAIL_QUOTA_UNITS_PER_SECOND,
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_TOKENS_PER_MINUTE,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_MAX_DELAY,
+)
+
+# Gmail quota units per call, from the Gmail API usage limits page
+GMAIL_QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get.full": 5,
+    "messages.get.metadata": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.send": 100,
+    "drafts.create": 10,
+    "history.list": 2,
+    "users.getProfile": 1,
+    "threads.get": 10,
+}
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Refills at `rate` per second up to `capacity`. reserve() always succeeds
+    and may leave the bucket in debt; the returned delay is how long the
+    caller must wait before using what it reserved, which keeps waiting
+    callers in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, amount: float):
+        """Give back part of a reservation (or take more, if negative)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    @property
+    def remaining(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+gmail_quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+openai_requests = TokenBucket(OPENAI_REQUESTS_PER_MINUTE / 60, OPENAI_REQUESTS_PER_MINUTE)
+openai_tokens = TokenBucket(OPENAI_TOKENS_PER_MINUTE / 60, OPENAI_TOKENS_PER_MINUTE)
+
+# Calls retried since start, by label
+retries: Dict[str, int] = {}
+# Seconds callers spent queued for budget, per API
+waited = {"gmail": 0.0, "openai": 0.0}
+
+
+def acquire_gmail(kind: str, count: int = 1):
+    """Block until the Gmail budget covers `count` calls of `kind`."""
+    delay = gmail_quota.reserve(GMAIL_QUOTA_UNITS.get(kind, 5) * count)
+    if delay:
+        waited["gmail"] += delay
+        time.sleep(delay)
+
+
+def _reserve_openai(estimated_tokens: int) -> float:
+    delay = max(openai_requests.reserve(1), openai_tokens.reserve(estimated_tokens))
+    waited["openai"] += delay
+    return delay
+
+
+async def acquire_openai(estimated_tokens: int):
+    """Wait until one more request and estimated_tokens fit the OpenAI limits."""
+    delay = _reserve_openai(estimated_tokens)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+def acquire_openai_sync(estimated_tokens: int):
+    delay = _reserve_openai(estimated_tokens)
+    if delay:
+        time.sleep(delay)
+
+
+def settle_openai(estimated_tokens: int, used_tokens: int):
+    """Correct the token bucket once the response reports actual usage."""
+    if used_tokens:
+        openai_tokens.refund(estimated_tokens - used_tokens)
+
+
+def _status(error: Exception) -> Optional[int]:
+    # openai errors carry status_code; googleapiclient's HttpError has resp.status
+    status = getattr(error, "status_code", None)
+    if status is None:
+        resp = getattr(error, "resp", None)
+        status = getattr(resp, "status", None) or getattr(error, "status", None)
+    try:
+        return int(status) if status else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    status = _status(error)
+    if status == 429:
+        return True
+    # Gmail reports per-user rate limits as 403 rateLimitExceeded
+    if status == 403:
+        content = getattr(error, "content", b"") or b""
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", errors="ignore")
+        return "ratelimitexceeded" in f"{content} {error}".lower()
+    return False
+
+
+def is_retryable(error: Exception, idempotent: bool = True, transient=()) -> bool:
+    """
+    Rate limits are always safe to retry; the server rejected the call.
+    5xx and connection errors are retried only for idempotent calls, since
+    the first attempt may have gone through.
+    """
+    if _is_rate_limit(error):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, (ConnectionError, TimeoutError) + tuple(transient)):
+        return True
+    return _status(error) in RETRYABLE_STATUSES
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds from a Retry-After / retry-after-ms response header, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        headers = getattr(error, "resp", None)
+    if not headers or not hasattr(headers, "get"):
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return float(ms) / 1000
+        seconds = headers.get("retry-after")
+        return float(seconds) if seconds is not None else None
+    except (TypeError, ValueError):
+        # HTTP-date form; fall back to our own backoff
+        return None
+
+
+def backoff_delay(attempt: int, error: Exception | None = None) -> float:
+    """Full-jitter exponential backoff, never shorter than Retry-After."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    hint = retry_after(error) if error is not None else None
+    return max(delay, hint or 0.0)
+
+
+def note_retry(label: str, message: str, count: int = 1):
+    retries[label] = retries.get(label, 0) + count
+    print(f"[RETRY] {label}: {message}")
+
+
+def call_with_retry(
+    fn: Callable, label: str, idempotent: bool = True, transient=(), attempts: int = RETRY_MAX_ATTEMPTS
+):
+    """Run fn(), retrying retryable errors up to `attempts` times in total."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt + 1 >= attempts or not is_retryable(e, idempotent, transient):
+                raise
+            delay = backoff_delay(attempt, e)
+            note_retry(label, f"attempt {attempt + 1} failed ({e}); retrying in {delay:.1f}s.")
+            time.sleep(delay)
+
+
+async def call_with_retry_async(
+    fn: Callable, label: str, idempotent: bool = True, transient=(), attempts: int = RETRY_MAX_ATTEMPTS
+):
+    """call_with_retry for a coroutine function."""
+    for attempt in range(attempts):
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt + 1 >= attempts or not is_retryable(e, idempotent, transient):
+                raise
+            delay = backoff_delay(attempt, e)
+            note_retry(label, f"attempt {attempt + 1} failed ({e}); retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+
+def gauges() -> Dict[str, float]:
+    """Remaining budget per bucket, time spent queued, and retry counts."""
+    return {
+        "gmail_units_remaining": round(gmail_quota.remaining, 1),
+        "openai_requests_remaining": round(openai_requests.remaining, 1),
+        "openai_tokens_remaining": round(openai_tokens.remaining),
+        "gmail_queued_seconds": round(waited["gmail"], 2),
+        "openai_queued_seconds": round(waited["openai"], 2),
+        "retries": sum(retries.values()),
+    }
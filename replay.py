@@ -0,0 +1,417 @@
+"""
+Record and replay Gmail and OpenAI traffic.
+
+Recording wraps the Gmail service and the async OpenAI client and appends
+every call to a gzip-compressed JSONL capture: which call it was, the
+arguments that identify it, how long it took and what came back (or the
+HTTP status it failed with). Replay serves those responses from the
+capture with no network and no credentials, sleeping each call's recorded
+latency divided by `speed`, so a busy day can be re-run against new
+pipeline settings or a new version and compared like for like.
+
+    python sandra.py --record busy_day.jsonl.gz watch
+    python sandra.py --replay busy_day.jsonl.gz --speed 10 scan
+    python replay.py busy_day.jsonl.gz           # calls and latency per method
+
+Gmail calls are matched on method and arguments (message id, format, page
+token, history id); repeats of the same call are served in recorded order
+and the last one is reused once they run out. Completions are matched on
+their prompt, falling back to the next recorded completion for the same
+system instruction when settings change the prompt. Only butler traffic is
+recorded; the interactive composer always calls the live API.
+
+A replay writes state.db and the caches as a live run does. Replay from a
+scratch copy of the working directory so every run starts from the same
+state.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+# Arguments that do not identify a Gmail call: response shaping, the caller,
+# request bodies, and search text that embeds today's date
+_IGNORED_ARGS = {"userId", "fields", "body", "q"}
+# Gmail resources reached by calling them with no arguments: users().messages()
+_RESOURCES = {"users", "messages", "drafts", "threads", "history"}
+
+_recorder: Optional["Recorder"] = None
+_capture: Optional["Capture"] = None
+
+
+def _gmail_key(kwargs: Dict[str, Any]) -> str:
+    return json.dumps({k: v for k, v in kwargs.items() if k not in _IGNORED_ARGS}, sort_keys=True)
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _prompt_keys(messages: List[Dict[str, str]]):
+    """(key for the whole prompt, key for its system instruction)."""
+    system = next((m["content"] for m in messages if m["role"] == "system"), "")
+    return _digest(json.dumps(messages, sort_keys=True)), _digest(system)
+
+
+def _error_record(error: Exception) -> Dict[str, Any]:
+    from ratelimit import _status
+
+    return {"status": _status(error), "message": str(error)[:500]}
+
+
+class ReplayedHttpError(Exception):
+    """A recorded API failure, shaped like both HttpError (resp.status) and openai's errors (status_code)."""
+
+    def __init__(self, status: Optional[int], message: str = ""):
+        super().__init__(message or f"HTTP {status}")
+        self.status_code = status
+        self.resp = SimpleNamespace(status=status, get=lambda *_: None)
+
+
+class Recorder:
+    """Appends records to a gzip JSONL file; safe to call from any thread."""
+
+    def __init__(self, path: str):
+        import atexit
+        import gzip
+
+        self.path = path
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.records = 0
+        atexit.register(self.close)
+
+    def write(self, api: str, method: str, key: str, latency: float, response=None, error=None, **extra):
+        record = {
+            "t": round(time.monotonic() - self._start, 4),
+            "api": api,
+            "method": method,
+            "key": key,
+            "latency": round(latency, 4),
+        }
+        if error is not None:
+            record["error"] = _error_record(error)
+        else:
+            record["response"] = response
+        record.update(extra)
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+                self.records += 1
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class Capture:
+    """Recorded responses, served in order per call."""
+
+    def __init__(self, path: str, speed: float = 1.0):
+        import gzip
+
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._calls: Dict[tuple, deque] = {}
+        # Completions by system instruction, for prompts that were not recorded
+        self._by_instruction: Dict[str, List[dict]] = {}
+        self._next_for_instruction: Dict[str, int] = {}
+        self.served = 0
+        self.misses = 0
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self._calls.setdefault((record["api"], record["method"], record["key"]), deque()).append(record)
+                if record["api"] == "openai":
+                    self._by_instruction.setdefault(record["instruction"], []).append(record)
+
+    def take(self, api: str, method: str, key: str, instruction: str | None = None) -> Optional[dict]:
+        with self._lock:
+            calls = self._calls.get((api, method, key))
+            if calls:
+                record = calls.popleft() if len(calls) > 1 else calls[0]
+            elif instruction in self._by_instruction:
+                records = self._by_instruction[instruction]
+                idx = self._next_for_instruction.get(instruction, 0)
+                self._next_for_instruction[instruction] = idx + 1
+                record = records[idx % len(records)]
+            else:
+                self.misses += 1
+                return None
+            self.served += 1
+            return record
+
+    def delay(self, latency: float) -> float:
+        """Seconds to wait for a call that took `latency`; speed <= 0 means no waiting."""
+        return latency / self.speed if self.speed > 0 else 0.0
+
+
+def _served(record: Optional[dict], method: str):
+    """The recorded response, or the recorded failure raised."""
+    if record is None:
+        raise ReplayedHttpError(404, f"{method}: no such call in the capture")
+    if "error" in record:
+        raise ReplayedHttpError(record["error"]["status"], record["error"]["message"])
+    return copy.deepcopy(record["response"])
+
+
+def _record(*args, **kwargs):
+    # Wrapped clients outlive stop_recording(); later calls go unrecorded
+    recorder = _recorder
+    if recorder is not None:
+        recorder.write(*args, **kwargs)
+
+
+# --- Gmail: recording ---------------------------------------------------------
+
+class _RecordingRequest:
+    def __init__(self, request, method: str, kwargs: Dict[str, Any]):
+        self.request = request
+        self.method = method
+        self.key = _gmail_key(kwargs)
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.request.execute(*args, **kwargs)
+        except Exception as e:
+            _record("gmail", self.method, self.key, time.perf_counter() - start, error=e)
+            raise
+        _record("gmail", self.method, self.key, time.perf_counter() - start, response)
+        return response
+
+
+class _RecordingBatch:
+    """Records each call in a batch once the batch returns, all with the batch's latency."""
+
+    def __init__(self, factory, callback):
+        self._callback = callback
+        self._requests: Dict[str, tuple] = {}
+        self._results: List[tuple] = []
+        self._batch = factory(callback=self._on_response)
+
+    def add(self, request: _RecordingRequest, request_id: str | None = None, callback=None):
+        request_id = request_id or str(len(self._requests))
+        self._requests[request_id] = (request, callback or self._callback)
+        self._batch.add(request.request, request_id=request_id)
+
+    def _on_response(self, request_id, response, exception):
+        self._results.append((request_id, response, exception))
+
+    def execute(self, *args, **kwargs):
+        self._results = []
+        start = time.perf_counter()
+        self._batch.execute(*args, **kwargs)
+        latency = time.perf_counter() - start
+        for request_id, response, exception in self._results:
+            request, callback = self._requests[request_id]
+            _record("gmail", request.method, request.key, latency, response, exception, batch=True)
+            callback(request_id, response, exception)
+
+
+class _RecordingResource:
+    def __init__(self, target, path: str = ""):
+        self._target = target
+        self._path = path
+
+    def new_batch_http_request(self, callback=None):
+        return _RecordingBatch(self._target.new_batch_http_request, callback)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        method = f"{self._path}.{name}" if self._path and self._path != "users" else name
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if name in _RESOURCES:
+                return _RecordingResource(result, method)
+            return _RecordingRequest(result, method, kwargs)
+
+        return call
+
+
+# --- Gmail: replay ------------------------------------------------------------
+
+class _ReplayRequest:
+    def __init__(self, method: str, kwargs: Dict[str, Any]):
+        self.method = method
+        self.key = _gmail_key(kwargs)
+
+    def execute(self, *args, **kwargs):
+        record = _capture.take("gmail", self.method, self.key)
+        if record is not None:
+            time.sleep(_capture.delay(record["latency"]))
+        return _served(record, self.method)
+
+
+class _ReplayBatch:
+    def __init__(self, callback):
+        self._callback = callback
+        self._requests: List[tuple] = []
+
+    def add(self, request: _ReplayRequest, request_id: str | None = None, callback=None):
+        self._requests.append((request_id or str(len(self._requests)), request, callback or self._callback))
+
+    def execute(self, *args, **kwargs):
+        records = [_capture.take("gmail", request.method, request.key) for _, request, _ in self._requests]
+        time.sleep(_capture.delay(max((r["latency"] for r in records if r), default=0.0)))
+        for (request_id, request, callback), record in zip(self._requests, records):
+            try:
+                response, error = _served(record, request.method), None
+            except ReplayedHttpError as e:
+                response, error = None, e
+            callback(request_id, response, error)
+
+
+class _ReplayResource:
+    def __init__(self, path: str = ""):
+        self._path = path
+
+    def new_batch_http_request(self, callback=None):
+        return _ReplayBatch(callback)
+
+    def __getattr__(self, name: str):
+        method = f"{self._path}.{name}" if self._path and self._path != "users" else name
+
+        def call(*args, **kwargs):
+            if name in _RESOURCES:
+                return _ReplayResource(method)
+            return _ReplayRequest(method, kwargs)
+
+        return call
+
+
+# --- OpenAI -------------------------------------------------------------------
+
+def _completion_response(content: str, usage: Dict[str, int]):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(**usage),
+    )
+
+
+class _RecordingCompletions:
+    def __init__(self, completions):
+        self._completions = completions
+
+    async def create(self, messages, **kwargs):
+        key, instruction = _prompt_keys(messages)
+        start = time.perf_counter()
+        try:
+            resp = await self._completions.create(messages=messages, **kwargs)
+        except Exception as e:
+            _record("openai", "chat.completions", key, time.perf_counter() - start,
+                            error=e, instruction=instruction)
+            raise
+        usage = getattr(resp, "usage", None)
+        response = {
+            "content": resp.choices[0].message.content or "",
+            "usage": {
+                "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+                "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            },
+        }
+        _record("openai", "chat.completions", key, time.perf_counter() - start, response,
+                        instruction=instruction)
+        return resp
+
+
+class _ReplayCompletions:
+    async def create(self, messages, **kwargs):
+        import asyncio
+
+        key, instruction = _prompt_keys(messages)
+        record = _capture.take("openai", "chat.completions", key, instruction)
+        if record is not None:
+            await asyncio.sleep(_capture.delay(record["latency"]))
+        response = _served(record, "chat.completions")
+        return _completion_response(response["content"], response["usage"])
+
+
+# --- Switches -----------------------------------------------------------------
+
+def start_recording(path: str) -> Recorder:
+    """Record every Gmail service and async OpenAI client created from now on to path."""
+    global _recorder
+    _recorder = Recorder(path)
+    return _recorder
+
+
+def stop_recording():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def start_replay(path: str, speed: float = 1.0) -> Capture:
+    """Serve Gmail and OpenAI calls from the capture at path, `speed` times faster than recorded."""
+    global _capture
+    _capture = Capture(path, speed)
+    return _capture
+
+
+def stop_replay():
+    global _capture
+    _capture = None
+
+
+def replaying() -> bool:
+    return _capture is not None
+
+
+def gmail_service():
+    """A stand-in Gmail service answering from the capture."""
+    return _ReplayResource()
+
+
+def wrap_gmail(service):
+    """service, recorded if recording is on."""
+    return _RecordingResource(service) if _recorder is not None else service
+
+
+def chat_client():
+    """A stand-in AsyncOpenAI answering from the capture."""
+    return SimpleNamespace(chat=SimpleNamespace(completions=_ReplayCompletions()))
+
+
+def wrap_chat(client):
+    """client, recorded if recording is on."""
+    if _recorder is None:
+        return client
+    return SimpleNamespace(chat=SimpleNamespace(completions=_RecordingCompletions(client.chat.completions)))
+
+
+def summarize(path: str) -> Dict[str, Dict[str, float]]:
+    """Calls, errors and total / mean latency per method in a capture."""
+    import gzip
+
+    summary: Dict[str, Dict[str, float]] = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            row = summary.setdefault(f"{record['api']} {record['method']}", {"calls": 0, "errors": 0, "seconds": 0.0})
+            row["calls"] += 1
+            row["errors"] += "error" in record
+            row["seconds"] += record["latency"]
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a recorded traffic capture.")
+    parser.add_argument("capture")
+    args = parser.parse_args()
+
+    for method, row in sorted(summarize(args.capture).items()):
+        mean = row["seconds"] / row["calls"] * 1000
+        print(f"{method}: {row['calls']} call(s), {row['errors']} error(s), mean {mean:.1f} ms")
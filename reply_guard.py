@@ -48,6 +48,34 @@ CLOSURE_PHRASES = [
 ]
 
 
+# Auto-responder markers, checked in the subject and in the body
+OUT_OF_OFFICE_SUBJECT_PHRASES = ["out of office", "automatic reply"]
+OUT_OF_OFFICE_BODY_PHRASES = ["out of office", "auto-reply", "automatic reply"]
+
+
+def _compile_any(patterns):
+    """One compiled alternation, so each body is scanned once per rule group."""
+    return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+
+def _contains_any(text: str, phrases) -> bool:
+    # CPython's substring search beats a regex alternation (and a pure-Python
+    # Aho-Corasick) for short literal phrase lists like these.
+    for phrase in phrases:
+        if phrase in text:
+            return True
+    return False
+
+
+_CLOSING_RE = _compile_any(CLOSING_PATTERNS)
+_DEFER_RE = _compile_any(DEFER_PATTERNS)
+_SYSTEM_RE = _compile_any(SYSTEM_PATTERNS)
+_CLOSURE_PHRASES = tuple(CLOSURE_PHRASES)
+_OOO_SUBJECT_PHRASES = tuple(OUT_OF_OFFICE_SUBJECT_PHRASES)
+_OOO_BODY_PHRASES = tuple(OUT_OF_OFFICE_BODY_PHRASES)
+_THANKS_PHRASES = ("thanks", "thank you")
+
+
 def _normalize(text: str) -> str:
     return (text or "").strip().lower()
 
@@ -56,25 +84,27 @@ def _contains_question(text: str) -> bool:
     return "?" in text
 
 
-def is_closing_ack(body: str) -> bool:
-    """
-    Returns True for very short closure messages like:
-    'thanks', 'ok', 'noted', etc.
-    """
-    norm = _normalize(body)
-
+def _is_closing_ack(norm: str) -> bool:
     # Only treat as closure if the message is short
-    if len(norm) <= 80:
-        for pattern in CLOSING_PATTERNS:
-            if re.match(pattern, norm):
-                return True
+    if len(norm) <= 80 and _CLOSING_RE.match(norm):
+        return True
 
     # Detect short gratitude messages like:
     # "thanks for the update" -> still closure
-    if ("thanks" in norm or "thank you" in norm) and len(norm.split()) <= 6:
-        return True
+    # maxsplit keeps this O(1) words for long bodies; the count is unchanged
+    return _contains_any(norm, _THANKS_PHRASES) and len(norm.split(None, 6)) <= 6
 
-    return False
+
+def _is_polite_closure_without_question(norm: str) -> bool:
+    return not _contains_question(norm) and _contains_any(norm, _CLOSURE_PHRASES)
+
+
+def is_closing_ack(body: str) -> bool:
+    """
+    Returns True for very short closure messages like:
+    'thanks', 'ok', 'noted', etc.
+    """
+    return _is_closing_ack(_normalize(body))
 
 
 def is_defer_then_close(body: str) -> bool:
@@ -82,22 +112,14 @@ def is_defer_then_close(body: str) -> bool:
     Returns True if the sender is saying they will act later and continue.
     Example: 'I will reach out and get back to you.'
     """
-    norm = _normalize(body)
-    for pattern in DEFER_PATTERNS:
-        if re.search(pattern, norm):
-            return True
-    return False
+    return bool(_DEFER_RE.search(_normalize(body)))
 
 
 def is_system_like(body: str) -> bool:
     """
     Returns True if message appears to come from a system or automated process.
     """
-    norm = _normalize(body)
-    for pattern in SYSTEM_PATTERNS:
-        if re.search(pattern, norm):
-            return True
-    return False
+    return bool(_SYSTEM_RE.search(_normalize(body)))
 
 
 def is_polite_closure_without_question(body: str) -> bool:
@@ -108,58 +130,57 @@ def is_polite_closure_without_question(body: str) -> bool:
     Example: 'Thank you for your quick response. Please feel free to reach out
     whenever you are ready to discuss further.'
     """
-    norm = _normalize(body)
+    return _is_polite_closure_without_question(_normalize(body))
 
-    if _contains_question(norm):
-        return False
 
-    for phrase in CLOSURE_PHRASES:
-        if phrase in norm:
-            return True
-
-    return False
-
-
-def should_generate_reply(subject: str, body: str) -> bool:
+def reply_block_reason(subject: str, body: str) -> str | None:
     """
-    Determines if the AI should generate a reply at all.
-    Returns False when:
-    - Message is empty
-    - Out-of-office / automatic reply
-    - System / notification email
-    - Simple closure ('thanks', 'got it', etc.)
-    - Sender indicates they will get back to you
-    - Sender sends a polite closure with no question and phrases like
-      'feel free to reach out whenever you are ready'
+    Name of the first rule that says no reply is needed, or None when it is
+    safe to generate one. Subject and body are normalized exactly once.
+
+    Rules, in order: "empty", "out_of_office", "system", "closing_ack",
+    "defer", "polite_closure".
     """
     norm_subject = _normalize(subject)
     norm_body = _normalize(body)
 
     # Empty or blank messages do not need replies
     if not norm_body:
-        return False
+        return "empty"
 
     # Out-of-office or auto-responses
-    if "out of office" in norm_subject or "automatic reply" in norm_subject:
-        return False
-    if "out of office" in norm_body or "auto-reply" in norm_body or "automatic reply" in norm_body:
-        return False
+    if _contains_any(norm_subject, _OOO_SUBJECT_PHRASES) or _contains_any(norm_body, _OOO_BODY_PHRASES):
+        return "out_of_office"
 
     # System emails or notification emails
-    if is_system_like(norm_body):
-        return False
+    if _SYSTEM_RE.search(norm_body):
+        return "system"
 
     # One-line closure like "thanks", "got it", etc.
-    if is_closing_ack(norm_body):
-        return False
+    if _is_closing_ack(norm_body):
+        return "closing_ack"
 
     # Sender indicates THEY will continue the conversation later
-    if is_defer_then_close(norm_body):
-        return False
+    if _DEFER_RE.search(norm_body):
+        return "defer"
 
     # Polite closure like your screenshot example
-    if is_polite_closure_without_question(norm_body):
-        return False
+    if _is_polite_closure_without_question(norm_body):
+        return "polite_closure"
+
+    return None
 
-    # Otherwise it is safe to generate a reply
-    return True
+
+def should_generate_reply(subject: str, body: str) -> bool:
+    """
+    Determines if the AI should generate a reply at all.
+    Returns False when:
+    - Message is empty
+    - Out-of-office / automatic reply
+    - System / notification email
+    - Simple closure ('thanks', 'got it', etc.)
+    - Sender indicates they will get back to you
+    - Sender sends a polite closure with no question and phrases like
+      'feel free to reach out whenever you are ready'
+    """
+    return reply_block_reason(subject, body) is None
@@ -1,6 +1,18 @@
 from email.utils import parseaddr
 
-from config import AUTO_SEND_EMAILS, AUTO_SEND_DOMAINS
+from config import AUTO_SEND_EMAILS, AUTO_SEND_DOMAINS, NO_CACHE_EMAILS, NO_CACHE_DOMAINS
+
+NOREPLY_PATTERNS = (
+    "no-reply",
+    "noreply",
+    "do-not-reply",
+    "donotreply",
+    "no_reply",
+    "noresponse",
+    "no-response",
+    "mailer-daemon",
+    "postmaster",
+)
 
 
 def is_noreply_address(addr: str) -> bool:
@@ -8,18 +20,7 @@ def is_noreply_address(addr: str) -> bool:
     True if address looks like a no-reply / system email.
     """
     addr_lower = (addr or "").lower()
-    patterns = [
-        "no-reply",
-        "noreply",
-        "do-not-reply",
-        "donotreply",
-        "no_reply",
-        "noresponse",
-        "no-response",
-        "mailer-daemon",
-        "postmaster",
-    ]
-    return any(p in addr_lower for p in patterns)
+    return any(p in addr_lower for p in NOREPLY_PATTERNS)
 
 
 def normalize_email_from_header(from_header: str) -> str:
@@ -48,3 +49,48 @@ def should_auto_send(sender_header: str) -> bool:
             return True
 
     return False
+
+
+def is_cache_opt_out(sender_header: str) -> bool:
+    """
+    Return True if replies to this sender must never come from the LLM cache.
+    Controlled via NO_CACHE_EMAILS and NO_CACHE_DOMAINS.
+    """
+    addr = normalize_email_from_header(sender_header)
+    if not addr:
+        return False
+
+    if addr in NO_CACHE_EMAILS:
+        return True
+
+    if "@" in addr:
+        domain = addr.split("@")[-1]
+        if domain in NO_CACHE_DOMAINS:
+            return True
+
+    return False
+
+
+def is_automated_message(list_unsubscribe: str, auto_submitted: str) -> bool:
+    """
+    True for bulk or machine-generated mail, judged from headers alone.
+    List-Unsubscribe marks newsletters and mailing lists; Auto-Submitted
+    (RFC 3834) is set by autoresponders to anything other than 'no'.
+    """
+    if (list_unsubscribe or "").strip():
+        return True
+    value = (auto_submitted or "").strip().lower()
+    return bool(value) and value != "no"
+
+
+def metadata_skip_reason(meta: dict) -> str | None:
+    """
+    Guards that only need headers, run before the message body is fetched.
+    `meta` is gmail_client.extract_metadata() output. Returns why the message
+    should be skipped, or None to keep it.
+    """
+    if is_noreply_address(meta.get("from", "")):
+        return "No-reply or system sender"
+    if is_automated_message(meta.get("list_unsubscribe", ""), meta.get("auto_submitted", "")):
+        return "Bulk or auto-submitted message"
+    return None
@@ -0,0 +1,121 @@
+"""
+Sandra's command line.
+
+    python sandra.py scan                      # one-shot scan of today's unread mail
+    python sandra.py scan --backlog --after 2024/01/01
+    python sandra.py watch --interval 10       # poll the inbox and auto-reply
+    python sandra.py watch --metrics-port 9108 # ... and serve /metrics
+    python sandra.py compose                   # draft and send a new email
+    python sandra.py                           # interactive menu
+    python sandra.py --record day.jsonl.gz watch          # capture Gmail / OpenAI traffic
+    python sandra.py --replay day.jsonl.gz --speed 10 scan  # re-run it offline, 10x faster
+
+Subcommands import what they use when they run, and the Gmail and OpenAI
+client libraries load on the first API call, so --help and the menu start
+without paying for either.
+"""
+import argparse
+import signal
+import sys
+
+
+def cmd_scan(args):
+    import main
+
+    if args.backlog:
+        main.drain_backlog(args.query, args.after, args.before, args.page_size)
+    else:
+        main.main()
+
+
+def cmd_watch(args):
+    from watch import watch_inbox
+
+    options = {}
+    if args.metrics_port is not None:
+        # Otherwise watch_inbox falls back to config.METRICS_PORT
+        options["metrics_port"] = args.metrics_port
+    watch_inbox(interval=args.interval, use_history=not args.no_history, **options)
+
+
+def cmd_compose(args):
+    from watch import send_email_interactive
+
+    send_email_interactive(stream=not args.no_stream)
+
+
+def interactive_menu(args=None):
+    print("What would you like to do?")
+    print("1. Send Email")
+    print("2. Watch Inbox and Auto-Reply")
+    print()
+
+    choice = input("Enter number of action here (1 or 2): ").strip()
+
+    if choice == "1":
+        from watch import send_email_interactive
+
+        send_email_interactive()
+    elif choice == "2":
+        from watch import watch_inbox
+
+        watch_inbox(interval=2)
+    else:
+        print("Invalid choice. Exiting.")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="sandra", description="Sandra email assistant.")
+    parser.set_defaults(func=interactive_menu)
+    parser.add_argument("--record", metavar="CAPTURE", help="record Gmail and OpenAI traffic to a .jsonl.gz file")
+    parser.add_argument("--replay", metavar="CAPTURE", help="answer Gmail and OpenAI calls from a recorded capture")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay this many times faster than recorded; 0 for no delays")
+    commands = parser.add_subparsers(title="commands")
+
+    scan = commands.add_parser("scan", help="one-shot unread inbox scan")
+    scan.add_argument("--backlog", action="store_true", help="drain every unread message, not just today's first 10")
+    scan.add_argument("--query", default="", help="extra Gmail search query for --backlog")
+    scan.add_argument("--after", help="only messages after YYYY/MM/DD (--backlog)")
+    scan.add_argument("--before", help="only messages before YYYY/MM/DD (--backlog)")
+    scan.add_argument("--page-size", type=int, default=100)
+    scan.set_defaults(func=cmd_scan)
+
+    watch = commands.add_parser("watch", help="watch the inbox and auto-reply")
+    watch.add_argument("--interval", type=int, default=10, help="seconds between polls")
+    watch.add_argument("--no-history", action="store_true", help="re-list unread mail instead of using the History API")
+    watch.add_argument("--metrics-port", type=int, help="serve Prometheus metrics at http://localhost:PORT/metrics (default: config.METRICS_PORT)")
+    watch.set_defaults(func=cmd_watch)
+
+    compose = commands.add_parser("compose", help="draft a new email with the composer and send it")
+    compose.add_argument("--no-stream", action="store_true", help="wait for the whole draft instead of streaming it")
+    compose.set_defaults(func=cmd_compose)
+
+    return parser
+
+
+def _exit_on_sigterm(signum, frame):
+    # systemd and Docker stop with SIGTERM, which skips atexit by default;
+    # exiting normally runs the finally blocks and atexit hooks that flush
+    # queued mark-as-read changes
+    sys.exit(128 + signum)
+
+
+def main(argv=None):
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
+    if args.record or args.replay:
+        import replay
+
+        if args.record:
+            replay.start_recording(args.record)
+        else:
+            replay.start_replay(args.replay, args.speed)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
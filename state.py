@@ -1,14 +1,146 @@
+"""
+Watcher state, stored in SQLite.
+
+Processed message ids live in their own indexed table, so recording one
+message is a single-row insert instead of a rewrite of the whole history.
+Other values (history_id, backlog_cursor, ...) are JSON in a key/value
+table. Every write is one transaction, so a crash never leaves a half
+written file behind.
+
+An existing state.json is imported on first use and renamed to
+state.json.migrated.
+"""
 import json
 import os
+import sqlite3
+import threading
+import time
+
+import metrics
 
 STATE_FILE = "state.json"
+STATE_DB = "state.db"
 
-def load_state():
+# Processed ids older than this are pruned; Gmail history sync never
+# reports them again.
+RETENTION_DAYS = 30
+
+_conn = None
+_lock = threading.Lock()
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS processed ("
+        " id TEXT PRIMARY KEY, processed_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS processed_at_idx ON processed (processed_at)"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.commit()
+    return conn
+
+
+def _connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = _open(STATE_DB)
+        _migrate_json(_conn)
+    return _conn
+
+
+def _migrate_json(conn: sqlite3.Connection):
     if not os.path.exists(STATE_FILE):
-        return {"processed_ids": []}
+        return
     with open(STATE_FILE, "r") as f:
-        return json.load(f)
+        old = json.load(f)
+    _write(conn, old.pop("processed_ids", []), old)
+    os.replace(STATE_FILE, STATE_FILE + ".migrated")
+    print(f"[STATE] Migrated {STATE_FILE} to {STATE_DB}.")
+
+
+def _write(conn: sqlite3.Connection, processed_ids, values: dict):
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO processed (id, processed_at) VALUES (?, ?)",
+            ((msg_id, now) for msg_id in processed_ids),
+        )
+        for key, value in values.items():
+            if value is None:
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (key, json.dumps(value)),
+                )
+
+
+def load_state():
+    with _lock:
+        conn = _connection()
+        state = {
+            key: json.loads(value)
+            for key, value in conn.execute("SELECT key, value FROM kv")
+        }
+        state["processed_ids"] = [row[0] for row in conn.execute("SELECT id FROM processed")]
+    return state
+
 
 def save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+    """
+    Merge a whole state dict into the store in one transaction.
+    Prefer record_progress() on hot paths; this touches every processed id.
+    """
+    values = {k: v for k, v in state.items() if k != "processed_ids"}
+    with metrics.timed("sandra_step_seconds", step="save_state"), _lock:
+        _write(_connection(), state.get("processed_ids", []), values)
+
+
+def record_progress(processed_ids=(), **values):
+    """
+    Atomically add processed ids and set state values. A value of None
+    deletes the key. Cost is proportional to what changed, not to history.
+    """
+    with metrics.timed("sandra_step_seconds", step="record_progress"), _lock:
+        _write(_connection(), processed_ids, values)
+
+
+def prune_processed(retention_days: float = RETENTION_DAYS) -> int:
+    """Delete processed ids older than the retention window."""
+    cutoff = time.time() - retention_days * 86400
+    with _lock:
+        conn = _connection()
+        with conn:
+            cur = conn.execute("DELETE FROM processed WHERE processed_at < ?", (cutoff,))
+    return cur.rowcount
+
+
+def compact():
+    """Prune old ids and fold the write-ahead log back into the database."""
+    removed = prune_processed()
+    with _lock:
+        _connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return removed
+
+
+def start_compaction(interval: float = 3600.0) -> threading.Thread:
+    """Run compact() every `interval` seconds on a daemon thread."""
+
+    def _run():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = compact()
+                if removed:
+                    print(f"[STATE] Compacted: pruned {removed} old processed id(s).")
+            except Exception as e:
+                print("[STATE] Compaction failed:", e)
+
+    thread = threading.Thread(target=_run, name="state-compaction", daemon=True)
+    thread.start()
+    return thread
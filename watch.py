@@ -1,99 +1,209 @@
 import time
 
-from state import load_state, save_state
+import metrics
+import ratelimit
+from config import METRICS_PORT, OUTBOX_FILE, WATCH_RETRY_LIMIT, WATCH_RETRY_MAX_DELAY
+from state import load_state, record_progress, start_compaction
 from gmail_client import (
     get_gmail_service,
+    start_token_refresher,
     list_unread_messages,
-    get_message_detail,
-    extract_email_data,
-    mark_as_read,
-    create_reply_draft,
-    send_reply,
+    sync_unread_messages,
+    extract_metadata,
+    FetchStats,
+    report_response_sizes,
+    LabelMutationQueue,
     send_new_email,         
 )
 from agent_sandra import (
+    butler_cache,
+    usage_stats,
     call_email_butler,
     compose_email_from_context,   
+    compose_email_streaming,
 )
-from rules import is_noreply_address, should_auto_send
-from reply_guard import should_generate_reply
-
-
-def watch_inbox(interval: int = 10):
+from outbox import Outbox, report_delivered
+from pipeline import ServicePool, process_messages
+
+
+def watch_inbox(interval: int = 10, use_history: bool = True, metrics_port: int | None = METRICS_PORT):
+    """
+    Poll the inbox and reply to new mail.
+
+    With use_history=True (default) each poll asks the Gmail History API for
+    messages added since the stored historyId instead of re-running the
+    unread search, so an idle poll is one small request. New messages go
+    through the concurrent pipeline in pipeline.py. Metrics are written to
+    METRICS_FILE after every cycle and, with metrics_port, served over HTTP.
+    Replies are stored in the outbox (OUTBOX_FILE) and delivered in the
+    background; anything an earlier run left undelivered is sent first.
+    """
     print(f"Watching inbox every {interval} seconds...")
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+        print(f"Serving metrics at http://localhost:{metrics_port}/metrics")
 
     state = load_state()
     processed = set(state.get("processed_ids", []))
+    start_compaction()
 
     service = get_gmail_service()
+    pool = ServicePool(get_gmail_service)
+    labels = LabelMutationQueue(service)
+    start_token_refresher()
+    outbox = Outbox(OUTBOX_FILE, on_delivered=report_delivered)
+    resumed = outbox.start(pool)
+    if resumed:
+        print(f"[OUTBOX] Resuming {resumed} undelivered repl{'y' if resumed == 1 else 'ies'} from an earlier run.")
+
+    try:
+        _watch_loop(service, pool, labels, outbox, state, processed, interval, use_history)
+    finally:
+        # Never leave processed messages UNREAD on shutdown
+        labels.flush()
+        # Anything still undelivered stays in the outbox for the next start
+        outbox.flush(timeout=30)
+
+
+def _report(item):
+    print("\n==============================")
+    if item.error is not None:
+        print(f"Could not process message {item.msg_id}: {item.error}")
+        return
+
+    if item.outcome == "gone":
+        print(f"Message {item.msg_id} no longer exists ({item.reason}); skipping.")
+        return
+
+    # Guard 1: sender / header checks, decided from metadata only
+    if item.outcome == "skipped":
+        meta = extract_metadata(item.msg)
+        print(f"NEW EMAIL: {meta['subject']} FROM {meta['from']}")
+        print(f"[GUARD] {item.reason}. Skipping reply.")
+        print("Queued mark as read.")
+        return
+
+    record = item.record
+    print(f"NEW EMAIL: {record.subject} FROM {record.sender}")
+    if item.coalesced:
+        print(f"[THREAD] Coalesced {len(item.coalesced)} earlier unread message(s) into one reply.")
+    print("BODY (truncated preview):")
+    print(record.body[:300])
+    print()
+
+    # Guard 2: closure / acknowledgement / system-like content
+    if item.outcome == "blocked":
+        print(f"[GUARD] No reply needed based on content ({item.reason}).")
+    elif item.outcome == "classified":
+        print(f"[TIER] Classified as {item.result.klass}; no draft needed.")
+    else:
+        print(f"[PROMPT] Trimmed ~{item.tokens_saved} tokens before the LLM call.")
+        print("Summary:")
+        print(item.result.summary)
+        print("Draft reply:")
+        print(item.result.draft_reply)
+        print()
+        if item.resumed:
+            print("Reply was already stored by an earlier run; not generating another.")
+        elif item.gmail_id is None:
+            print(f"Reply stored in the outbox for {'sending' if item.outcome == 'sent' else 'drafting'}.")
+        elif item.outcome == "sent":
+            print(f"Auto-sent reply. Gmail ID: {item.gmail_id}")
+        else:
+            print(f"Draft created. ID: {item.gmail_id}")
+
+    print("Queued mark as read.")
+
+
+def _update_retries(retry, attempted, failed, threads, processed, interval):
+    """
+    The retry schedule after a cycle: msg_id -> {attempts, next_at,
+    thread_id}. Ids that succeeded are dropped; failed ones back off, and
+    after WATCH_RETRY_LIMIT attempts are given up on and recorded as
+    processed so no later poll picks them up again.
+    """
+    retry = {msg_id: entry for msg_id, entry in retry.items() if msg_id not in processed}
+    attempted = set(attempted)
+    gave_up = []
+    for msg_id in failed:
+        if msg_id not in attempted:
+            continue
+        attempts = retry.get(msg_id, {}).get("attempts", 0) + 1
+        if attempts >= WATCH_RETRY_LIMIT:
+            retry.pop(msg_id, None)
+            gave_up.append(msg_id)
+            continue
+        retry[msg_id] = {
+            "attempts": attempts,
+            "next_at": time.time() + min(interval * 2 ** attempts, WATCH_RETRY_MAX_DELAY),
+            "thread_id": threads.get(msg_id),
+        }
+    if gave_up:
+        print(f"[RETRY] Giving up on {len(gave_up)} message(s) after {WATCH_RETRY_LIMIT} attempts;"
+              f" leaving them unread: {gave_up}")
+        record_progress(gave_up)
+        processed.update(gave_up)
+    return retry
+
+
+def _watch_loop(service, pool, labels, outbox, state, processed, interval, use_history):
+    stats = FetchStats()
 
     while True:
         try:
-            messages = list_unread_messages(service, max_results=10)
-
-            if messages:
-                for m in messages:
-                    msg_id = m["id"]
-
-                    # Skip already processed emails
-                    if msg_id in processed:
-                        continue
-
-                    full_msg = get_message_detail(service, msg_id)
-                    email_data = extract_email_data(full_msg)
-
-                    sender = email_data["from"]
-                    subject = email_data["subject"]
-                    body = email_data["body"]
-
-                    print("\n==============================")
-                    print(f"NEW EMAIL: {subject} FROM {sender}")
-                    print("BODY (truncated preview):")
-                    print((body or "")[:300])
-                    print()
-
-                    # Guard 1: no-reply / system sender
-                    if is_noreply_address(sender):
-                        print("[GUARD] No-reply or system sender. Skipping reply.")
-                        mark_as_read(service, msg_id)
-                        print("Marked as read.")
-                        processed.add(msg_id)
-                        state["processed_ids"] = list(processed)
-                        save_state(state)
-                        continue
-
-                    # Guard 2: closure / acknowledgement / system-like content
-                    if not should_generate_reply(subject, body):
-                        print("[GUARD] No reply needed based on content.")
-                        mark_as_read(service, msg_id)
-                        print("Marked as read.")
-                        processed.add(msg_id)
-                        state["processed_ids"] = list(processed)
-                        save_state(state)
-                        continue
-
-                    # Safe to reply
-                    result = call_email_butler(subject, sender, body)
-
-                    print("Summary:")
-                    print(result.summary)
-                    print("Draft reply:")
-                    print(result.draft_reply)
-                    print()
-
-                    if should_auto_send(sender):
-                        sent = send_reply(service, full_msg, result.draft_reply)
-                        print(f"Auto-sent reply. Gmail ID: {sent.get('id')}")
-                    else:
-                        draft = create_reply_draft(service, full_msg, result.draft_reply)
-                        print(f"Draft created. ID: {draft.get('id')}")
-
-                    mark_as_read(service, msg_id)
-                    print("Marked as read.")
-
-                    processed.add(msg_id)
-                    state["processed_ids"] = list(processed)
-                    save_state(state)
+            with metrics.timed("sandra_step_seconds", step="list_unread_messages"):
+                if use_history:
+                    messages, history_id = sync_unread_messages(
+                        service, state.get("history_id"), max_results=10
+                    )
+                else:
+                    messages, history_id = list_unread_messages(service, max_results=10), None
+            failed = []
+
+            # Failed messages wait for their retry slot; history never reports them again
+            retry = state.get("retry") or {}
+            now = time.time()
+            due = [msg_id for msg_id, entry in retry.items() if entry["next_at"] <= now and msg_id not in processed]
+
+            # Skip already processed emails before fetching anything
+            new_ids = [m["id"] for m in messages if m["id"] not in processed and m["id"] not in retry]
+            threads = {m["id"]: m.get("threadId") for m in messages}
+            threads.update({msg_id: retry[msg_id].get("thread_id") for msg_id in due})
+
+            if new_ids or due:
+                # Several new replies in one thread get a single reply
+                failed = process_messages(
+                    pool, labels, new_ids + due, call_email_butler,
+                    report=_report, processed=processed, stats=stats,
+                    threads=threads, outbox=outbox,
+                )
+
+                print(f"[FETCH] {stats}")
+                stats.reset()
+                report_response_sizes()
+                print(f"[CACHE] {butler_cache.stats()}")
+                for line in usage_stats.report():
+                    print(f"[TOKENS] {line}")
+                print(f"[QUOTA] {ratelimit.gauges()}")
+                print(f"[OUTBOX] {outbox.stats()}")
+                for line in metrics.summary_lines():
+                    print(f"[STAGE] {line}")
+
+            # One batchModify per poll cycle instead of one modify per message
+            labels.flush()
+
+            # Failures are kept in the retry schedule, so the sync point always moves on
+            updated = _update_retries(retry, new_ids + due, failed, threads, processed, interval)
+            values = {}
+            if history_id and history_id != state.get("history_id"):
+                values["history_id"] = history_id
+            if updated != retry:
+                values["retry"] = updated or None
+            if values:
+                state.update(values)
+                record_progress(**values)
+
+            metrics.write_textfile()
 
         except Exception as e:
             print("Error in watcher:", e)
@@ -101,7 +211,7 @@ def watch_inbox(interval: int = 10):
         time.sleep(interval)
 
 
-def send_email_interactive():
+def send_email_interactive(stream: bool = True):
     to_email = input("Enter recipient email address: ").strip()
     if not to_email:
         print("No email entered. Aborting.")
@@ -119,13 +229,34 @@ def send_email_interactive():
         print("No context entered. Aborting.")
         return
 
-    result = compose_email_from_context(
-        context=mail_context,
-        relationship=relationship,
-        mood=mood,
-        recipient_email=to_email,
-        sender_name=sender_name,
-    )
+    sections = []
+
+    def print_streamed(section, text):
+        if not sections or sections[-1] != section:
+            sections.append(section)
+            print("\nSubject:" if section == "subject" else "\nBody:")
+        print(text, end="", flush=True)
+
+    if stream:
+        print("\n=== Drafting ===")
+        result, timing = compose_email_streaming(
+            context=mail_context,
+            relationship=relationship,
+            mood=mood,
+            recipient_email=to_email,
+            sender_name=sender_name,
+            on_text=print_streamed,
+        )
+        first = f"{timing.first_text:.2f}s" if timing.first_text is not None else "n/a"
+        print(f"\n[STREAM] First text after {first}, complete after {timing.total:.2f}s.")
+    else:
+        result = compose_email_from_context(
+            context=mail_context,
+            relationship=relationship,
+            mood=mood,
+            recipient_email=to_email,
+            sender_name=sender_name,
+        )
 
     # Safety: replace placeholders if the model still used them
     body_text = result.body
@@ -152,16 +283,6 @@ def send_email_interactive():
 
 
 if __name__ == "__main__":
-    print("What would you like to do?")
-    print("1. Send Email")
-    print("2. Watch Inbox and Auto-Reply")
-    print()
-
-    choice = input("Enter number of action here (1 or 2): ").strip()
+    from sandra import interactive_menu
 
-    if choice == "1":
-        send_email_interactive()
-    elif choice == "2":
-        watch_inbox(interval=2)
-    else:
-        print("Invalid choice. Exiting.")
+    interactive_menu()